@@ -1,9 +1,13 @@
 from contextlib import asynccontextmanager
-from fastapi import FastAPI
+from fastapi import FastAPI, Query
 import logging
 from datetime import datetime
 from fastapi.responses import FileResponse
 import os
+import tempfile
+import time
+from typing import Optional
+from utils.lazy_state import LazyState
 
 
 # 配置日志
@@ -11,6 +15,30 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def _create_services() -> dict:
+    """创建用户存储、超时检查器和发件箱，在首个需要它们的请求中调用"""
+    # 动态导入以避免循环依赖和路径问题，同时缩短冷启动时间
+    from db.user_storage import UserStorage
+    from db.async_user_storage import AsyncUserStorage
+    from utils.timeout_checker import TimeoutChecker
+    from utils.outbox_dispatcher import OutboxDispatcher
+    
+    start = time.perf_counter()
+    # 初始化用户存储，数据库调用在线程池中执行，不阻塞事件循环
+    user_storage = AsyncUserStorage(UserStorage())
+    
+    # 初始化超时检查器，推送使用的HTTP会话在首次发送时创建
+    timeout_checker = TimeoutChecker()
+    
+    # 告警写入发件箱，由手动触发的超时检查接口顺带投递（无后台任务）
+    timeout_checker.outbox = OutboxDispatcher(
+        user_storage, timeout_checker.service_manager, event_bus=timeout_checker.event_bus
+    )
+    
+    logger.info(f"存储和超时检查器初始化完成，耗时 {time.perf_counter() - start:.3f} 秒")
+    return {"user_storage": user_storage, "timeout_checker": timeout_checker}
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """生命周期管理器 - 适用于Vercel部署"""
@@ -19,18 +47,14 @@ async def lifespan(app: FastAPI):
     # 在Vercel环境中，强制使用内存数据库，因为文件系统是只读的
     if os.environ.get("VERCEL"):
         os.environ.setdefault("USE_MEMORY_DB", "true")
+        # 同一实例重启（冷启动复用临时目录）时从快照恢复，而不是从空数据库开始
+        os.environ.setdefault(
+            "MEMORY_SNAPSHOT_PATH",
+            os.path.join(os.environ.get("TMPDIR", tempfile.gettempdir()), "user_data.snapshot")
+        )
     
-    # 动态导入以避免循环依赖和路径问题
-    from db.user_storage import UserStorage
-    from utils.timeout_checker import TimeoutChecker
-    
-    # 初始化用户存储
-    user_storage = UserStorage()
-    app.state.user_storage = user_storage
-    
-    # 初始化超时检查器
-    timeout_checker = TimeoutChecker()
-    app.state.timeout_checker = timeout_checker
+    # 存储和超时检查器在首次访问app.state.user_storage等属性时才创建，健康检查无需等待
+    app.state = LazyState(_create_services)
     
     # 注意：Vercel Serverless Functions 是无状态的
     # 长时间运行的后台任务（如APScheduler）在此环境中不可靠
@@ -39,16 +63,28 @@ async def lifespan(app: FastAPI):
     logger.info("Vercel应用启动完成")
     yield
     
-    # 清理资源
+    # 清理资源，未初始化时无需清理
     logger.info("正在关闭Vercel应用...")
+    timeout_checker = app.state.get_initialized("timeout_checker")
+    if timeout_checker is not None:
+        await timeout_checker.close()
+    user_storage = app.state.get_initialized("user_storage")
+    if user_storage is not None:
+        await user_storage.close()
 
 
 app = FastAPI(lifespan=lifespan)
 
 # 动态导入路由
-from routes import users_router
+from routes import users_router, outbox_router, events_router, metrics_router, admin_router, metrics_middleware
 # 注册路由
 app.include_router(users_router)
+app.include_router(outbox_router)
+app.include_router(events_router)
+app.include_router(metrics_router)
+app.include_router(admin_router)
+# 统计HTTP请求耗时
+app.middleware("http")(metrics_middleware)
 
 
 @app.get("/")
@@ -75,14 +111,29 @@ async def health_check():
 
 # 添加一个端点用于手动触发超时检查（替代后台任务）
 @app.post("/trigger-timeout-check")
-async def trigger_timeout_check():
-    """手动触发超时检查"""
+async def trigger_timeout_check(
+    budget: float = Query(None, gt=0, le=300, description="本次调用的时间预算（秒）"),
+    cursor: Optional[str] = Query(None, description="从该user_id之后继续，默认使用上次保存的进度"),
+    batch_size: int = Query(200, ge=1, le=5000)
+):
+    """手动触发超时检查
+    
+    在时间预算内按user_id顺序分批检查已到期用户并投递告警，未处理完的部分由下次调用接续，
+    适合由Vercel Cron Jobs定期调用。
+    """
     timeout_checker = app.state.timeout_checker
     user_storage = app.state.user_storage
-    users_db = user_storage.get_all_users()
+    if budget is None:
+        budget = float(os.environ.get("TIMEOUT_CHECK_BUDGET", "8"))
     
-    await timeout_checker.check_all_users_timeout(users_db)
-    return {"message": "Timeout check completed", "timestamp": datetime.now()}
+    # 一半预算用于检查，剩余时间投递本次及之前到期重试的告警
+    stats = await timeout_checker.check_overdue_users_budgeted(
+        user_storage, budget / 2, cursor=cursor, batch_size=batch_size
+    )
+    stats["outbox"] = await timeout_checker.outbox.drain(budget=max(budget - stats["elapsed"], 0.0))
+    # 没有后台调度器，由定时调用顺带清理过期的打卡历史，每小时最多一次
+    stats["checkin_history_compacted"] = await user_storage.compact_checkin_history(min_interval=3600)
+    return {"message": "Timeout check completed", "timestamp": datetime.now(), "stats": stats}
 
 
 # 根路径重定向到 docs
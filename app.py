@@ -4,6 +4,7 @@ import logging
 from datetime import datetime
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from fastapi.responses import FileResponse
+import os
 
 
 # 配置日志
@@ -18,56 +19,94 @@ async def lifespan(app: FastAPI):
     
     # 动态导入以避免循环依赖和路径问题
     from db.user_storage import UserStorage
+    from db.async_user_storage import AsyncUserStorage
     from utils.timeout_checker import TimeoutChecker
+    from utils.shard_lease import ShardLeaseManager
+    from utils.outbox_dispatcher import OutboxDispatcher
+    from db.checkin_buffer import CheckinBuffer
+    from utils.request_profile import LOOP_MONITOR
     
-    # 初始化用户存储
-    user_storage = UserStorage()
+    # 初始化用户存储，数据库调用在线程池中执行，不阻塞事件循环
+    user_storage = AsyncUserStorage(UserStorage())
     app.state.user_storage = user_storage
     
+    # 多进程或多节点共享同一数据库时，通过分片租约分摊超时检查，避免重复告警
+    lease_manager = None
+    if os.environ.get("SHARDED_TIMEOUT_CHECK", "").lower() == "true":
+        lease_manager = ShardLeaseManager(user_storage)
+        await lease_manager.renew()
+    
     # 初始化超时检查器
-    timeout_checker = TimeoutChecker()
+    timeout_checker = TimeoutChecker(lease_manager=lease_manager)
+    await timeout_checker.start()
     app.state.timeout_checker = timeout_checker
     
+    # 告警写入发件箱后由后台任务投递，失败按退避重试，重启后继续投递未完成的告警
+    outbox = OutboxDispatcher(user_storage, timeout_checker.service_manager, event_bus=timeout_checker.event_bus)
+    timeout_checker.outbox = outbox
+    await outbox.start()
+    
+    # 打卡频繁时合并写入：同一时间段内的打卡在一个事务中提交，提交后才返回
+    checkin_buffer = None
+    if os.environ.get("CHECKIN_WRITE_BEHIND", "").lower() == "true":
+        checkin_buffer = CheckinBuffer(user_storage)
+        timeout_checker.checkin_buffer = checkin_buffer
+    
     # 启动定时任务调度器
     scheduler = AsyncIOScheduler()
     scheduler.start()
     
-    # 每分钟检查一次打卡超时
-    scheduler.add_job(
-        check_all_users_timeout_job, 
-        "interval", 
-        minutes=1,
-        args=[app]
-    )
+    # 按最近的打卡截止时间唤醒检查，而不是每分钟全量扫描所有用户
+    shards = lease_manager.shards if lease_manager else None
+    timeout_checker.load_deadlines(await user_storage.get_deadlines(shards))
+    timeout_checker.attach_scheduler(scheduler, user_storage)
     
     app.state.scheduler = scheduler
     
+    # 每小时清理超过保留期的打卡历史，累计打卡统计不受影响
+    async def compact_checkin_history():
+        deleted = await user_storage.compact_checkin_history()
+        if deleted:
+            logger.info(f"已清理 {deleted} 条过期打卡历史")
+    
+    scheduler.add_job(compact_checkin_history, "interval", hours=1, id="compact_checkin_history")
+    
+    # 测量事件循环调度延迟，慢请求日志据此判断是否有同步代码阻塞事件循环
+    await LOOP_MONITOR.start()
+    
     yield
     
+    await LOOP_MONITOR.close()
+    
     # 关闭调度器
     scheduler.shutdown()
-
-
-# 注意：由于Vercel不支持长时间运行的后台任务，以下函数不会自动执行
-# 如需定期执行此任务，应使用外部服务或Vercel Cron Jobs
-async def check_all_users_timeout_job(app: FastAPI):
-    """检查所有用户超时的作业函数"""
-    from db.user_storage import UserStorage
-    from utils.timeout_checker import TimeoutChecker
     
-    timeout_checker = app.state.timeout_checker
-    user_storage = app.state.user_storage
-    users_db = user_storage.get_all_users()
+    # 释放分片租约，其他进程无需等待租约到期即可接管
+    if lease_manager:
+        await lease_manager.release()
+    
+    # 提交尚未写入的打卡
+    if checkin_buffer:
+        await checkin_buffer.close()
     
-    await timeout_checker.check_all_users_timeout(users_db)
+    # 停止发件箱投递，关闭推送服务HTTP会话和数据库连接
+    await outbox.close()
+    await timeout_checker.close()
+    await user_storage.close()
 
 
 app = FastAPI(lifespan=lifespan)
 
 # 动态导入路由
-from routes import users_router
+from routes import users_router, outbox_router, events_router, metrics_router, admin_router, metrics_middleware
 # 注册路由
 app.include_router(users_router)
+app.include_router(outbox_router)
+app.include_router(events_router)
+app.include_router(metrics_router)
+app.include_router(admin_router)
+# 统计HTTP请求耗时
+app.middleware("http")(metrics_middleware)
 
 
 @app.get("/")
@@ -0,0 +1,115 @@
+"""Vercel入口冷启动基准测试
+
+每次在全新的子进程中导入 ``api.app`` 并请求 ``/health``，输出导入耗时和首个响应耗时；
+``--imports`` 模式用 ``python -X importtime`` 统计导入各模块的耗时，按累计耗时排序输出。
+
+    python benchmarks/bench_cold_start.py --runs 10
+    python benchmarks/bench_cold_start.py --imports --top 30
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# 在子进程中执行：记录导入应用和首个/health响应的耗时（秒），不含导入测试客户端的时间
+CHILD_SCRIPT = """
+import json, time
+start = time.perf_counter()
+from api.app import app
+imported = time.perf_counter()
+from fastapi.testclient import TestClient
+client_imported = time.perf_counter()
+with TestClient(app) as client:
+    status = client.get("/health").status_code
+    responded = time.perf_counter()
+print(json.dumps({
+    "status": status,
+    "import": imported - start,
+    "startup": responded - client_imported,
+    "first_response": imported - start + responded - client_imported,
+}))
+"""
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Vercel入口冷启动基准测试")
+    parser.add_argument("--runs", type=int, default=5, help="冷启动次数，取中位数")
+    parser.add_argument("--module", default="api.app", help="--imports模式下导入的模块")
+    parser.add_argument("--imports", action="store_true", help="统计各模块的导入耗时")
+    parser.add_argument("--top", type=int, default=25, help="--imports模式下输出的模块数")
+    parser.add_argument("--output", help="结果写入的JSON文件，默认输出到标准输出")
+    return parser.parse_args(argv)
+
+
+def child_env() -> dict:
+    """模拟Vercel环境：内存存储，临时目录不含上次的快照"""
+    env = dict(os.environ)
+    env["VERCEL"] = "1"
+    env["TMPDIR"] = tempfile.mkdtemp(prefix="cold-start-")
+    env["PYTHONPATH"] = str(ROOT)
+    return env
+
+
+def measure_cold_start(runs: int) -> dict:
+    """多次冷启动，返回各阶段耗时的中位数和最大值（毫秒）"""
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-c", CHILD_SCRIPT], capture_output=True, text=True, cwd=str(ROOT), env=child_env()
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"冷启动子进程失败:\n{result.stderr}")
+        samples.append(json.loads(result.stdout.strip().splitlines()[-1]))
+    
+    report = {"runs": runs}
+    for key in ("import", "startup", "first_response"):
+        values = [sample[key] * 1000 for sample in samples]
+        report[f"{key}_ms_median"] = round(statistics.median(values), 1)
+        report[f"{key}_ms_max"] = round(max(values), 1)
+    return report
+
+
+def profile_imports(module: str, top: int) -> dict:
+    """解析 ``-X importtime`` 的输出，返回累计耗时最高的模块（微秒）"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, cwd=str(ROOT), env=child_env()
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"导入 {module} 失败:\n{result.stderr}")
+    
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules.append({"module": name.strip(), "self_us": int(self_us), "cumulative_us": int(cumulative_us)})
+    
+    total = next((item["cumulative_us"] for item in modules if item["module"] == module), None)
+    modules.sort(key=lambda item: item["cumulative_us"], reverse=True)
+    return {"module": module, "total_us": total, "imported_modules": len(modules), "top": modules[:top]}
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.imports:
+        report = profile_imports(args.module, args.top)
+    else:
+        report = measure_cold_start(args.runs)
+    
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""超时检查与推送链路基准测试
+
+用合成用户数据填充UserStorage（SQLite或内存模式），对本地模拟的钉钉webhook执行超时检查，
+以JSON输出耗时、告警吞吐和内存峰值，便于对比不同版本。
+
+    python benchmarks/bench_timeout_check.py --users 10000,100000 --mode both --latency-ms 50 --output result.json
+
+每个（模式, 用户数）组合在独立子进程中运行，内存峰值互不影响。
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="超时检查与推送链路基准测试")
+    parser.add_argument("--users", default="10000", help="用户数，多个用逗号分隔，例如 10000,100000,1000000")
+    parser.add_argument("--mode", choices=["sqlite", "memory", "both"], default="both", help="存储模式")
+    parser.add_argument("--overdue-ratio", type=float, default=0.1, help="已超时用户比例")
+    parser.add_argument("--rules-per-user", type=int, default=1, help="每个用户的推送规则数")
+    parser.add_argument("--webhooks", type=int, default=100, help="不同webhook数量，用户按顺序共用")
+    parser.add_argument("--latency-ms", type=float, default=50, help="模拟webhook的响应延迟（毫秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟webhook返回错误的比例")
+    parser.add_argument("--concurrency", type=int, default=50, help="同时推送的用户数上限")
+    parser.add_argument("--rate-limit", type=float, default=1e9, help="每个webhook每分钟消息数上限，默认不限流")
+    parser.add_argument("--digest-window", type=float, default=0.05, help="同一webhook通知的合并窗口（秒）")
+    parser.add_argument("--output", help="结果写入的JSON文件，默认输出到标准输出")
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def make_users(count: int, overdue_ratio: float, rules_per_user: int, webhooks: int, webhook_url: str):
+    """生成合成用户：前overdue_ratio比例已超时，其余刚打过卡"""
+    from models.push_rule import PushRule
+    from models.user import CheckinUser
+    
+    now = datetime.now()
+    overdue_count = int(count * overdue_ratio)
+    for i in range(count):
+        hours_ago = 2 if i < overdue_count else 0
+        yield CheckinUser(
+            user_id=f"bench{i:08d}",
+            timeout_duration=1,
+            last_checkin_time=now - timedelta(hours=hours_ago),
+            push_rules=[
+                PushRule(
+                    id=f"rule{r}",
+                    type="dingtalk",
+                    config={"webhook_url": f"{webhook_url}?access_token=team{(i + r) % webhooks}"}
+                )
+                for r in range(rules_per_user)
+            ]
+        )
+
+
+def peak_rss_mb() -> float:
+    """进程内存峰值（MB）"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux上单位为KB，macOS上为字节
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+async def run_single(args, users: int, mode: str) -> dict:
+    """在当前进程中运行一个（模式, 用户数）组合"""
+    from benchmarks.fake_dingtalk import FakeDingtalkServer
+    from db.async_user_storage import AsyncUserStorage
+    from db.user_storage import UserStorage
+    from utils.metrics import PUSH_USERS
+    from utils.timeout_checker import TimeoutChecker
+    
+    server = FakeDingtalkServer(latency=args.latency_ms / 1000, error_rate=args.error_rate)
+    server.start()
+    
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    storage = UserStorage(db_path=os.path.join(workdir, "users.db"))
+    async_storage = AsyncUserStorage(storage)
+    
+    start = time.perf_counter()
+    seeded = await async_storage.import_users(
+        make_users(users, args.overdue_ratio, args.rules_per_user, args.webhooks, server.url)
+    )
+    seed_seconds = time.perf_counter() - start
+    
+    checker = TimeoutChecker(max_concurrency=args.concurrency)
+    checker.service_manager.batcher.rate_per_minute = args.rate_limit
+    checker.service_manager.batcher.window = args.digest_window
+    await checker.start()
+    
+    # 成功送达的告警以推送计数为准（摘要消息中的每个用户计一次），而不是按超时用户数推算
+    delivered_before = PUSH_USERS.get(service="dingtalk", result="success")
+    failed_before = PUSH_USERS.get(service="dingtalk", result="failure")
+    try:
+        start = time.perf_counter()
+        overdue = await async_storage.get_overdue_users(time.time())
+        load_seconds = time.perf_counter() - start
+        
+        stats = await checker.check_all_users_timeout(overdue, async_storage)
+        scan_seconds = stats["elapsed"]
+        alerts = int(PUSH_USERS.get(service="dingtalk", result="success") - delivered_before)
+        failed_alerts = int(PUSH_USERS.get(service="dingtalk", result="failure") - failed_before)
+    finally:
+        await checker.close()
+        await async_storage.close()
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    
+    return {
+        "mode": mode,
+        "users": seeded,
+        "overdue_ratio": args.overdue_ratio,
+        "rules_per_user": args.rules_per_user,
+        "webhooks": args.webhooks,
+        "latency_ms": args.latency_ms,
+        "error_rate": args.error_rate,
+        "concurrency": args.concurrency,
+        "seed_seconds": round(seed_seconds, 4),
+        "load_overdue_seconds": round(load_seconds, 4),
+        "scan_seconds": round(scan_seconds, 4),
+        "checked": stats["checked"],
+        "timed_out": stats["timed_out"],
+        "alerts": alerts,
+        "failed_alerts": failed_alerts,
+        "alerts_per_second": round(alerts / scan_seconds, 1) if scan_seconds else None,
+        "webhook_messages": server.messages,
+        "webhook_errors": server.errors,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def run_isolated(args, users: int, mode: str) -> dict:
+    """在子进程中运行一个组合，返回其JSON结果"""
+    argv = [
+        sys.executable, __file__, "--single",
+        "--users", str(users),
+        "--mode", mode,
+        "--overdue-ratio", str(args.overdue_ratio),
+        "--rules-per-user", str(args.rules_per_user),
+        "--webhooks", str(args.webhooks),
+        "--latency-ms", str(args.latency_ms),
+        "--error-rate", str(args.error_rate),
+        "--concurrency", str(args.concurrency),
+        "--rate-limit", str(args.rate_limit),
+        "--digest-window", str(args.digest_window),
+    ]
+    result = subprocess.run(argv, capture_output=True, text=True, cwd=str(ROOT))
+    if result.returncode != 0:
+        raise RuntimeError(f"基准测试子进程失败（{mode}, {users}）:\n{result.stderr}")
+    return json.loads(result.stdout)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    
+    if args.single:
+        if args.mode == "memory":
+            os.environ["USE_MEMORY_DB"] = "true"
+        else:
+            os.environ.pop("USE_MEMORY_DB", None)
+        # 结果只写标准输出，供父进程解析
+        result = asyncio.run(run_single(args, int(args.users), args.mode))
+        print(json.dumps(result))
+        return
+    
+    modes = ["sqlite", "memory"] if args.mode == "both" else [args.mode]
+    sizes = [int(size) for size in args.users.split(",")]
+    report = {
+        "timestamp": datetime.now().isoformat(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "sqlite": sqlite3.sqlite_version,
+            "cpu_count": os.cpu_count(),
+        },
+        "results": [run_isolated(args, size, mode) for size in sizes for mode in modes],
+    }
+    
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
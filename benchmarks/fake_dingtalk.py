@@ -0,0 +1,63 @@
+import asyncio
+import random
+import threading
+from aiohttp import web
+
+
+class FakeDingtalkServer:
+    """本地模拟的钉钉机器人webhook，可配置响应延迟和错误率
+    
+    在独立线程的事件循环中运行，避免与被测的超时检查争用同一个事件循环。
+    """
+    
+    def __init__(self, latency: float = 0.05, error_rate: float = 0.0, port: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.port = port
+        self.messages = 0
+        self.errors = 0
+        self._loop = None
+        self._runner = None
+        self._thread = None
+        self._ready = threading.Event()
+    
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/robot/send"
+    
+    async def _handle(self, request: web.Request) -> web.Response:
+        await request.read()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response({"errcode": 130101, "errmsg": "send too fast"})
+        self.messages += 1
+        return web.json_response({"errcode": 0, "errmsg": "ok"})
+    
+    async def _start(self):
+        app = web.Application()
+        app.router.add_post("/robot/send", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+    
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        self._loop.run_until_complete(self._start())
+        self._ready.set()
+        self._loop.run_forever()
+        self._loop.run_until_complete(self._runner.cleanup())
+        self._loop.close()
+    
+    def start(self):
+        """在后台线程中启动服务器，返回后即可接收请求"""
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+    
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
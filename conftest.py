@@ -0,0 +1,15 @@
+import pytest
+from db.user_storage import UserStorage
+
+
+@pytest.fixture(params=["sqlite", "memory"])
+def storage(request, tmp_path, monkeypatch):
+    """分别使用SQLite和内存模式的用户存储"""
+    if request.param == "memory":
+        monkeypatch.setenv("USE_MEMORY_DB", "true")
+        storage = UserStorage()
+    else:
+        monkeypatch.delenv("USE_MEMORY_DB", raising=False)
+        storage = UserStorage(db_path=str(tmp_path / "users.db"))
+    yield storage
+    storage.close()
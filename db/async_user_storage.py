@@ -0,0 +1,246 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from db.user_storage import UserStorage
+from models.checkin import CheckinResult
+from models.checkin_stats import CheckinStats
+from models.notification_state import NotificationState
+from models.outbox import OutboxEntry
+from models.user import CheckinUser
+from utils.metrics import STORAGE_DURATION, STORAGE_ERRORS
+from utils.request_profile import profile_span
+
+
+class AsyncUserStorage:
+    """UserStorage的异步封装，避免SQLite调用阻塞事件循环
+    
+    读操作在读线程池中执行（每个线程持有自己的连接，WAL模式下可并发读），
+    写操作全部提交给单个写线程串行执行，避免多个写事务争用数据库锁。
+    内存模式没有IO，直接在事件循环中调用。
+    """
+    
+    def __init__(self, storage: UserStorage, read_threads: Optional[int] = None):
+        self.storage = storage
+        self.use_memory = storage.use_memory
+        self.cache = storage.cache
+        
+        if read_threads is None:
+            read_threads = int(os.environ.get("DB_READ_THREADS", "4"))
+        
+        self._read_executor = None
+        self._write_executor = None
+        if not self.use_memory:
+            self._read_executor = ThreadPoolExecutor(max_workers=read_threads, thread_name_prefix="db-read")
+            self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+        
+        # 打卡历史保留天数，及上次清理的时间（monotonic）
+        self.history_retention_days = float(os.environ.get("CHECKIN_HISTORY_RETENTION_DAYS", "90"))
+        self._history_compacted_at: Optional[float] = None
+    
+    @staticmethod
+    def _timed(func, *args, **kwargs):
+        """执行存储调用并记录耗时指标（不含在线程池中排队的时间）"""
+        operation = func.__name__.lstrip("_")
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            STORAGE_ERRORS.inc(operation=operation)
+            raise
+        finally:
+            STORAGE_DURATION.observe(time.perf_counter() - start, operation=operation)
+    
+    async def _read(self, func, *args, **kwargs):
+        """在读线程池中执行，等待时间（含排队）计入当前请求的存储耗时"""
+        with profile_span("storage"):
+            if self._read_executor is None:
+                return self._timed(func, *args, **kwargs)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._read_executor, partial(self._timed, func, *args, **kwargs))
+    
+    async def _write(self, func, *args, **kwargs):
+        """在写线程中执行，等待时间（含排队）计入当前请求的存储耗时"""
+        with profile_span("storage"):
+            if self._write_executor is None:
+                return self._timed(func, *args, **kwargs)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._write_executor, partial(self._timed, func, *args, **kwargs))
+    
+    async def close(self):
+        """等待进行中的操作和后台快照完成后关闭线程池和数据库连接"""
+        await self.storage.wait_snapshot()
+        loop = asyncio.get_running_loop()
+        for executor in (self._read_executor, self._write_executor):
+            if executor is not None:
+                await loop.run_in_executor(None, partial(executor.shutdown, wait=True))
+        self.storage.close()
+    
+    async def get_user(self, user_id: str) -> Optional[CheckinUser]:
+        """获取用户"""
+        # 缓存命中时无需切换线程
+        cached = self.cache.get(user_id)
+        if cached is not None:
+            return cached[0].model_copy()
+        if self.use_memory:
+            return self._timed(self.storage.get_user, user_id)
+        return await self._read(self.storage._load_user, user_id)
+    
+    async def get_user_version(self, user_id: str) -> Optional[int]:
+        """获取用户数据的版本，用户不存在时返回None"""
+        return await self._read(self.storage.get_user_version, user_id)
+    
+    async def get_user_at_version(self, user_id: str, version: int) -> Optional[Tuple[CheckinUser, int]]:
+        """获取与version一致的用户及其版本，缓存中的用户版本不一致时重新读取"""
+        cached = self.cache.get(user_id)
+        if cached is not None and cached[1] == version:
+            return cached[0].model_copy(), version
+        return await self._read(self.storage.get_user_at_version, user_id, version)
+    
+    async def get_users(self, user_ids: List[str]) -> Dict[str, CheckinUser]:
+        """批量获取用户"""
+        return await self._read(self.storage.get_users, user_ids)
+    
+    async def get_all_users(self) -> Dict[str, CheckinUser]:
+        """获取所有用户"""
+        return await self._read(self.storage.get_all_users)
+    
+    async def list_users(
+        self,
+        after_user_id: str = "",
+        limit: int = 100,
+        fields: Optional[Iterable[str]] = None,
+        overdue: Optional[bool] = None,
+        push_type: Optional[str] = None,
+        enabled: Optional[bool] = None
+    ) -> List[dict]:
+        """按user_id键集分页列出用户，只返回请求的字段"""
+        return await self._read(
+            self.storage.list_users, after_user_id, limit, fields, overdue, push_type, enabled
+        )
+    
+    async def get_overdue_users(
+        self,
+        now: float,
+        limit: Optional[int] = None,
+        shards: Optional[Iterable[int]] = None
+    ) -> Dict[str, CheckinUser]:
+        """获取下次检查时间已到的用户"""
+        return await self._read(self.storage.get_overdue_users, now, limit, shards)
+    
+    async def get_overdue_users_page(
+        self,
+        now: float,
+        after_user_id: str = "",
+        limit: int = 200
+    ) -> Dict[str, CheckinUser]:
+        """按user_id顺序分页获取下次检查时间已到的用户"""
+        return await self._read(self.storage.get_overdue_users_page, now, after_user_id, limit)
+    
+    async def get_cursor(self, name: str) -> str:
+        """读取分批检查的进度游标"""
+        return await self._read(self.storage.get_cursor, name)
+    
+    async def save_cursor(self, name: str, cursor: str):
+        """保存分批检查的进度游标"""
+        await self._write(self.storage.save_cursor, name, cursor)
+    
+    async def get_deadlines(self, shards: Optional[Iterable[int]] = None) -> List[Tuple[str, float]]:
+        """获取用户的下次检查时间"""
+        return await self._read(self.storage.get_deadlines, shards)
+    
+    async def get_notification_states(self, user_id: str) -> Dict[str, NotificationState]:
+        """获取用户各推送规则的告警状态"""
+        return await self._read(self.storage.get_notification_states, user_id)
+    
+    def iter_users_ndjson(self, batch_size: int = 1000) -> Iterator[str]:
+        """同步生成器，交给StreamingResponse在线程池中迭代"""
+        return self.storage.iter_users_ndjson(batch_size)
+    
+    async def save_user(self, user: CheckinUser):
+        """保存用户"""
+        await self._write(self.storage.save_user, user)
+    
+    async def delete_user(self, user_id: str) -> bool:
+        """删除用户"""
+        return await self._write(self.storage.delete_user, user_id)
+    
+    async def record_checkin(self, user_id: str, checkin_time: datetime) -> Optional[float]:
+        """记录单次打卡"""
+        return await self._write(self.storage.record_checkin, user_id, checkin_time)
+    
+    async def record_checkins(self, checkins: List[Tuple[str, datetime]]) -> List[CheckinResult]:
+        """批量记录打卡"""
+        return await self._write(self.storage.record_checkins, checkins)
+    
+    async def get_checkin_stats(self, user_id: str) -> Optional[CheckinStats]:
+        """用户的累计打卡统计"""
+        return await self._read(self.storage.get_checkin_stats, user_id)
+    
+    async def count_checkin_events(self, user_id: str, since: float, until: float) -> Tuple[int, int]:
+        """统计时间范围内的打卡次数和超时后打卡的次数"""
+        return await self._read(self.storage.count_checkin_events, user_id, since, until)
+    
+    async def compact_checkin_events(self, before: float) -> int:
+        """删除早于before的打卡历史"""
+        return await self._write(self.storage.compact_checkin_events, before)
+    
+    async def compact_checkin_history(self, min_interval: float = 0) -> int:
+        """删除超过保留期的打卡历史；距上次清理不足min_interval秒时跳过，返回删除条数"""
+        now = time.monotonic()
+        if self._history_compacted_at is not None and now - self._history_compacted_at < min_interval:
+            return 0
+        self._history_compacted_at = now
+        return await self.compact_checkin_events(time.time() - self.history_retention_days * 86400)
+    
+    async def import_users(self, users: Iterable[CheckinUser], chunk_size: int = 1000) -> int:
+        """分块导入用户"""
+        return await self._write(self.storage.import_users, users, chunk_size)
+    
+    async def save_notification_states(
+        self,
+        user_id: str,
+        deadline_at: float,
+        states: List[NotificationState],
+        next_alert_at: Optional[float],
+        outbox_entries: Optional[List[OutboxEntry]] = None
+    ) -> bool:
+        """保存推送后的告警状态，可同时写入发件箱"""
+        return await self._write(
+            self.storage.save_notification_states, user_id, deadline_at, states, next_alert_at, outbox_entries
+        )
+    
+    async def claim_alert(self, user_id: str, deadline_at: float, now: float, claim_until: float) -> bool:
+        """推送前认领告警"""
+        return await self._write(self.storage.claim_alert, user_id, deadline_at, now, claim_until)
+    
+    async def acquire_shard_leases(self, worker_id: str, ttl: float) -> List[int]:
+        """续约并分配分片租约"""
+        return await self._write(self.storage.acquire_shard_leases, worker_id, ttl)
+    
+    async def release_shard_leases(self, worker_id: str):
+        """释放分片租约"""
+        await self._write(self.storage.release_shard_leases, worker_id)
+    
+    async def claim_outbox(self, now: float, claim_until: float, limit: int = 100) -> List[OutboxEntry]:
+        """认领一批到期的待投递告警"""
+        return await self._write(self.storage.claim_outbox, now, claim_until, limit)
+    
+    async def complete_outbox(self, entry_id: int):
+        """投递成功后移除告警"""
+        await self._write(self.storage.complete_outbox, entry_id)
+    
+    async def fail_outbox(self, entry_id: int, attempts: int, next_attempt_at: Optional[float], error: str):
+        """记录投递失败"""
+        await self._write(self.storage.fail_outbox, entry_id, attempts, next_attempt_at, error)
+    
+    async def get_outbox_entries(self, status: Optional[str] = None, limit: int = 100) -> List[OutboxEntry]:
+        """列出发件箱中的告警"""
+        return await self._read(self.storage.get_outbox_entries, status, limit)
+    
+    async def get_outbox_stats(self) -> Dict[str, int]:
+        """各状态的告警数量"""
+        return await self._read(self.storage.get_outbox_stats)
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Dict, Optional, Set
+from models.checkin import CheckinResult
+from utils.metrics import CHECKIN_FLUSH_SIZE
+
+
+logger = logging.getLogger(__name__)
+
+
+class CheckinBuffer:
+    """打卡合并写入（组提交）
+    
+    打卡先记入内存，每flush_interval秒或累计max_entries个用户时在一个事务中批量写入，
+    同一用户在一批内的多次打卡只写最新的一次。record_checkin在所在批次提交后才返回，
+    因此接口确认过的打卡不会因进程崩溃丢失；提交前超时检查器通过pending_checkin读取最新打卡时间。
+    """
+    
+    def __init__(
+        self,
+        user_storage,
+        flush_interval: Optional[float] = None,
+        max_entries: Optional[int] = None
+    ):
+        self.user_storage = user_storage
+        if flush_interval is None:
+            flush_interval = float(os.environ.get("CHECKIN_FLUSH_INTERVAL_MS", "50")) / 1000
+        self.flush_interval = flush_interval
+        if max_entries is None:
+            max_entries = int(os.environ.get("CHECKIN_FLUSH_MAX_ENTRIES", "1000"))
+        self.max_entries = max_entries
+        # 当前批次：用户 -> 最新打卡时间，以及批次提交后的结果
+        self._pending: Dict[str, datetime] = {}
+        self._batch: Optional[asyncio.Future] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # 尚未提交（含正在提交）的最新打卡时间，供超时检查器读取
+        self._unflushed: Dict[str, datetime] = {}
+        # 批次按顺序提交，避免较早的批次覆盖较新的打卡
+        self._flush_lock = asyncio.Lock()
+        self._flushes: Set[asyncio.Task] = set()
+    
+    def pending_checkin(self, user_id: str) -> Optional[datetime]:
+        """尚未写入存储的最新打卡时间"""
+        return self._unflushed.get(user_id)
+    
+    async def record_checkin(self, user_id: str, checkin_time: datetime) -> CheckinResult:
+        """记录打卡，所在批次提交后返回该用户的写入结果"""
+        latest = self._pending.get(user_id)
+        if latest is None or checkin_time > latest:
+            self._pending[user_id] = checkin_time
+            unflushed = self._unflushed.get(user_id)
+            if unflushed is None or checkin_time > unflushed:
+                self._unflushed[user_id] = checkin_time
+        
+        if self._batch is None:
+            loop = asyncio.get_running_loop()
+            self._batch = loop.create_future()
+            self._timer = loop.call_later(self.flush_interval, self._start_flush)
+        batch = self._batch
+        if len(self._pending) >= self.max_entries:
+            self._start_flush()
+        
+        # 请求被取消（客户端断开）不影响批次提交
+        results = await asyncio.shield(batch)
+        return results[user_id]
+    
+    def _start_flush(self):
+        """取出当前批次并在后台提交"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._batch is None:
+            return
+        
+        pending, batch = self._pending, self._batch
+        self._pending, self._batch = {}, None
+        task = asyncio.create_task(self._flush(pending, batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+    
+    async def _flush(self, pending: Dict[str, datetime], batch: asyncio.Future):
+        async with self._flush_lock:
+            start = time.perf_counter()
+            try:
+                results = await self.user_storage.record_checkins(list(pending.items()))
+            except Exception as e:
+                logger.error(f"批量写入 {len(pending)} 条打卡失败: {str(e)}")
+                batch.set_exception(e)
+                # 没有等待者时避免未读取异常的警告
+                batch.exception()
+            else:
+                batch.set_result({result.user_id: result for result in results})
+            finally:
+                for user_id, checkin_time in pending.items():
+                    if self._unflushed.get(user_id) == checkin_time:
+                        del self._unflushed[user_id]
+            
+            CHECKIN_FLUSH_SIZE.observe(len(pending))
+            logger.debug(f"已提交 {len(pending)} 条打卡，耗时 {time.perf_counter() - start:.3f} 秒")
+    
+    async def close(self):
+        """提交剩余的打卡并等待所有批次完成"""
+        self._start_flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
@@ -0,0 +1,404 @@
+import bisect
+import json
+import math
+import os
+import struct
+import tempfile
+import time
+from array import array
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+from models.push_rule import PushRule
+from models.user import CheckinUser
+
+
+_NAN = float("nan")
+# 快照JSON按块编码，每块之间释放GIL，后台写快照时事件循环不会长时间停顿
+_JSON_CHUNK = 1000
+
+
+def _iter_json(value) -> Iterator[str]:
+    """分块编码JSON，结果与json.dumps(value, ensure_ascii=False)等价"""
+    if isinstance(value, dict):
+        if len(value) > _JSON_CHUNK:
+            items = list(value.items())
+            yield "{"
+            for start in range(0, len(items), _JSON_CHUNK):
+                if start:
+                    yield ", "
+                yield json.dumps(dict(items[start:start + _JSON_CHUNK]), ensure_ascii=False)[1:-1]
+            yield "}"
+        else:
+            yield "{"
+            for index, (key, item) in enumerate(value.items()):
+                if index:
+                    yield ", "
+                yield json.dumps(str(key), ensure_ascii=False)
+                yield ": "
+                yield from _iter_json(item)
+            yield "}"
+    elif isinstance(value, (list, tuple)) and len(value) > _JSON_CHUNK:
+        yield "["
+        for start in range(0, len(value), _JSON_CHUNK):
+            if start:
+                yield ", "
+            yield json.dumps(list(value[start:start + _JSON_CHUNK]), ensure_ascii=False)[1:-1]
+        yield "]"
+    else:
+        yield json.dumps(value, ensure_ascii=False)
+
+
+class _UserRecord:
+    """单个用户的非数值字段，时间戳保存在CompactUserStore的数组中"""
+    
+    __slots__ = ("user_id", "timeout_duration", "push_rules", "last_checkin_time", "timezone", "version")
+    
+    def __init__(self, user_id: str, timeout_duration: int, push_rules: Tuple[PushRule, ...],
+                 last_checkin_time: Optional[datetime], timezone: str, version: int):
+        self.user_id = user_id
+        self.timeout_duration = timeout_duration
+        self.push_rules = push_rules
+        self.last_checkin_time = last_checkin_time
+        self.timezone = timezone
+        self.version = version  # 最后一次写入时的纳秒时间戳
+
+
+class CompactUserStore:
+    """内存模式下的紧凑用户存储
+    
+    每个用户一个 ``__slots__`` 记录，截止时间和下次检查时间保存在按槽位索引的 ``array('d')`` 中
+    （NaN表示无），相同的推送规则只保存一份。读取时按需构造CheckinUser，调用方修改返回的对象
+    不影响存储，需要通过put写回。支持快照到二进制文件并在启动时恢复。
+    """
+    
+    SNAPSHOT_MAGIC = b"HHZUSERS"
+    SNAPSHOT_VERSION = 2
+    
+    def __init__(self):
+        self._slots: Dict[str, int] = {}
+        self._records: List[Optional[_UserRecord]] = []
+        self._deadlines = array("d")
+        self._next_alerts = array("d")
+        self._free: List[int] = []
+        self._interned_rules: Dict[tuple, Tuple[PushRule, ...]] = {}
+        self._timezones: Dict[str, str] = {}
+        # 按user_id排序的索引，用于分页；删除的用户暂时保留在索引中（计入_stale_ids），
+        # 新增的用户先放入_unsorted_ids，分页时再合并
+        self._sorted_ids: List[str] = []
+        self._unsorted_ids: Set[str] = set()
+        self._stale_ids = 0
+    
+    def __len__(self) -> int:
+        return len(self._slots)
+    
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._slots
+    
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._slots)
+    
+    def _index_id(self, user_id: str):
+        """新增用户时登记到排序索引"""
+        index = bisect.bisect_left(self._sorted_ids, user_id)
+        if index < len(self._sorted_ids) and self._sorted_ids[index] == user_id:
+            # 删除后重新添加，索引中的旧条目重新有效
+            self._stale_ids -= 1
+        else:
+            self._unsorted_ids.add(user_id)
+    
+    def _unindex_id(self, user_id: str):
+        if user_id in self._unsorted_ids:
+            self._unsorted_ids.discard(user_id)
+        else:
+            self._stale_ids += 1
+    
+    def iter_sorted_ids(self, after_user_id: str = "") -> Iterator[str]:
+        """按user_id升序遍历大于after_user_id的用户，二分定位起点
+        
+        新增的用户在这里合并进索引（已排序部分加少量新条目，排序接近线性）；
+        已删除的条目超过四分之一时重建索引。合并总是生成新列表，遍历期间的写入不影响本次遍历。
+        """
+        ids = self._sorted_ids
+        if self._stale_ids > len(ids) // 4:
+            ids = [user_id for user_id in ids if user_id in self._slots]
+            self._stale_ids = 0
+        if self._unsorted_ids:
+            ids = ids + list(self._unsorted_ids)
+            ids.sort()
+            self._unsorted_ids = set()
+        self._sorted_ids = ids
+        
+        slots = self._slots
+        for index in range(bisect.bisect_right(ids, after_user_id), len(ids)):
+            user_id = ids[index]
+            if user_id in slots:
+                yield user_id
+    
+    def _intern_rules(self, push_rules: List[PushRule]) -> Tuple[PushRule, ...]:
+        """共用同一组推送规则的用户引用同一个元组"""
+        key = tuple(
+            (rule.id, rule.type, rule.enabled, tuple(sorted(rule.config.items())))
+            for rule in push_rules
+        )
+        rules = self._interned_rules.get(key)
+        if rules is None:
+            rules = tuple(rule.clone() for rule in push_rules)
+            self._interned_rules[key] = rules
+        return rules
+    
+    def _intern_timezone(self, timezone: str) -> str:
+        return self._timezones.setdefault(timezone, timezone)
+    
+    @staticmethod
+    def _to_user(record: _UserRecord) -> CheckinUser:
+        """构造新的用户对象，推送规则也复制一份，避免调用方修改共享的规则"""
+        return CheckinUser.model_construct(
+            user_id=record.user_id,
+            timeout_duration=record.timeout_duration,
+            push_rules=[rule.clone() for rule in record.push_rules],
+            last_checkin_time=record.last_checkin_time,
+            timezone=record.timezone
+        )
+    
+    @staticmethod
+    def _from_nan(value: float) -> Optional[float]:
+        return None if math.isnan(value) else value
+    
+    def get(self, user_id: str) -> Optional[CheckinUser]:
+        """获取用户，不存在时返回None"""
+        slot = self._slots.get(user_id)
+        if slot is None:
+            return None
+        return self._to_user(self._records[slot])
+    
+    def put(self, user: CheckinUser) -> bool:
+        """保存用户；新用户或截止时间变化时把下次检查时间重置为截止时间并返回True
+        
+        截止时间不变但推送规则变化，或此前没有下次检查时间时，也把下次检查时间重置为截止时间，
+        但返回False（保留告警状态）。
+        """
+        deadline_at = user.deadline_at
+        record = _UserRecord(
+            user.user_id,
+            user.timeout_duration,
+            self._intern_rules(user.push_rules),
+            user.last_checkin_time,
+            self._intern_timezone(user.timezone),
+            time.time_ns()
+        )
+        
+        slot = self._slots.get(user.user_id)
+        if slot is not None:
+            previous, self._records[slot] = self._records[slot], record
+            if self._from_nan(self._deadlines[slot]) == deadline_at:
+                if previous.push_rules is not record.push_rules or math.isnan(self._next_alerts[slot]):
+                    self._next_alerts[slot] = self._deadlines[slot]
+                return False
+        elif self._free:
+            slot = self._free.pop()
+            self._records[slot] = record
+            self._slots[user.user_id] = slot
+            self._index_id(user.user_id)
+        else:
+            slot = len(self._records)
+            self._records.append(record)
+            self._deadlines.append(_NAN)
+            self._next_alerts.append(_NAN)
+            self._slots[user.user_id] = slot
+            self._index_id(user.user_id)
+        
+        value = _NAN if deadline_at is None else deadline_at
+        self._deadlines[slot] = value
+        self._next_alerts[slot] = value
+        return True
+    
+    def delete(self, user_id: str) -> bool:
+        """删除用户，槽位留给之后新增的用户复用"""
+        slot = self._slots.pop(user_id, None)
+        if slot is None:
+            return False
+        self._unindex_id(user_id)
+        self._records[slot] = None
+        self._deadlines[slot] = _NAN
+        self._next_alerts[slot] = _NAN
+        self._free.append(slot)
+        return True
+    
+    def record_checkin(self, user_id: str, checkin_time: datetime) -> Optional[float]:
+        """只更新打卡时间和截止时间，返回新的截止时间；用户不存在时返回None"""
+        slot = self._slots.get(user_id)
+        if slot is None:
+            return None
+        record = self._records[slot]
+        record.last_checkin_time = checkin_time
+        record.version = time.time_ns()
+        deadline_at = checkin_time.timestamp() + record.timeout_duration * 3600
+        self._deadlines[slot] = deadline_at
+        self._next_alerts[slot] = deadline_at
+        return deadline_at
+    
+    def get_row(self, user_id: str) -> Optional[dict]:
+        """以字典返回用户的各字段，不构造CheckinUser；push_rules为共享的元组，调用方不可修改"""
+        slot = self._slots.get(user_id)
+        if slot is None:
+            return None
+        record = self._records[slot]
+        return {
+            "user_id": record.user_id,
+            "timeout_duration": record.timeout_duration,
+            "push_rules": record.push_rules,
+            "last_checkin_time": record.last_checkin_time.isoformat() if record.last_checkin_time else None,
+            "timezone": record.timezone,
+            "deadline_at": self._from_nan(self._deadlines[slot]),
+            "next_alert_at": self._from_nan(self._next_alerts[slot]),
+        }
+    
+    def get_version(self, user_id: str) -> Optional[int]:
+        slot = self._slots.get(user_id)
+        return None if slot is None else self._records[slot].version
+    
+    def get_deadline(self, user_id: str) -> Optional[float]:
+        slot = self._slots.get(user_id)
+        return None if slot is None else self._from_nan(self._deadlines[slot])
+    
+    def get_next_alert(self, user_id: str) -> Optional[float]:
+        slot = self._slots.get(user_id)
+        return None if slot is None else self._from_nan(self._next_alerts[slot])
+    
+    def set_next_alert(self, user_id: str, next_alert_at: Optional[float]):
+        slot = self._slots[user_id]
+        self._next_alerts[slot] = _NAN if next_alert_at is None else next_alert_at
+    
+    def iter_next_alerts(self) -> Iterator[Tuple[str, float]]:
+        """遍历有下次检查时间的用户，不复制也不构造用户对象"""
+        next_alerts = self._next_alerts
+        for user_id, slot in self._slots.items():
+            value = next_alerts[slot]
+            if value == value:  # 跳过NaN
+                yield user_id, value
+    
+    def snapshot(self, path: str, extra: Optional[dict] = None):
+        """将全部用户写入二进制快照文件"""
+        self.write_snapshot(path, self.capture(extra))
+    
+    def capture(self, extra: Optional[dict] = None) -> dict:
+        """复制快照需要的数据，不做编码和IO
+        
+        在事件循环中调用，之后存储继续修改也不影响复制出的数据；编码和写文件交给write_snapshot在其他线程完成。
+        extra需可JSON序列化，调用方负责传入副本。
+        """
+        records = [record for record in self._records if record is not None]
+        slots = [self._slots[record.user_id] for record in records]
+        rule_table: Dict[int, int] = {}
+        rules: List[List[dict]] = []
+        rule_refs = array("I")
+        for record in records:
+            index = rule_table.get(id(record.push_rules))
+            if index is None:
+                index = rule_table[id(record.push_rules)] = len(rules)
+                rules.append([rule.model_dump() for rule in record.push_rules])
+            rule_refs.append(index)
+        
+        return {
+            "user_ids": [record.user_id for record in records],
+            "rules": rules,
+            "last_checkin_times": [record.last_checkin_time for record in records],
+            "timezones": [record.timezone for record in records],
+            "extra": extra or {},
+            "timeouts": array("i", (record.timeout_duration for record in records)),
+            "rule_refs": rule_refs,
+            "deadlines": array("d", (self._deadlines[slot] for slot in slots)),
+            "next_alerts": array("d", (self._next_alerts[slot] for slot in slots)),
+            "versions": array("q", (record.version for record in records)),
+        }
+    
+    @classmethod
+    def write_snapshot(cls, path: str, captured: dict):
+        """把capture复制出的数据写入快照文件，先写临时文件再替换，中途失败不会损坏旧快照
+        
+        数值列以数组原始字节保存，其余字段和extra保存为一段JSON。可在事件循环之外的线程中调用。
+        """
+        meta = {
+            "user_ids": captured["user_ids"],
+            "rules": captured["rules"],
+            "last_checkin_times": [
+                last_checkin_time.isoformat() if last_checkin_time else None
+                for last_checkin_time in captured["last_checkin_times"]
+            ],
+            "timezones": captured["timezones"],
+            "extra": captured["extra"],
+        }
+        sections = [
+            "".join(_iter_json(meta)).encode("utf-8"),
+            captured["timeouts"].tobytes(),
+            captured["rule_refs"].tobytes(),
+            captured["deadlines"].tobytes(),
+            captured["next_alerts"].tobytes(),
+            captured["versions"].tobytes(),
+        ]
+        
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".snapshot-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(cls.SNAPSHOT_MAGIC)
+                f.write(struct.pack("<I", cls.SNAPSHOT_VERSION))
+                for section in sections:
+                    f.write(struct.pack("<Q", len(section)))
+                    f.write(section)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+    
+    def restore(self, path: str) -> dict:
+        """从快照文件恢复全部用户，返回快照中保存的附加数据"""
+        with open(path, "rb") as f:
+            data = f.read()
+        
+        magic_size = len(self.SNAPSHOT_MAGIC)
+        if data[:magic_size] != self.SNAPSHOT_MAGIC:
+            raise ValueError("不是有效的用户快照文件")
+        version, = struct.unpack_from("<I", data, magic_size)
+        if version not in (1, self.SNAPSHOT_VERSION):
+            raise ValueError(f"不支持的快照版本: {version}")
+        
+        sections = []
+        offset = magic_size + 4
+        while offset < len(data):
+            size, = struct.unpack_from("<Q", data, offset)
+            offset += 8
+            sections.append(data[offset:offset + size])
+            offset += size
+        
+        meta = json.loads(sections[0])
+        timeout_durations = array("i")
+        timeout_durations.frombytes(sections[1])
+        rule_refs = array("I")
+        rule_refs.frombytes(sections[2])
+        deadlines = array("d")
+        deadlines.frombytes(sections[3])
+        next_alerts = array("d")
+        next_alerts.frombytes(sections[4])
+        # 版本1的快照没有数据版本列
+        versions = array("q", bytes(8 * len(deadlines)) if version == 1 else sections[5])
+        
+        self.__init__()
+        rules = [self._intern_rules([PushRule(**rule) for rule in rule_list]) for rule_list in meta["rules"]]
+        self._deadlines = deadlines
+        self._next_alerts = next_alerts
+        for slot, user_id in enumerate(meta["user_ids"]):
+            last_checkin_time = meta["last_checkin_times"][slot]
+            self._records.append(_UserRecord(
+                user_id,
+                timeout_durations[slot],
+                rules[rule_refs[slot]],
+                datetime.fromisoformat(last_checkin_time) if last_checkin_time else None,
+                self._intern_timezone(meta["timezones"][slot]),
+                versions[slot]
+            ))
+            self._slots[user_id] = slot
+        self._sorted_ids = sorted(self._slots)
+        return meta["extra"]
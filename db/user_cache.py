@@ -0,0 +1,103 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Generic, Hashable, Optional, TypeVar
+
+
+V = TypeVar("V")
+
+
+class LRUCache(Generic[V]):
+    """线程安全的LRU缓存，支持条目过期时间
+    
+    每次失效都会递增版本号并记录该键的失效版本；读穿透时先取版本号，
+    写入缓存前若该键在此之后被失效则放弃写入，避免并发写入期间把旧数据放回缓存。
+    """
+    
+    def __init__(self, maxsize: int = 10000, ttl: float = 30.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = 0
+        self._invalidated: Dict[Hashable, int] = {}
+        self._floor = 0  # 早于此版本的读穿透结果一律丢弃
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0
+    
+    def version(self) -> int:
+        """当前版本号，读穿透前获取"""
+        return self._version
+    
+    def get(self, key: Hashable) -> Optional[V]:
+        """获取缓存值，未命中或已过期时返回None"""
+        if not self.enabled:
+            return None
+        
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+            
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+    
+    def put(self, key: Hashable, value: V, version: int):
+        """写入缓存；该键在version之后被失效过时放弃"""
+        if not self.enabled:
+            return
+        
+        with self._lock:
+            if version < self._floor or self._invalidated.get(key, -1) > version:
+                return
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+    
+    def invalidate(self, key: Hashable):
+        """移除单个条目"""
+        with self._lock:
+            self._version += 1
+            self._data.pop(key, None)
+            self._invalidated[key] = self._version
+            if len(self._invalidated) > max(self.maxsize, 1024):
+                # 失效记录过多时整体提高下限，代价是短时间内的读穿透不写入缓存
+                self._invalidated.clear()
+                self._floor = self._version + 1
+    
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._version += 1
+            self._data.clear()
+            self._invalidated.clear()
+            self._floor = self._version + 1
+    
+    def stats(self) -> Dict[str, float]:
+        """命中统计"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
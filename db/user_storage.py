@@ -1,20 +1,90 @@
+import asyncio
+import bisect
 import json
+import logging
+import math
 import sqlite3
-from typing import Dict, Optional
+import struct
+import time
+import zlib
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 from models.user import CheckinUser
+from models.notification_state import NotificationState
+from models.checkin import CheckinResult
+from models.checkin_stats import CheckinStats
+from models.outbox import OutboxEntry
+from db.memory_store import CompactUserStore
+from db.user_cache import LRUCache
 from datetime import datetime
 import os
 import tempfile
+import threading
+
+
+logger = logging.getLogger(__name__)
 
 
 class UserStorage:
     """用户数据存储 - 支持Vercel环境版（支持内存和文件存储）"""
     
+    USER_COLUMNS = "user_id, timeout_duration, push_rules, last_checkin_time, timezone"
+    # 用户列表接口可以选择的字段
+    LIST_FIELDS = (
+        "user_id", "timeout_duration", "push_rules", "last_checkin_time", "timezone", "deadline_at", "next_alert_at"
+    )
+    CHECKIN_STATS_COLUMNS = (
+        "user_id, checkin_count, first_checkin_at, last_checkin_at, interval_sum, interval_count, "
+        "max_interval, current_streak, longest_streak, overdue_count"
+    )
+    OUTBOX_COLUMNS = (
+        "id, user_id, rule_id, rule_type, config, user, status, attempts, next_attempt_at, last_error, created_at, "
+        "deadline_at"
+    )
+    
+    # 每个连接的SQLite调优参数
+    CONNECTION_PRAGMAS = (
+        "PRAGMA journal_mode=WAL",  # 读写互不阻塞
+        "PRAGMA synchronous=NORMAL",  # WAL模式下仍可保证崩溃一致性
+        "PRAGMA cache_size=-16000",  # 约16MB页缓存
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA busy_timeout=5000",
+    )
+    
+    # 超时检查的哈希分片数，多个工作进程通过租约分摊分片
+    SHARD_COUNT = 64
+    
     def __init__(self, db_path: str = None):
+        # 已解析用户对象及其数据版本的读缓存，USER_CACHE_SIZE=0时关闭
+        self.cache: LRUCache[Tuple[CheckinUser, int]] = LRUCache(
+            maxsize=int(os.environ.get("USER_CACHE_SIZE", "10000")),
+            ttl=float(os.environ.get("USER_CACHE_TTL", "30"))
+        )
+        
         # 检测是否在Vercel等无服务器环境中强制使用内存存储
         if os.environ.get("USE_MEMORY_DB", "").lower() == "true":
             self.use_memory = True
-            self.users = {}  # 使用字典作为内存存储
+            self.cache.maxsize = 0  # 内存模式本身保存的就是用户对象，无需缓存
+            self.users = CompactUserStore()  # 紧凑的内存存储，同时保存截止时间和下次检查时间
+            self.notification_states: Dict[str, Dict[str, NotificationState]] = {}
+            self.shard_leases: Dict[int, Tuple[str, float]] = {}  # 分片 -> (持有者, 到期时间)
+            self.shard_workers: Dict[str, float] = {}  # 工作进程 -> 心跳到期时间
+            self.outbox: Dict[int, OutboxEntry] = {}  # 待投递的告警通知
+            self._outbox_seq = 0
+            self.cursors: Dict[str, str] = {}  # 分批检查的进度游标
+            # 累计打卡统计只整体替换、不原地修改，快照时浅拷贝字典即可得到一致的副本
+            self.checkin_stats: Dict[str, CheckinStats] = {}
+            # 按时间排序的(打卡时间, 是否超时)；列表只在末尾原地追加，乱序插入和清理时换成新列表，
+            # 因此快照记下的长度之前的部分不会再变化
+            self.checkin_events: Dict[str, List[Tuple[float, bool]]] = {}
+            
+            # 设置MEMORY_SNAPSHOT_PATH时定期把内存数据快照到文件，重启后从快照恢复
+            self.snapshot_path = os.environ.get("MEMORY_SNAPSHOT_PATH") or None
+            self.snapshot_interval = float(os.environ.get("MEMORY_SNAPSHOT_INTERVAL", "30"))
+            self._snapshot_dirty = False
+            self._snapshot_at = time.monotonic()
+            self._snapshot_task: Optional[asyncio.Task] = None
+            if self.snapshot_path and os.path.exists(self.snapshot_path):
+                self.restore_snapshot()
         else:
             self.use_memory = False
             if db_path is None:
@@ -27,6 +97,12 @@ class UserStorage:
             else:
                 self.db_path = db_path
             
+            # 每个线程持有一个长连接，避免每次操作都重新建立连接
+            self._local = threading.local()
+            self._connections = []
+            self._connections_lock = threading.Lock()
+            self._generation = 0
+            
             self.init_db()
     
     def init_db(self):
@@ -39,7 +115,7 @@ class UserStorage:
         if db_dir:
             os.makedirs(db_dir, exist_ok=True)
         
-        conn = sqlite3.connect(self.db_path)
+        conn = self._get_connection()
         cursor = conn.cursor()
         
         # 创建用户表
@@ -49,33 +125,392 @@ class UserStorage:
                 timeout_duration INTEGER NOT NULL,
                 push_rules TEXT NOT NULL,
                 last_checkin_time TEXT,
-                timezone TEXT DEFAULT 'Asia/Shanghai'
+                timezone TEXT DEFAULT 'Asia/Shanghai',
+                deadline_at REAL,
+                next_alert_at REAL,
+                last_notified_at REAL,
+                notify_stage INTEGER NOT NULL DEFAULT 0,
+                shard INTEGER,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        
+        self._migrate_deadline_column(cursor)
+        self._migrate_notification_columns(cursor)
+        self._migrate_shard_column(cursor)
+        self._migrate_version_column(cursor)
+        
+        # 超时截止时间索引，超时检查只需范围扫描
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_users_deadline_at ON users (deadline_at)"
+        )
+        # 下次检查时间索引（截止时间或告警冷却结束时间）
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_users_next_alert_at ON users (next_alert_at)"
+        )
+        # 按分片查询到期用户
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_users_shard_next_alert_at ON users (shard, next_alert_at)"
+        )
+        
+        # 每条推送规则的告警状态
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS notification_state (
+                user_id TEXT NOT NULL,
+                rule_id TEXT NOT NULL,
+                stage INTEGER NOT NULL DEFAULT 0,
+                last_notified_at REAL,
+                next_notify_at REAL,
+                deadline_at REAL,
+                PRIMARY KEY (user_id, rule_id)
+            )
+        ''')
+        self._migrate_notification_state_deadline(cursor)
+        
+        # 告警发件箱，推送失败后按退避时间重试，超过次数后标记为dead
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                rule_id TEXT NOT NULL,
+                rule_type TEXT NOT NULL,
+                config TEXT NOT NULL,
+                user TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                deadline_at REAL
+            )
+        ''')
+        self._migrate_outbox_deadline_column(cursor)
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_outbox_status_next_attempt_at ON outbox (status, next_attempt_at)"
+        )
+        
+        # 分批超时检查的进度游标，供无服务器环境的定时调用接续处理
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS check_cursors (
+                name TEXT PRIMARY KEY,
+                cursor TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        
+        # 分片租约和工作进程心跳，多个进程共享同一数据库时协调超时检查
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS shard_leases (
+                shard INTEGER PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
             )
         ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS shard_workers (
+                worker_id TEXT PRIMARY KEY,
+                expires_at REAL NOT NULL
+            )
+        ''')
+        
+        # 只追加的打卡历史，超过保留期的记录定期清理；累计统计单独保存，不受清理影响。两者都由下面的触发器写入
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS checkin_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                checkin_at REAL NOT NULL,
+                deadline_at REAL,
+                overdue INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        # 按用户和时间范围统计打卡次数
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_checkin_events_user_checkin_at ON checkin_events (user_id, checkin_at)"
+        )
+        # 清理过期历史
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_checkin_events_checkin_at ON checkin_events (checkin_at)"
+        )
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS checkin_stats (
+                user_id TEXT PRIMARY KEY,
+                checkin_count INTEGER NOT NULL DEFAULT 0,
+                first_checkin_at REAL,
+                last_checkin_at REAL,
+                interval_sum REAL NOT NULL DEFAULT 0,
+                interval_count INTEGER NOT NULL DEFAULT 0,
+                max_interval REAL,
+                current_streak INTEGER NOT NULL DEFAULT 0,
+                longest_streak INTEGER NOT NULL DEFAULT 0,
+                overdue_count INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        # 打卡时间变化时追加打卡历史并增量更新累计统计，与打卡的UPDATE在同一语句中完成，打卡路径无需额外查询；
+        # 规则与CheckinStats.record一致：打卡晚于打卡前的截止时间即为超时，早于上次打卡的乱序打卡只计入次数和超时
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_users_checkin_history
+            AFTER UPDATE OF last_checkin_time ON users
+            WHEN NEW.last_checkin_time IS NOT OLD.last_checkin_time AND NEW.deadline_at IS NOT NULL
+            BEGIN
+                INSERT INTO checkin_events (user_id, checkin_at, deadline_at, overdue)
+                VALUES (
+                    NEW.user_id,
+                    NEW.deadline_at - NEW.timeout_duration * 3600,
+                    OLD.deadline_at,
+                    COALESCE(NEW.deadline_at - NEW.timeout_duration * 3600 > OLD.deadline_at, 0)
+                );
+                INSERT INTO checkin_stats (
+                    user_id, checkin_count, first_checkin_at, last_checkin_at, interval_sum, interval_count,
+                    max_interval, current_streak, longest_streak, overdue_count
+                )
+                SELECT user_id, 1, checkin_at, checkin_at, 0, 0, NULL, 1 - overdue, 1 - overdue, overdue
+                FROM checkin_events WHERE id = last_insert_rowid()
+                ON CONFLICT(user_id) DO UPDATE SET
+                    checkin_count = checkin_count + 1,
+                    overdue_count = overdue_count + excluded.overdue_count,
+                    first_checkin_at = CASE WHEN first_checkin_at IS NULL OR excluded.last_checkin_at < first_checkin_at
+                        THEN excluded.last_checkin_at ELSE first_checkin_at END,
+                    interval_sum = interval_sum + CASE WHEN excluded.last_checkin_at >= last_checkin_at
+                        THEN excluded.last_checkin_at - last_checkin_at ELSE 0 END,
+                    interval_count = interval_count + COALESCE(excluded.last_checkin_at >= last_checkin_at, 0),
+                    max_interval = CASE WHEN excluded.last_checkin_at >= last_checkin_at
+                        AND (max_interval IS NULL OR excluded.last_checkin_at - last_checkin_at > max_interval)
+                        THEN excluded.last_checkin_at - last_checkin_at ELSE max_interval END,
+                    current_streak = CASE
+                        WHEN excluded.last_checkin_at < last_checkin_at THEN current_streak
+                        WHEN excluded.overdue_count THEN 0
+                        ELSE current_streak + 1 END,
+                    longest_streak = MAX(longest_streak, CASE
+                        WHEN excluded.last_checkin_at < last_checkin_at OR excluded.overdue_count THEN 0
+                        ELSE current_streak + 1 END),
+                    last_checkin_at = CASE WHEN last_checkin_at IS NULL OR excluded.last_checkin_at >= last_checkin_at
+                        THEN excluded.last_checkin_at ELSE last_checkin_at END;
+            END
+        ''')
         
         conn.commit()
-        conn.close()
     
-    def get_user(self, user_id: str) -> Optional[CheckinUser]:
-        """获取用户"""
+    def _get_connection(self) -> sqlite3.Connection:
+        """获取当前线程的长连接，首次使用时创建并设置PRAGMA"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.generation == self._generation:
+            return conn
+        
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=5.0,
+            check_same_thread=False,
+            cached_statements=256  # 复用预编译语句
+        )
+        for pragma in self.CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        
+        with self._connections_lock:
+            self._connections.append(conn)
+        self._local.conn = conn
+        self._local.generation = self._generation
+        return conn
+    
+    def close(self):
+        """关闭所有线程的数据库连接；内存模式下写入最后一次快照"""
         if self.use_memory:
-            return self.users.get(user_id)
+            if self._snapshot_dirty:
+                self.save_snapshot()
+            return
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+            self._generation += 1
+        
+        for conn in connections:
+            try:
+                # 关闭前让SQLite按需更新查询规划统计信息
+                conn.execute("PRAGMA optimize")
+                conn.close()
+            except sqlite3.Error:
+                pass
+    
+    def _capture_snapshot(self) -> dict:
+        """复制内存模式的全部数据供写入快照，复制之后的修改会在下一次快照中保存"""
+        self._snapshot_dirty = False
+        return self.users.capture(extra={
+            "notification_states": {
+                user_id: [state.model_dump() for state in states.values()]
+                for user_id, states in self.notification_states.items()
+            },
+            "outbox": [entry.model_dump(mode="json") for entry in self.outbox.values()],
+            "outbox_seq": self._outbox_seq,
+            "cursors": dict(self.cursors),
+            "checkin_stats": list(self.checkin_stats.values()),
+            # 只记录每个列表当前的长度，切片留给写入线程
+            "checkin_events": [(user_id, events, len(events)) for user_id, events in self.checkin_events.items()],
+        })
+    
+    @staticmethod
+    def _write_snapshot(path: str, captured: dict):
+        """序列化复制出的打卡统计和历史并写入快照文件，可在事件循环之外的线程中调用"""
+        extra = captured["extra"]
+        extra["checkin_stats"] = [stats.model_dump() for stats in extra["checkin_stats"]]
+        extra["checkin_events"] = {user_id: events[:length] for user_id, events, length in extra["checkin_events"]}
+        CompactUserStore.write_snapshot(path, captured)
+    
+    def save_snapshot(self):
+        """把内存模式的全部数据写入快照文件（同步，用于关闭时和没有事件循环的场景）"""
+        if not self.snapshot_path:
+            return
+        self._write_snapshot(self.snapshot_path, self._capture_snapshot())
+        self._snapshot_at = time.monotonic()
+    
+    async def _save_snapshot_in_background(self):
+        """在事件循环中复制数据，编码和写文件在线程中完成，不阻塞其他请求"""
+        try:
+            captured = self._capture_snapshot()
+            await asyncio.to_thread(self._write_snapshot, self.snapshot_path, captured)
+        except OSError as e:
+            self._snapshot_dirty = True
+            logger.warning(f"写入内存快照 {self.snapshot_path} 失败: {str(e)}")
+        finally:
+            self._snapshot_at = time.monotonic()
+            self._snapshot_task = None
+    
+    async def wait_snapshot(self):
+        """等待正在后台写入的快照完成"""
+        if self.use_memory and self._snapshot_task is not None:
+            await asyncio.shield(self._snapshot_task)
+    
+    def restore_snapshot(self):
+        """从快照文件恢复内存模式的数据，快照损坏时从空数据开始"""
+        try:
+            extra = self.users.restore(self.snapshot_path)
+        except (OSError, ValueError, IndexError, KeyError, struct.error) as e:
+            logger.warning(f"读取内存快照 {self.snapshot_path} 失败，从空数据开始: {str(e)}")
+            self.users = CompactUserStore()
+            return
         
+        self.notification_states = {
+            user_id: {state["rule_id"]: NotificationState(**state) for state in states}
+            for user_id, states in extra.get("notification_states", {}).items()
+        }
+        self.outbox = {entry["id"]: OutboxEntry(**entry) for entry in extra.get("outbox", [])}
+        self._outbox_seq = extra.get("outbox_seq", 0)
+        self.cursors = extra.get("cursors", {})
+        self.checkin_stats = {stats["user_id"]: CheckinStats(**stats) for stats in extra.get("checkin_stats", [])}
+        self.checkin_events = {
+            user_id: [(checkin_at, overdue) for checkin_at, overdue in events]
+            for user_id, events in extra.get("checkin_events", {}).items()
+        }
+        self._snapshot_at = time.monotonic()
+        logger.info(f"已从内存快照恢复 {len(self.users)} 个用户")
+    
+    def _memory_changed(self):
+        """内存模式写入后调用，距上次快照超过snapshot_interval时安排写入新快照
+        
+        在事件循环中调用时创建后台任务写入，触发快照的请求无需等待；没有事件循环时直接写入。
+        """
+        self._snapshot_dirty = True
+        if not self.snapshot_path or self._snapshot_task is not None:
+            return
+        if time.monotonic() - self._snapshot_at < self.snapshot_interval:
+            return
+        
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is not None:
+            self._snapshot_task = loop.create_task(self._save_snapshot_in_background())
+            return
+        
+        try:
+            self.save_snapshot()
+        except OSError as e:
+            logger.warning(f"写入内存快照 {self.snapshot_path} 失败: {str(e)}")
+            self._snapshot_at = time.monotonic()
+    
+    def _migrate_deadline_column(self, cursor: sqlite3.Cursor):
+        """为旧数据库补充deadline_at列并回填已有用户的截止时间"""
+        cursor.execute("PRAGMA table_info(users)")
+        columns = {row[1] for row in cursor.fetchall()}
+        if "deadline_at" in columns:
+            return
+        
+        cursor.execute("ALTER TABLE users ADD COLUMN deadline_at REAL")
         cursor.execute(
-            "SELECT user_id, timeout_duration, push_rules, last_checkin_time, timezone FROM users WHERE user_id = ?",
-            (user_id,)
+            "SELECT user_id, timeout_duration, last_checkin_time FROM users WHERE last_checkin_time IS NOT NULL"
         )
-        row = cursor.fetchone()
+        updates = [
+            (self._compute_deadline(last_checkin_time_str, timeout_duration), user_id)
+            for user_id, timeout_duration, last_checkin_time_str in cursor.fetchall()
+        ]
+        cursor.executemany("UPDATE users SET deadline_at = ? WHERE user_id = ?", updates)
+    
+    def _migrate_notification_columns(self, cursor: sqlite3.Cursor):
+        """为旧数据库补充告警状态列，下次检查时间初始化为截止时间"""
+        cursor.execute("PRAGMA table_info(users)")
+        columns = {row[1] for row in cursor.fetchall()}
+        if "next_alert_at" in columns:
+            return
         
-        conn.close()
+        cursor.execute("ALTER TABLE users ADD COLUMN next_alert_at REAL")
+        cursor.execute("ALTER TABLE users ADD COLUMN last_notified_at REAL")
+        cursor.execute("ALTER TABLE users ADD COLUMN notify_stage INTEGER NOT NULL DEFAULT 0")
+        cursor.execute("UPDATE users SET next_alert_at = deadline_at")
+    
+    def _migrate_notification_state_deadline(self, cursor: sqlite3.Cursor):
+        """为告警状态补充所属截止时间；截止时间与用户当前不一致的状态视为已失效"""
+        cursor.execute("PRAGMA table_info(notification_state)")
+        columns = {row[1] for row in cursor.fetchall()}
+        if "deadline_at" in columns:
+            return
         
-        if row is None:
-            return None
+        cursor.execute("ALTER TABLE notification_state ADD COLUMN deadline_at REAL")
+        cursor.execute('''
+            UPDATE notification_state SET deadline_at = (
+                SELECT deadline_at FROM users WHERE users.user_id = notification_state.user_id
+            )
+        ''')
+    
+    def _migrate_outbox_deadline_column(self, cursor: sqlite3.Cursor):
+        """为发件箱补充告警所属的截止时间；旧告警没有截止时间，照常投递"""
+        cursor.execute("PRAGMA table_info(outbox)")
+        columns = {row[1] for row in cursor.fetchall()}
+        if "deadline_at" not in columns:
+            cursor.execute("ALTER TABLE outbox ADD COLUMN deadline_at REAL")
+    
+    def _migrate_shard_column(self, cursor: sqlite3.Cursor):
+        """为旧数据库补充分片列并回填"""
+        cursor.execute("PRAGMA table_info(users)")
+        columns = {row[1] for row in cursor.fetchall()}
+        if "shard" in columns:
+            return
         
-        # 反序列化数据
+        cursor.execute("ALTER TABLE users ADD COLUMN shard INTEGER")
+        cursor.execute("SELECT user_id FROM users")
+        updates = [(self.shard_of(user_id), user_id) for user_id, in cursor.fetchall()]
+        cursor.executemany("UPDATE users SET shard = ? WHERE user_id = ?", updates)
+    
+    def _migrate_version_column(self, cursor: sqlite3.Cursor):
+        """为旧数据库补充用户数据版本列"""
+        cursor.execute("PRAGMA table_info(users)")
+        columns = {row[1] for row in cursor.fetchall()}
+        if "version" not in columns:
+            cursor.execute("ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    
+    @classmethod
+    def shard_of(cls, user_id: str) -> int:
+        """用户所属分片，各进程计算结果一致"""
+        return zlib.crc32(user_id.encode("utf-8")) % cls.SHARD_COUNT
+    
+    @staticmethod
+    def _compute_deadline(last_checkin_time_str: Optional[str], timeout_duration: int) -> Optional[float]:
+        """根据打卡时间字符串计算截止时间（epoch秒）"""
+        if not last_checkin_time_str:
+            return None
+        return datetime.fromisoformat(last_checkin_time_str).timestamp() + timeout_duration * 3600
+    
+    @staticmethod
+    def _row_to_user(row: Tuple) -> CheckinUser:
+        """将数据库行反序列化为用户对象"""
         user_id, timeout_duration, push_rules_str, last_checkin_time_str, timezone = row
         
         # 解析JSON格式的push_rules
@@ -96,89 +531,1019 @@ class UserStorage:
             timezone=timezone
         )
     
+    def get_user(self, user_id: str) -> Optional[CheckinUser]:
+        """获取用户"""
+        if self.use_memory:
+            return self.users.get(user_id)
+        
+        # 返回连同推送规则一起复制的副本，调用方修改字段或规则都不会影响缓存中的对象
+        cached = self.cache.get(user_id)
+        if cached is not None:
+            return cached[0].clone()
+        
+        return self._load_user(user_id)
+    
+    def _load_user(self, user_id: str) -> Optional[CheckinUser]:
+        """缓存未命中时从数据库读取用户并写入缓存"""
+        loaded = self._load_versioned_user(user_id)
+        return loaded[0] if loaded else None
+    
+    def _load_versioned_user(self, user_id: str) -> Optional[Tuple[CheckinUser, int]]:
+        """从数据库读取用户及其数据版本并写入缓存"""
+        cache_version = self.cache.version()
+        conn = self._get_connection()
+        row = conn.execute(
+            f"SELECT {self.USER_COLUMNS}, version FROM users WHERE user_id = ?",
+            (user_id,)
+        ).fetchone()
+        
+        if row is None:
+            return None
+        
+        user = self._row_to_user(row[:-1])
+        self.cache.put(user_id, (user, row[-1]), cache_version)
+        return user.clone(), row[-1]
+    
+    def get_user_at_version(self, user_id: str, version: int) -> Optional[Tuple[CheckinUser, int]]:
+        """获取与version一致的用户及其版本，用户不存在时返回None
+        
+        缓存只在本进程写入时失效，其他进程写入后缓存中的用户可能比version旧；
+        版本不一致时从数据库重新读取，返回的版本与用户数据来自同一行，可直接用作ETag。
+        """
+        if self.use_memory:
+            user = self.users.get(user_id)
+            return (user, self.users.get_version(user_id)) if user else None
+        
+        cached = self.cache.get(user_id)
+        if cached is not None and cached[1] == version:
+            return cached[0].clone(), version
+        return self._load_versioned_user(user_id)
+    
+    def get_user_version(self, user_id: str) -> Optional[int]:
+        """获取用户数据的版本（最后一次写入时的纳秒时间戳），用户不存在时返回None
+        
+        只读取版本列，不解析推送规则，用于条件请求判断数据是否变化。
+        """
+        if self.use_memory:
+            return self.users.get_version(user_id)
+        
+        conn = self._get_connection()
+        row = conn.execute("SELECT version FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+    
+    def get_users(self, user_ids: List[str]) -> Dict[str, CheckinUser]:
+        """批量获取用户，缺失的用户不出现在结果中"""
+        if self.use_memory:
+            users = {}
+            for user_id in user_ids:
+                user = self.users.get(user_id)
+                if user is not None:
+                    users[user_id] = user
+            return users
+        
+        users = {}
+        missing = []
+        for user_id in user_ids:
+            cached = self.cache.get(user_id)
+            if cached is not None:
+                users[user_id] = cached[0].clone()
+            else:
+                missing.append(user_id)
+        
+        version = self.cache.version()
+        conn = self._get_connection()
+        for start in range(0, len(missing), 500):
+            chunk = missing[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT {self.USER_COLUMNS}, version FROM users WHERE user_id IN ({placeholders})",
+                chunk
+            ).fetchall()
+            for row in rows:
+                user = self._row_to_user(row[:-1])
+                self.cache.put(user.user_id, (user, row[-1]), version)
+                users[user.user_id] = user.clone()
+        
+        return users
+    
     def save_user(self, user: CheckinUser):
         """保存用户"""
         if self.use_memory:
-            self.users[user.user_id] = user
+            self._save_memory_user(user)
+            self._memory_changed()
             return
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # 序列化数据
-        push_rules_str = json.dumps([rule.dict() for rule in user.push_rules])
+        conn = self._get_connection()
+        with conn:
+            self._write_users(conn, [user])
+        self.cache.invalidate(user.user_id)
+    
+    def _save_memory_user(self, user: CheckinUser):
+        """内存模式下保存用户；已有用户的打卡时间变化时与SQLite的触发器一样记入打卡历史"""
+        previous = self.users.get_row(user.user_id)
+        previous_deadline = self.users.get_deadline(user.user_id)
+        if (previous is not None and user.last_checkin_time is not None
+                and previous["last_checkin_time"] != user.last_checkin_time.isoformat()):
+            self._record_memory_history(user.user_id, user.last_checkin_time.timestamp(), previous_deadline)
+        if self.users.put(user):
+            # 截止时间变化（打卡或修改超时时长）时重置告警状态
+            self.notification_states.pop(user.user_id, None)
+    
+    @staticmethod
+    def _user_params(user: CheckinUser) -> Tuple:
+        """序列化用户为写入参数"""
+        push_rules_str = json.dumps([rule.model_dump() for rule in user.push_rules])
         last_checkin_time_str = user.last_checkin_time.isoformat() if user.last_checkin_time else None
+        deadline_at = user.deadline_at
         
-        cursor.execute('''
-            INSERT OR REPLACE INTO users 
-            (user_id, timeout_duration, push_rules, last_checkin_time, timezone)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (
+        return (
             user.user_id,
             user.timeout_duration,
             push_rules_str,
             last_checkin_time_str,
-            user.timezone
-        ))
+            user.timezone,
+            deadline_at,
+            deadline_at,
+            UserStorage.shard_of(user.user_id),
+            time.time_ns()
+        )
+    
+    def _write_users(self, conn: sqlite3.Connection, users: List[CheckinUser]):
+        """在调用方的事务中写入一批用户"""
+        params = [self._user_params(user) for user in users]
         
-        conn.commit()
-        conn.close()
+        # 截止时间变化（打卡或修改超时时长）时重置告警状态，否则保留冷却进度；
+        # 推送规则变化或此前因没有可用规则而不再检查时，下次检查时间回到截止时间，使新规则能够告警
+        conn.executemany('''
+            DELETE FROM notification_state WHERE user_id = ? AND NOT EXISTS (
+                SELECT 1 FROM users WHERE user_id = ? AND deadline_at IS ?
+            )
+        ''', [(param[0], param[0], param[5]) for param in params])
+        conn.executemany('''
+            INSERT INTO users
+            (user_id, timeout_duration, push_rules, last_checkin_time, timezone,
+             deadline_at, next_alert_at, last_notified_at, notify_stage, shard, version)
+            VALUES (?, ?, ?, ?, ?, ?, ?, NULL, 0, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                version = excluded.version,
+                timeout_duration = excluded.timeout_duration,
+                push_rules = excluded.push_rules,
+                last_checkin_time = excluded.last_checkin_time,
+                timezone = excluded.timezone,
+                next_alert_at = CASE
+                    WHEN users.deadline_at IS NOT excluded.deadline_at THEN excluded.deadline_at
+                    WHEN users.next_alert_at IS NULL OR users.push_rules IS NOT excluded.push_rules
+                        THEN excluded.deadline_at
+                    ELSE users.next_alert_at END,
+                last_notified_at = CASE WHEN users.deadline_at IS excluded.deadline_at
+                    THEN users.last_notified_at ELSE NULL END,
+                notify_stage = CASE WHEN users.deadline_at IS excluded.deadline_at
+                    THEN users.notify_stage ELSE 0 END,
+                deadline_at = excluded.deadline_at
+        ''', params)
+    
+    def import_users(self, users: Iterable[CheckinUser], chunk_size: int = 1000) -> int:
+        """分块导入用户，每块一个事务，返回导入数量"""
+        if self.use_memory:
+            count = 0
+            for user in users:
+                self._save_memory_user(user)
+                count += 1
+            self._memory_changed()
+            return count
+        
+        conn = self._get_connection()
+        count = 0
+        for chunk in self._chunked(users, chunk_size):
+            with conn:
+                self._write_users(conn, chunk)
+            for user in chunk:
+                self.cache.invalidate(user.user_id)
+            count += len(chunk)
+        return count
+    
+    @staticmethod
+    def _chunked(items: Iterable, size: int) -> Iterator[List]:
+        """将可迭代对象按固定大小分块"""
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+    
+    def iter_users(self, batch_size: int = 1000) -> Iterator[CheckinUser]:
+        """按user_id顺序分批遍历所有用户，内存占用与用户总数无关"""
+        for batch in self._iter_user_rows(batch_size):
+            for row in batch:
+                yield row if self.use_memory else self._row_to_user(row)
+    
+    def iter_users_ndjson(self, batch_size: int = 1000) -> Iterator[str]:
+        """按批导出NDJSON，每批一个字符串；数据库中的push_rules原样输出，无需反序列化"""
+        for batch in self._iter_user_rows(batch_size):
+            if self.use_memory:
+                lines = [user.model_dump_json() for user in batch]
+            else:
+                lines = [self._row_to_json_line(row) for row in batch]
+            yield "\n".join(lines) + "\n"
+    
+    @staticmethod
+    def _row_to_json_line(row: Tuple) -> str:
+        """将数据库行直接拼接为JSON行"""
+        user_id, timeout_duration, push_rules_str, last_checkin_time_str, timezone = row
+        return (
+            f'{{"user_id":{json.dumps(user_id)},"timeout_duration":{timeout_duration},'
+            f'"push_rules":{push_rules_str},"last_checkin_time":{json.dumps(last_checkin_time_str)},'
+            f'"timezone":{json.dumps(timezone)}}}'
+        )
+    
+    def _iter_user_rows(self, batch_size: int) -> Iterator[List]:
+        """按user_id键集分页读取，每批单独查询，不持有长事务"""
+        if self.use_memory:
+            user_ids = sorted(self.users)
+            for start in range(0, len(user_ids), batch_size):
+                batch = [self.users.get(user_id) for user_id in user_ids[start:start + batch_size]]
+                batch = [user for user in batch if user is not None]
+                if batch:
+                    yield batch
+            return
+        
+        last_user_id = ""
+        while True:
+            conn = self._get_connection()
+            rows = conn.execute(
+                f"SELECT {self.USER_COLUMNS} FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                (last_user_id, batch_size)
+            ).fetchall()
+            if not rows:
+                return
+            yield rows
+            last_user_id = rows[-1][0]
     
     def delete_user(self, user_id: str) -> bool:
         """删除用户"""
         if self.use_memory:
-            if user_id in self.users:
-                del self.users[user_id]
+            if self.users.delete(user_id):
+                self.notification_states.pop(user_id, None)
+                self.checkin_stats.pop(user_id, None)
+                self.checkin_events.pop(user_id, None)
+                for entry_id, entry in list(self.outbox.items()):
+                    if entry.user_id == user_id and entry.status == "pending":
+                        del self.outbox[entry_id]
+                self._memory_changed()
                 return True
             return False
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        conn = self._get_connection()
+        with conn:
+            cursor = conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+            affected_rows = cursor.rowcount
+            conn.execute("DELETE FROM notification_state WHERE user_id = ?", (user_id,))
+            # 用户已删除，不再投递尚未发送的告警
+            conn.execute("DELETE FROM outbox WHERE user_id = ? AND status = 'pending'", (user_id,))
+            conn.execute("DELETE FROM checkin_stats WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM checkin_events WHERE user_id = ?", (user_id,))
+        self.cache.invalidate(user_id)
         
-        cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
-        affected_rows = cursor.rowcount
+        return affected_rows > 0
+    
+    def record_checkin(self, user_id: str, checkin_time: datetime) -> Optional[float]:
+        """记录单次打卡，返回新的截止时间；用户不存在时返回None
         
-        conn.commit()
-        conn.close()
+        只执行一条按主键的UPDATE，不读取和序列化push_rules；打卡历史和累计统计由触发器在同一事务中写入。
+        """
+        checkin_ts = checkin_time.timestamp()
+        if self.use_memory:
+            previous_deadline = self.users.get_deadline(user_id)
+            deadline_at = self.users.record_checkin(user_id, checkin_time)
+            if deadline_at is not None:
+                self.notification_states.pop(user_id, None)
+                self._record_memory_history(user_id, checkin_ts, previous_deadline)
+                self._memory_changed()
+            return deadline_at
         
-        return affected_rows > 0
+        conn = self._get_connection()
+        with conn:
+            # 重置告警状态；旧的规则告警状态因截止时间不一致自动失效
+            cursor = conn.execute('''
+                UPDATE users SET
+                    last_checkin_time = ?,
+                    deadline_at = ? + timeout_duration * 3600,
+                    next_alert_at = ? + timeout_duration * 3600,
+                    last_notified_at = NULL,
+                    notify_stage = 0,
+                    version = ?
+                WHERE user_id = ?
+                RETURNING deadline_at
+            ''', (checkin_time.isoformat(), checkin_ts, checkin_ts, time.time_ns(), user_id))
+            row = cursor.fetchone()
+        
+        if cursor.rowcount == 0 or row is None:
+            return None
+        
+        self.cache.invalidate(user_id)
+        return row[0]
+    
+    def record_checkins(self, checkins: List[Tuple[str, datetime]], max_skew: float = 300) -> List[CheckinResult]:
+        """在单个事务中批量记录打卡
+        
+        同一用户只保留最新的打卡时间；早于已记录打卡时间的条目标记为stale，
+        比服务器时间超前max_skew秒以上的条目标记为future。
+        """
+        now = datetime.now().timestamp()
+        latest: Dict[str, datetime] = {}
+        results: Dict[str, CheckinResult] = {}
+        for user_id, checkin_time in checkins:
+            if checkin_time.timestamp() > now + max_skew:
+                results.setdefault(user_id, CheckinResult(user_id=user_id, status="future", checkin_time=checkin_time))
+                continue
+            if user_id not in latest or checkin_time > latest[user_id]:
+                latest[user_id] = checkin_time
+        
+        if self.use_memory:
+            for user_id, checkin_time in latest.items():
+                user = self.users.get(user_id)
+                if user is None:
+                    results[user_id] = CheckinResult(user_id=user_id, status="not_found")
+                elif user.last_checkin_time and user.last_checkin_time.timestamp() > checkin_time.timestamp():
+                    results[user_id] = CheckinResult(
+                        user_id=user_id,
+                        status="stale",
+                        checkin_time=user.last_checkin_time,
+                        deadline_at=user.deadline_at
+                    )
+                else:
+                    previous_deadline = user.deadline_at
+                    deadline_at = self.users.record_checkin(user_id, checkin_time)
+                    self.notification_states.pop(user_id, None)
+                    self._record_memory_history(user_id, checkin_time.timestamp(), previous_deadline)
+                    results[user_id] = CheckinResult(
+                        user_id=user_id, status="ok", checkin_time=checkin_time, deadline_at=deadline_at
+                    )
+            self._memory_changed()
+            return list(results.values())
+        
+        conn = self._get_connection()
+        with conn:
+            # 先取出批次内已存在用户的截止时间和超时时长
+            existing = {}
+            user_ids = list(latest)
+            for start in range(0, len(user_ids), 500):
+                chunk = user_ids[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                for user_id, deadline_at, timeout_duration in conn.execute(
+                    f"SELECT user_id, deadline_at, timeout_duration FROM users WHERE user_id IN ({placeholders})",
+                    chunk
+                ):
+                    existing[user_id] = (deadline_at, timeout_duration * 3600)
+            
+            updates = []
+            for user_id, checkin_time in latest.items():
+                if user_id not in existing:
+                    results[user_id] = CheckinResult(user_id=user_id, status="not_found")
+                    continue
+                
+                deadline_at, timeout_seconds = existing[user_id]
+                checkin_ts = checkin_time.timestamp()
+                if deadline_at is not None and deadline_at - timeout_seconds > checkin_ts:
+                    results[user_id] = CheckinResult(
+                        user_id=user_id,
+                        status="stale",
+                        checkin_time=datetime.fromtimestamp(deadline_at - timeout_seconds),
+                        deadline_at=deadline_at
+                    )
+                    continue
+                
+                new_deadline = checkin_ts + timeout_seconds
+                updates.append((checkin_time.isoformat(), new_deadline, new_deadline, time.time_ns(), user_id))
+                results[user_id] = CheckinResult(
+                    user_id=user_id, status="ok", checkin_time=checkin_time, deadline_at=new_deadline
+                )
+            
+            # 打卡会改变截止时间，同时重置告警状态；旧的规则告警状态因截止时间不一致自动失效
+            conn.executemany('''
+                UPDATE users SET
+                    last_checkin_time = ?,
+                    deadline_at = ?,
+                    next_alert_at = ?,
+                    last_notified_at = NULL,
+                    notify_stage = 0,
+                    version = ?
+                WHERE user_id = ?
+            ''', updates)
+        
+        for update in updates:
+            self.cache.invalidate(update[-1])
+        
+        return list(results.values())
+    
+    def _record_memory_history(self, user_id: str, checkin_ts: float, previous_deadline: Optional[float]):
+        """内存模式下追加打卡历史并更新累计统计"""
+        stats = self.checkin_stats.get(user_id)
+        stats = stats.model_copy() if stats is not None else CheckinStats(user_id=user_id)
+        overdue = stats.record(checkin_ts, previous_deadline)
+        self.checkin_stats[user_id] = stats
+        
+        event = (checkin_ts, overdue)
+        events = self.checkin_events.setdefault(user_id, [])
+        if not events or events[-1] <= event:
+            # 打卡基本按时间顺序到达，通常只是在末尾追加
+            events.append(event)
+        else:
+            # 乱序到达时插入到新列表，不改动快照可能正在读取的旧列表
+            events = list(events)
+            bisect.insort(events, event)
+            self.checkin_events[user_id] = events
+    
+    def _row_to_checkin_stats(self, row: Tuple) -> CheckinStats:
+        return CheckinStats(**dict(zip(self.CHECKIN_STATS_COLUMNS.split(", "), row)))
+    
+    def get_checkin_stats(self, user_id: str) -> Optional[CheckinStats]:
+        """用户的累计打卡统计，从未打卡时返回None"""
+        if self.use_memory:
+            stats = self.checkin_stats.get(user_id)
+            return stats.model_copy() if stats is not None else None
+        
+        conn = self._get_connection()
+        row = conn.execute(
+            f"SELECT {self.CHECKIN_STATS_COLUMNS} FROM checkin_stats WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return self._row_to_checkin_stats(row) if row else None
+    
+    def count_checkin_events(self, user_id: str, since: float, until: float) -> Tuple[int, int]:
+        """统计[since, until)内的打卡次数和超时后打卡的次数，只扫描该时间范围的历史"""
+        if self.use_memory:
+            events = self.checkin_events.get(user_id, [])
+            window = events[bisect.bisect_left(events, (since,)):bisect.bisect_left(events, (until,))]
+            return len(window), sum(overdue for _, overdue in window)
+        
+        conn = self._get_connection()
+        checkins, overdue = conn.execute('''
+            SELECT COUNT(*), COALESCE(SUM(overdue), 0) FROM checkin_events
+            WHERE user_id = ? AND checkin_at >= ? AND checkin_at < ?
+        ''', (user_id, since, until)).fetchone()
+        return checkins, overdue
+    
+    def compact_checkin_events(self, before: float, batch_size: int = 5000) -> int:
+        """删除打卡时间早于before的历史，返回删除条数；累计统计不受影响
+        
+        SQLite中分批删除，每批一个事务，避免长时间占用写锁。
+        """
+        if self.use_memory:
+            deleted = 0
+            for user_id, events in list(self.checkin_events.items()):
+                index = bisect.bisect_left(events, (before,))
+                if index:
+                    deleted += index
+                    if index == len(events):
+                        del self.checkin_events[user_id]
+                    else:
+                        self.checkin_events[user_id] = events[index:]
+            if deleted:
+                self._memory_changed()
+            return deleted
+        
+        deleted = 0
+        conn = self._get_connection()
+        while True:
+            with conn:
+                cursor = conn.execute('''
+                    DELETE FROM checkin_events WHERE id IN (
+                        SELECT id FROM checkin_events WHERE checkin_at < ? LIMIT ?
+                    )
+                ''', (before, batch_size))
+            deleted += cursor.rowcount
+            if cursor.rowcount < batch_size:
+                return deleted
     
     def get_all_users(self) -> Dict[str, CheckinUser]:
         """获取所有用户"""
         if self.use_memory:
-            return self.users.copy()
+            return {user_id: self.users.get(user_id) for user_id in self.users}
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        conn = self._get_connection()
+        rows = conn.execute(f"SELECT {self.USER_COLUMNS} FROM users").fetchall()
         
-        cursor.execute(
-            "SELECT user_id, timeout_duration, push_rules, last_checkin_time, timezone FROM users"
-        )
-        rows = cursor.fetchall()
+        users = {}
+        for row in rows:
+            user = self._row_to_user(row)
+            users[user.user_id] = user
         
-        conn.close()
+        return users
+    
+    def list_users(
+        self,
+        after_user_id: str = "",
+        limit: int = 100,
+        fields: Optional[Iterable[str]] = None,
+        overdue: Optional[bool] = None,
+        push_type: Optional[str] = None,
+        enabled: Optional[bool] = None,
+        now: Optional[float] = None
+    ) -> List[dict]:
+        """按user_id键集分页列出用户，只返回fields中的字段（user_id总会返回）
+        
+        overdue按截止时间是否已过筛选；push_type和enabled筛选至少有一条推送规则满足条件的用户。
+        不请求push_rules时不会解析推送规则的JSON，内存占用只与limit有关。
+        """
+        fields = list(fields) if fields else list(self.USER_COLUMNS.split(", "))
+        unknown = set(fields) - set(self.LIST_FIELDS)
+        if unknown:
+            raise ValueError(f"未知的字段: {', '.join(sorted(unknown))}")
+        if "user_id" not in fields:
+            fields.insert(0, "user_id")
+        if now is None:
+            now = time.time()
+        
+        if self.use_memory:
+            def matches(row: dict) -> bool:
+                deadline_at = row["deadline_at"]
+                if overdue is not None and (deadline_at is not None and deadline_at < now) != overdue:
+                    return False
+                if push_type is None and enabled is None:
+                    return True
+                return any(
+                    (push_type is None or rule.type == push_type) and (enabled is None or rule.enabled == enabled)
+                    for rule in row["push_rules"]
+                )
+            
+            # 在排序索引中二分定位游标，只为扫描到的用户构造字段
+            rows = []
+            if limit > 0:
+                for user_id in self.users.iter_sorted_ids(after_user_id):
+                    row = self.users.get_row(user_id)
+                    if matches(row):
+                        rows.append(row)
+                        if len(rows) >= limit:
+                            break
+            result = []
+            for row in rows:
+                item = {field: row[field] for field in fields}
+                if "push_rules" in item:
+                    item["push_rules"] = [rule.model_dump() for rule in item["push_rules"]]
+                result.append(item)
+            return result
+        
+        conditions = ["user_id > ?"]
+        params: List = [after_user_id]
+        if overdue is True:
+            conditions.append("deadline_at < ?")
+            params.append(now)
+        elif overdue is False:
+            conditions.append("(deadline_at IS NULL OR deadline_at >= ?)")
+            params.append(now)
+        if push_type is not None or enabled is not None:
+            # 在SQLite中检查推送规则JSON，不在Python中解析
+            rule_conditions = []
+            if push_type is not None:
+                rule_conditions.append("json_extract(value, '$.type') = ?")
+                params.append(push_type)
+            if enabled is not None:
+                rule_conditions.append("json_extract(value, '$.enabled') = ?")
+                params.append(int(enabled))
+            conditions.append(
+                f"EXISTS (SELECT 1 FROM json_each(users.push_rules) WHERE {' AND '.join(rule_conditions)})"
+            )
+        params.append(limit)
+        
+        conn = self._get_connection()
+        rows = conn.execute(
+            f"SELECT {', '.join(fields)} FROM users WHERE {' AND '.join(conditions)} ORDER BY user_id LIMIT ?",
+            params
+        ).fetchall()
+        
+        result = []
+        for row in rows:
+            item = dict(zip(fields, row))
+            if "push_rules" in item:
+                item["push_rules"] = json.loads(item["push_rules"])
+            result.append(item)
+        return result
+    
+    def get_overdue_users(
+        self,
+        now: float,
+        limit: Optional[int] = None,
+        shards: Optional[Iterable[int]] = None
+    ) -> Dict[str, CheckinUser]:
+        """获取下次检查时间不晚于now（epoch秒）的用户，按时间升序
+        
+        处于告警冷却期内的超时用户不会返回；指定shards时只返回这些分片的用户。
+        """
+        if self.use_memory:
+            shard_set = None if shards is None else set(shards)
+            overdue = sorted(
+                (next_alert_at, user_id) for user_id, next_alert_at in self.users.iter_next_alerts()
+                if next_alert_at <= now and (shard_set is None or self.shard_of(user_id) in shard_set)
+            )
+            if limit is not None:
+                overdue = overdue[:limit]
+            return {user_id: self.users.get(user_id) for _, user_id in overdue}
+        
+        conn = self._get_connection()
+        if shards is None:
+            rows = conn.execute(
+                f"SELECT {self.USER_COLUMNS} FROM users WHERE next_alert_at <= ? ORDER BY next_alert_at LIMIT ?",
+                (now, -1 if limit is None else limit)
+            ).fetchall()
+        else:
+            shards = list(shards)
+            placeholders = ",".join("?" * len(shards))
+            rows = conn.execute(
+                f"SELECT {self.USER_COLUMNS} FROM users WHERE shard IN ({placeholders}) AND next_alert_at <= ? "
+                f"ORDER BY next_alert_at LIMIT ?",
+                (*shards, now, -1 if limit is None else limit)
+            ).fetchall()
         
         users = {}
         for row in rows:
-            user_id, timeout_duration, push_rules_str, last_checkin_time_str, timezone = row
-            
-            # 解析JSON格式的push_rules
-            from models.push_rule import PushRule
-            push_rules_data = json.loads(push_rules_str)
-            push_rules = [PushRule(**rule_data) for rule_data in push_rules_data]
-            
-            # 解析时间字符串
-            last_checkin_time = None
-            if last_checkin_time_str:
-                last_checkin_time = datetime.fromisoformat(last_checkin_time_str)
-            
-            user = CheckinUser(
+            user = self._row_to_user(row)
+            users[user.user_id] = user
+        
+        return users
+    
+    def get_overdue_users_page(self, now: float, after_user_id: str = "", limit: int = 200) -> Dict[str, CheckinUser]:
+        """按user_id顺序分页获取下次检查时间不晚于now的用户，从after_user_id之后开始"""
+        if self.use_memory:
+            overdue = sorted(
+                user_id for user_id, next_alert_at in self.users.iter_next_alerts()
+                if next_alert_at <= now and user_id > after_user_id
+            )[:limit]
+            return {user_id: self.users.get(user_id) for user_id in overdue}
+        
+        conn = self._get_connection()
+        rows = conn.execute(
+            f"SELECT {self.USER_COLUMNS} FROM users WHERE user_id > ? AND next_alert_at <= ? ORDER BY user_id LIMIT ?",
+            (after_user_id, now, limit)
+        ).fetchall()
+        
+        users = {}
+        for row in rows:
+            user = self._row_to_user(row)
+            users[user.user_id] = user
+        
+        return users
+    
+    def get_cursor(self, name: str) -> str:
+        """读取分批检查的进度游标，不存在时返回空字符串（从头开始）"""
+        if self.use_memory:
+            return self.cursors.get(name, "")
+        
+        conn = self._get_connection()
+        row = conn.execute("SELECT cursor FROM check_cursors WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else ""
+    
+    def save_cursor(self, name: str, cursor: str):
+        """保存分批检查的进度游标"""
+        if self.use_memory:
+            self.cursors[name] = cursor
+            self._memory_changed()
+            return
+        
+        conn = self._get_connection()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO check_cursors (name, cursor, updated_at) VALUES (?, ?, ?)",
+                (name, cursor, time.time())
+            )
+    
+    def get_deadlines(self, shards: Optional[Iterable[int]] = None) -> List[Tuple[str, float]]:
+        """获取用户的下次检查时间（截止时间或告警冷却结束时间），不解析推送规则
+        
+        指定shards时只返回这些分片的用户。
+        """
+        if self.use_memory:
+            shard_set = None if shards is None else set(shards)
+            return [
+                (user_id, next_alert_at)
+                for user_id, next_alert_at in self.users.iter_next_alerts()
+                if shard_set is None or self.shard_of(user_id) in shard_set
+            ]
+        
+        conn = self._get_connection()
+        if shards is None:
+            return conn.execute(
+                "SELECT user_id, next_alert_at FROM users WHERE next_alert_at IS NOT NULL"
+            ).fetchall()
+        
+        shards = list(shards)
+        placeholders = ",".join("?" * len(shards))
+        return conn.execute(
+            f"SELECT user_id, next_alert_at FROM users WHERE shard IN ({placeholders}) AND next_alert_at IS NOT NULL",
+            shards
+        ).fetchall()
+    
+    def claim_alert(self, user_id: str, deadline_at: float, now: float, claim_until: float) -> bool:
+        """推送前认领一次告警：把到期的下次检查时间推迟到claim_until
+        
+        多个进程同时处理同一用户时只有一个能认领成功；认领后进程崩溃的，
+        claim_until之后会被重新检查。
+        """
+        if self.use_memory:
+            next_alert_at = self.users.get_next_alert(user_id)
+            if (user_id not in self.users or self.users.get_deadline(user_id) != deadline_at
+                    or next_alert_at is None or next_alert_at > now):
+                return False
+            self.users.set_next_alert(user_id, claim_until)
+            self._memory_changed()
+            return True
+        
+        conn = self._get_connection()
+        with conn:
+            cursor = conn.execute('''
+                UPDATE users SET next_alert_at = ?
+                WHERE user_id = ? AND deadline_at IS ? AND next_alert_at <= ?
+            ''', (claim_until, user_id, deadline_at, now))
+        return cursor.rowcount > 0
+    
+    def acquire_shard_leases(self, worker_id: str, ttl: float, now: Optional[float] = None) -> List[int]:
+        """续约并按存活工作进程数均分分片租约，返回当前持有的分片
+        
+        每个进程最多持有 ceil(分片数 / 存活进程数) 个分片，超出部分释放给新加入的进程；
+        进程退出或停止续约后，其租约到期即可被其他进程接管。
+        """
+        if now is None:
+            now = time.time()
+        
+        if self.use_memory:
+            self.shard_workers[worker_id] = now + ttl
+            leases = self.shard_leases
+            live_workers = sum(1 for expires_at in self.shard_workers.values() if expires_at > now)
+            rows = [(shard, owner, expires_at) for shard, (owner, expires_at) in leases.items()]
+        else:
+            conn = self._get_connection()
+            # 立即获取写锁，同一时刻只有一个进程在分配租约
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO shard_workers (worker_id, expires_at) VALUES (?, ?)",
+                    (worker_id, now + ttl)
+                )
+                conn.execute("DELETE FROM shard_workers WHERE expires_at <= ?", (now,))
+                live_workers = conn.execute("SELECT COUNT(*) FROM shard_workers").fetchone()[0]
+                rows = conn.execute("SELECT shard, owner, expires_at FROM shard_leases").fetchall()
+            except BaseException:
+                conn.rollback()
+                raise
+        
+        target = math.ceil(self.SHARD_COUNT / max(live_workers, 1))
+        taken = {shard for shard, owner, expires_at in rows if owner != worker_id and expires_at > now}
+        mine = sorted(shard for shard, owner, _ in rows if owner == worker_id)
+        released = mine[target:]
+        mine = mine[:target]
+        free = [shard for shard in range(self.SHARD_COUNT) if shard not in taken and shard not in mine]
+        mine += free[:max(target - len(mine), 0)]
+        
+        if self.use_memory:
+            for shard in released:
+                leases.pop(shard, None)
+            for shard in mine:
+                leases[shard] = (worker_id, now + ttl)
+            return sorted(mine)
+        
+        try:
+            conn.executemany("DELETE FROM shard_leases WHERE shard = ?", [(shard,) for shard in released])
+            conn.executemany(
+                "INSERT OR REPLACE INTO shard_leases (shard, owner, expires_at) VALUES (?, ?, ?)",
+                [(shard, worker_id, now + ttl) for shard in mine]
+            )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return sorted(mine)
+    
+    def release_shard_leases(self, worker_id: str):
+        """释放工作进程持有的全部租约，其他进程下次续约时即可接管"""
+        if self.use_memory:
+            self.shard_workers.pop(worker_id, None)
+            for shard, (owner, _) in list(self.shard_leases.items()):
+                if owner == worker_id:
+                    del self.shard_leases[shard]
+            return
+        
+        conn = self._get_connection()
+        with conn:
+            conn.execute("DELETE FROM shard_leases WHERE owner = ?", (worker_id,))
+            conn.execute("DELETE FROM shard_workers WHERE worker_id = ?", (worker_id,))
+    
+    def get_notification_states(self, user_id: str) -> Dict[str, NotificationState]:
+        """获取用户各推送规则的告警状态"""
+        if self.use_memory:
+            return {
+                rule_id: state.copy()
+                for rule_id, state in self.notification_states.get(user_id, {}).items()
+            }
+        
+        conn = self._get_connection()
+        rows = conn.execute('''
+            SELECT rule_id, stage, last_notified_at, next_notify_at FROM notification_state
+            WHERE user_id = ? AND deadline_at IS (SELECT deadline_at FROM users WHERE user_id = ?)
+        ''', (user_id, user_id)).fetchall()
+        
+        return {
+            rule_id: NotificationState(
                 user_id=user_id,
-                timeout_duration=timeout_duration,
-                push_rules=push_rules,
-                last_checkin_time=last_checkin_time,
-                timezone=timezone
+                rule_id=rule_id,
+                stage=stage,
+                last_notified_at=last_notified_at,
+                next_notify_at=next_notify_at
+            )
+            for rule_id, stage, last_notified_at, next_notify_at in rows
+        }
+    
+    def save_notification_states(
+        self,
+        user_id: str,
+        deadline_at: float,
+        states: List[NotificationState],
+        next_alert_at: Optional[float],
+        outbox_entries: Optional[List[OutboxEntry]] = None
+    ) -> bool:
+        """保存推送后的告警状态和用户下次检查时间，并在同一事务中把告警写入发件箱
+        
+        仅当用户截止时间仍为deadline_at时写入；推送期间用户已打卡或被删除时返回False。
+        """
+        notified = [state.last_notified_at for state in states if state.last_notified_at is not None]
+        last_notified_at = max(notified) if notified else None
+        stage = max((state.stage for state in states), default=0)
+        
+        if self.use_memory:
+            if user_id not in self.users or self.users.get_deadline(user_id) != deadline_at:
+                return False
+            self.users.set_next_alert(user_id, next_alert_at)
+            self.notification_states[user_id] = {state.rule_id: state for state in states}
+            for entry in outbox_entries or []:
+                self._outbox_seq += 1
+                self.outbox[self._outbox_seq] = entry.model_copy(update={"id": self._outbox_seq})
+            self._memory_changed()
+            return True
+        
+        conn = self._get_connection()
+        with conn:
+            cursor = conn.execute('''
+                UPDATE users SET
+                    next_alert_at = ?,
+                    last_notified_at = COALESCE(?, last_notified_at),
+                    notify_stage = ?
+                WHERE user_id = ? AND deadline_at IS ?
+            ''', (next_alert_at, last_notified_at, stage, user_id, deadline_at))
+            if cursor.rowcount == 0:
+                return False
+            
+            conn.executemany('''
+                INSERT OR REPLACE INTO notification_state
+                (user_id, rule_id, stage, last_notified_at, next_notify_at, deadline_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [
+                (user_id, state.rule_id, state.stage, state.last_notified_at, state.next_notify_at, deadline_at)
+                for state in states
+            ])
+            if outbox_entries:
+                conn.executemany('''
+                    INSERT INTO outbox
+                    (user_id, rule_id, rule_type, config, user, status, attempts, next_attempt_at, last_error, created_at,
+                     deadline_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', [
+                    (entry.user_id, entry.rule_id, entry.rule_type, json.dumps(entry.config), entry.user.model_dump_json(),
+                     entry.status, entry.attempts, entry.next_attempt_at, entry.last_error, entry.created_at,
+                     entry.deadline_at)
+                    for entry in outbox_entries
+                ])
+        
+        return True
+    
+    @staticmethod
+    def _row_to_outbox_entry(row: Tuple) -> OutboxEntry:
+        """将发件箱行反序列化"""
+        (entry_id, user_id, rule_id, rule_type, config_str, user_str,
+         status, attempts, next_attempt_at, last_error, created_at, deadline_at) = row
+        return OutboxEntry(
+            id=entry_id,
+            user_id=user_id,
+            rule_id=rule_id,
+            rule_type=rule_type,
+            config=json.loads(config_str),
+            user=CheckinUser.model_validate_json(user_str),
+            status=status,
+            attempts=attempts,
+            next_attempt_at=next_attempt_at,
+            last_error=last_error,
+            created_at=created_at,
+            deadline_at=deadline_at
+        )
+    
+    def claim_outbox(self, now: float, claim_until: float, limit: int = 100) -> List[OutboxEntry]:
+        """认领一批到期的待投递告警，把它们的下次投递时间推迟到claim_until
+        
+        多个进程同时投递时每条告警只会被一个进程认领；认领后进程崩溃的，claim_until之后重新投递。
+        所属截止时间与用户当前截止时间不一致（已打卡、修改了超时时间或用户已删除）的告警不再投递，直接删除。
+        """
+        if self.use_memory:
+            stale = [
+                entry_id for entry_id, entry in self.outbox.items()
+                if entry.status == "pending" and entry.deadline_at is not None
+                and self.users.get_deadline(entry.user_id) != entry.deadline_at
+            ]
+            for entry_id in stale:
+                del self.outbox[entry_id]
+            if stale:
+                self._memory_changed()
+            due = sorted(
+                (entry for entry in self.outbox.values()
+                 if entry.status == "pending" and entry.next_attempt_at <= now),
+                key=lambda entry: entry.next_attempt_at
+            )[:limit]
+            for entry in due:
+                entry.next_attempt_at = claim_until
+            return [entry.model_copy() for entry in due]
+        
+        conn = self._get_connection()
+        with conn:
+            conn.execute('''
+                DELETE FROM outbox
+                WHERE status = 'pending' AND next_attempt_at <= ? AND deadline_at IS NOT NULL
+                    AND deadline_at IS NOT (SELECT deadline_at FROM users WHERE users.user_id = outbox.user_id)
+            ''', (now,))
+            rows = conn.execute(f'''
+                UPDATE outbox SET next_attempt_at = ?
+                WHERE id IN (
+                    SELECT id FROM outbox WHERE status = 'pending' AND next_attempt_at <= ?
+                    ORDER BY next_attempt_at LIMIT ?
+                )
+                RETURNING {self.OUTBOX_COLUMNS}
+            ''', (claim_until, now, limit)).fetchall()
+        return [self._row_to_outbox_entry(row) for row in rows]
+    
+    def complete_outbox(self, entry_id: int):
+        """投递成功后移除告警"""
+        if self.use_memory:
+            self.outbox.pop(entry_id, None)
+            self._memory_changed()
+            return
+        
+        conn = self._get_connection()
+        with conn:
+            conn.execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+    
+    def fail_outbox(self, entry_id: int, attempts: int, next_attempt_at: Optional[float], error: str):
+        """记录投递失败；next_attempt_at为None时标记为dead，不再重试"""
+        status = "pending" if next_attempt_at is not None else "dead"
+        if self.use_memory:
+            entry = self.outbox.get(entry_id)
+            if entry is not None:
+                entry.status = status
+                entry.attempts = attempts
+                entry.next_attempt_at = next_attempt_at if next_attempt_at is not None else entry.next_attempt_at
+                entry.last_error = error
+                self._memory_changed()
+            return
+        
+        conn = self._get_connection()
+        with conn:
+            conn.execute('''
+                UPDATE outbox SET
+                    status = ?,
+                    attempts = ?,
+                    next_attempt_at = COALESCE(?, next_attempt_at),
+                    last_error = ?
+                WHERE id = ?
+            ''', (status, attempts, next_attempt_at, error, entry_id))
+    
+    def get_outbox_entries(self, status: Optional[str] = None, limit: int = 100) -> List[OutboxEntry]:
+        """按下次投递时间列出发件箱中的告警"""
+        if self.use_memory:
+            entries = sorted(
+                (entry for entry in self.outbox.values() if status is None or entry.status == status),
+                key=lambda entry: entry.next_attempt_at
             )
-            users[user_id] = user
+            return [entry.model_copy() for entry in entries[:limit]]
+        
+        conn = self._get_connection()
+        if status is None:
+            rows = conn.execute(
+                f"SELECT {self.OUTBOX_COLUMNS} FROM outbox ORDER BY next_attempt_at LIMIT ?",
+                (limit,)
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                f"SELECT {self.OUTBOX_COLUMNS} FROM outbox WHERE status = ? ORDER BY next_attempt_at LIMIT ?",
+                (status, limit)
+            ).fetchall()
+        return [self._row_to_outbox_entry(row) for row in rows]
+    
+    def get_outbox_stats(self) -> Dict[str, int]:
+        """各状态的告警数量"""
+        stats = {"pending": 0, "dead": 0}
+        if self.use_memory:
+            for entry in self.outbox.values():
+                stats[entry.status] += 1
+            return stats
         
-        return users
\ No newline at end of file
+        conn = self._get_connection()
+        for status, count in conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status"):
+            stats[status] = count
+        return stats
\ No newline at end of file
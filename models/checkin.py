@@ -0,0 +1,27 @@
+from pydantic import BaseModel, Field, field_validator
+from typing import List, Optional
+from datetime import datetime
+
+
+class CheckinItem(BaseModel):
+    user_id: str
+    checkin_time: Optional[datetime] = None  # 客户端打卡时间，为空时使用服务器时间
+    
+    @field_validator("checkin_time")
+    @classmethod
+    def to_local_naive(cls, value: Optional[datetime]) -> Optional[datetime]:
+        """带时区的时间转换为服务器本地时间并去掉时区，与其他打卡时间保持一致，避免与不带时区的时间比较出错"""
+        if value is not None and value.tzinfo is not None:
+            return value.astimezone().replace(tzinfo=None)
+        return value
+
+
+class BatchCheckinRequest(BaseModel):
+    checkins: List[CheckinItem] = Field(..., min_length=1, max_length=50000)
+
+
+class CheckinResult(BaseModel):
+    user_id: str
+    status: str  # 'ok' | 'not_found' | 'stale' | 'future'
+    checkin_time: Optional[datetime] = None
+    deadline_at: Optional[float] = None  # 当前的超时截止时间（epoch秒）
\ No newline at end of file
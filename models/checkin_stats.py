@@ -0,0 +1,50 @@
+from pydantic import BaseModel
+from typing import Optional
+
+
+class CheckinStats(BaseModel):
+    """用户的累计打卡统计，每次打卡增量更新，不需要扫描打卡历史"""
+    user_id: str
+    checkin_count: int = 0
+    first_checkin_at: Optional[float] = None  # epoch秒
+    last_checkin_at: Optional[float] = None  # epoch秒
+    interval_sum: float = 0  # 相邻两次打卡的间隔之和（秒）
+    interval_count: int = 0
+    max_interval: Optional[float] = None  # 最长打卡间隔（秒）
+    current_streak: int = 0  # 当前连续按时打卡次数
+    longest_streak: int = 0
+    overdue_count: int = 0  # 超过截止时间后才打卡的次数
+    
+    @property
+    def mean_interval(self) -> Optional[float]:
+        """平均打卡间隔（秒），少于两次打卡时为None"""
+        if not self.interval_count:
+            return None
+        return self.interval_sum / self.interval_count
+    
+    def record(self, checkin_at: float, deadline_at: Optional[float]) -> bool:
+        """计入一次打卡，deadline_at为打卡前的截止时间；返回这次打卡是否已超时
+        
+        早于上次打卡时间的打卡（乱序到达）只计入次数和超时，不影响间隔和连续按时次数。
+        """
+        overdue = deadline_at is not None and checkin_at > deadline_at
+        self.checkin_count += 1
+        if overdue:
+            self.overdue_count += 1
+        if self.first_checkin_at is None or checkin_at < self.first_checkin_at:
+            self.first_checkin_at = checkin_at
+        
+        if self.last_checkin_at is not None and checkin_at < self.last_checkin_at:
+            return overdue
+        
+        if self.last_checkin_at is not None:
+            interval = checkin_at - self.last_checkin_at
+            self.interval_sum += interval
+            self.interval_count += 1
+            if self.max_interval is None or interval > self.max_interval:
+                self.max_interval = interval
+        self.last_checkin_at = checkin_at
+        
+        self.current_streak = 0 if overdue else self.current_streak + 1
+        self.longest_streak = max(self.longest_streak, self.current_streak)
+        return overdue
\ No newline at end of file
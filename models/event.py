@@ -0,0 +1,14 @@
+from pydantic import BaseModel
+from typing import Any, Dict, Literal
+
+
+EventType = Literal["checkin", "overdue", "notification_sent"]
+
+
+class Event(BaseModel):
+    """推送给事件流订阅者的用户事件"""
+    id: int  # 进程内递增的事件序号
+    type: EventType
+    user_id: str
+    timestamp: float  # 事件发生时间（epoch秒）
+    data: Dict[str, Any] = {}
\ No newline at end of file
@@ -0,0 +1,11 @@
+from pydantic import BaseModel
+from typing import Optional
+
+
+class NotificationState(BaseModel):
+    """单个用户单条推送规则的告警状态"""
+    user_id: str
+    rule_id: str
+    stage: int = 0  # 已成功发送的提醒次数
+    last_notified_at: Optional[float] = None  # 上次成功发送时间（epoch秒）
+    next_notify_at: Optional[float] = None  # 下次允许发送时间（epoch秒）
\ No newline at end of file
@@ -0,0 +1,19 @@
+from pydantic import BaseModel
+from typing import Any, Dict, Literal, Optional
+from models.user import CheckinUser
+
+
+class OutboxEntry(BaseModel):
+    """待投递的告警通知"""
+    id: Optional[int] = None  # 写入发件箱后由存储分配
+    user_id: str
+    rule_id: str
+    rule_type: str
+    config: Dict[str, Any]
+    user: CheckinUser  # 告警时的用户快照，用于生成消息内容
+    deadline_at: Optional[float] = None  # 告警所属的截止时间，用户打卡或修改超时时间后告警作废
+    status: Literal["pending", "dead"] = "pending"
+    attempts: int = 0  # 已失败的投递次数
+    next_attempt_at: float  # 下次投递时间（epoch秒）
+    last_error: Optional[str] = None
+    created_at: float
\ No newline at end of file
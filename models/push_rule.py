@@ -6,4 +6,8 @@ class PushRule(BaseModel):
     id: str
     type: str  # 'dingtalk'
     enabled: bool = True
-    config: Dict[str, str]  # 推送配置
\ No newline at end of file
+    config: Dict[str, str]  # 推送配置
+    
+    def clone(self) -> "PushRule":
+        """复制规则及其配置字典，修改副本不影响原对象"""
+        return self.model_copy(update={"config": dict(self.config)})
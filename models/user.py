@@ -9,4 +9,15 @@ class CheckinUser(BaseModel):
     timeout_duration: int  # 超时时间（小时）
     push_rules: List[PushRule]
     last_checkin_time: Optional[datetime] = None
-    timezone: str = "Asia/Shanghai"
\ No newline at end of file
+    timezone: str = "Asia/Shanghai"
+    
+    @property
+    def deadline_at(self) -> Optional[float]:
+        """超时截止时间（epoch秒），从未打卡时为None"""
+        if not self.last_checkin_time:
+            return None
+        return self.last_checkin_time.timestamp() + self.timeout_duration * 3600
+    
+    def clone(self) -> "CheckinUser":
+        """复制用户及其推送规则，修改副本不影响原对象（比model_copy(deep=True)快）"""
+        return self.model_copy(update={"push_rules": [rule.clone() for rule in self.push_rules]})
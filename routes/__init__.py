@@ -1,3 +1,7 @@
 from .users import router as users_router
+from .outbox import router as outbox_router
+from .events import router as events_router
+from .metrics import router as metrics_router, metrics_middleware
+from .admin import router as admin_router
 
-__all__ = ["users_router"]
+__all__ = ["users_router", "outbox_router", "events_router", "metrics_router", "metrics_middleware", "admin_router"]
@@ -0,0 +1,43 @@
+import asyncio
+import hmac
+import os
+from typing import Literal, Optional
+from fastapi import APIRouter, Header, HTTPException, Query
+from fastapi.responses import JSONResponse, PlainTextResponse
+from utils.sampling_profiler import PROFILER
+
+# 运维诊断路由，需要配置ADMIN_TOKEN并在请求头X-Admin-Token中携带
+router = APIRouter(prefix="/admin", tags=["admin"])
+
+
+def _check_token(token: Optional[str]):
+    """未配置ADMIN_TOKEN时管理接口不可用"""
+    expected = os.environ.get("ADMIN_TOKEN")
+    if not expected:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if token is None or not hmac.compare_digest(token.encode(), expected.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+@router.post("/profile")
+async def profile(
+    seconds: float = Query(5, gt=0, le=60),
+    interval: float = Query(0.005, ge=0.001, le=1),
+    top: int = Query(30, ge=1, le=1000),
+    format: Literal["json", "folded"] = Query("json"),
+    x_admin_token: Optional[str] = Header(None)
+):
+    """对整个进程采样seconds秒，返回按次数聚合的调用栈
+    
+    采样在单独的线程中进行，期间事件循环照常处理请求，因此能看到真实负载下各线程的热点。
+    format=folded 时返回折叠格式的全部调用栈，可直接生成火焰图。
+    """
+    _check_token(x_admin_token)
+    
+    result = await asyncio.to_thread(PROFILER.run, seconds, interval)
+    if result is None:
+        raise HTTPException(status_code=409, detail="Profiler is already running")
+    
+    if format == "folded":
+        return PlainTextResponse(PROFILER.folded(result))
+    return JSONResponse(PROFILER.summarize(result, top))
@@ -0,0 +1,52 @@
+import os
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import StreamingResponse
+from typing import AsyncIterator, List, Optional
+from models.event import EventType
+from routes.users import get_timeout_checker
+from utils.event_bus import EventBus
+
+# 事件流路由
+router = APIRouter(prefix="/events", tags=["events"])
+
+
+def get_event_bus(timeout_checker=Depends(get_timeout_checker)) -> EventBus:
+    """超时检查器持有的事件总线"""
+    return timeout_checker.event_bus
+
+
+async def _stream(event_bus: EventBus, user_id_prefix: str, types: Optional[List[str]]) -> AsyncIterator[str]:
+    """输出SSE事件，空闲时定期发送注释行保持连接；被判定为慢消费者后结束
+    
+    在生成器内订阅，客户端断开时生成器被关闭，随即取消订阅。
+    """
+    keepalive = float(os.environ.get("EVENT_KEEPALIVE_INTERVAL", "15"))
+    subscription = event_bus.subscribe(user_id_prefix, types)
+    try:
+        # 建议客户端断开后3秒重连
+        yield "retry: 3000\n\n"
+        while True:
+            payload = await subscription.get(timeout=keepalive)
+            if payload is None:
+                yield "event: evicted\ndata: {}\n\n"
+                return
+            yield payload or ": keepalive\n\n"
+    finally:
+        event_bus.unsubscribe(subscription)
+
+
+@router.get("/")
+async def stream_events(
+    user_id_prefix: str = Query("", description="只接收user_id以此开头的事件"),
+    types: Optional[List[EventType]] = Query(None, description="只接收这些类型的事件，默认全部"),
+    event_bus: EventBus = Depends(get_event_bus)
+):
+    """以Server-Sent Events推送打卡（checkin）、超时（overdue）和通知发送（notification_sent）事件
+    
+    看板订阅一个事件流即可，无需轮询每个用户的状态。
+    """
+    return StreamingResponse(
+        _stream(event_bus, user_id_prefix, types),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -0,0 +1,32 @@
+import time
+from fastapi import APIRouter
+from fastapi.requests import Request
+from fastapi.responses import PlainTextResponse
+from utils.metrics import REGISTRY, HTTP_REQUEST_DURATION
+from utils.request_profile import log_if_slow, start_profile
+
+# Prometheus指标路由
+router = APIRouter(tags=["metrics"])
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """以Prometheus文本格式输出指标"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+async def metrics_middleware(request: Request, call_next):
+    """统计每个请求的处理耗时，按路由模板而不是实际路径聚合；慢请求记录存储和序列化耗时"""
+    profile = start_profile()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        elapsed = time.perf_counter() - start
+        route = request.scope.get("route")
+        route_path = route.path if route is not None else "unmatched"
+        HTTP_REQUEST_DURATION.observe(elapsed, method=request.method, route=route_path, status=str(status))
+        log_if_slow(profile, request.method, route_path, status, elapsed)
@@ -0,0 +1,18 @@
+from fastapi import APIRouter, Depends, Query
+from typing import Literal, Optional
+from routes.users import get_user_storage
+
+# 告警发件箱路由
+router = APIRouter(prefix="/outbox", tags=["outbox"])
+
+
+@router.get("/")
+async def list_outbox(
+    status: Optional[Literal["pending", "dead"]] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    user_storage=Depends(get_user_storage)
+):
+    """查看发件箱中待投递和已放弃（dead）的告警"""
+    stats = await user_storage.get_outbox_stats()
+    entries = await user_storage.get_outbox_entries(status, limit)
+    return {"stats": stats, "entries": entries}
@@ -1,14 +1,27 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query
 from fastapi.requests import Request
-from typing import List
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import ValidationError
+from datetime import datetime
+from typing import AsyncIterator, List, Optional, Set
 from models.user import CheckinUser
+from models.checkin import BatchCheckinRequest
+from models.checkin_stats import CheckinStats
+from utils.request_profile import profile_span
 
 # 创建用户路由
 router = APIRouter(prefix="/users", tags=["users"])
 
+# 导入时每个事务写入的用户数
+IMPORT_CHUNK_SIZE = 1000
+# 导入结果中最多返回的错误条数
+MAX_IMPORT_ERRORS = 100
+# 超时配置接口返回的字段
+TIMEOUT_CONFIG_FIELDS = {"timeout_duration", "last_checkin_time", "push_rules"}
+
 
 def get_user_storage(request: Request):
-    """从请求中获取用户存储实例"""
+    """从请求中获取用户存储实例（AsyncUserStorage，读写方法均需await）"""
     return request.app.state.user_storage
 
 
@@ -17,28 +30,174 @@ def get_timeout_checker(request: Request):
     return request.app.state.timeout_checker
 
 
-@router.get("/{user_id}")
-async def get_user(user_id: str, user_storage=Depends(get_user_storage)):
-    """获取用户信息"""
-    user = user_storage.get_user(user_id)
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match中是否包含etag（弱比较，支持 * 和多个值）"""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+async def _user_response(
+    request: Request,
+    user_id: str,
+    user_storage,
+    include: Optional[Set[str]] = None
+) -> Response:
+    """按用户数据版本生成ETag，客户端缓存未过期时返回304，不读取和序列化用户
+    
+    数据变化时由pydantic直接序列化为JSON，不经过jsonable_encoder。
+    """
+    version = await user_storage.get_user_version(user_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="用户未找到")
+    
+    etag = f'"{version:x}"'
+    # 允许客户端缓存，但每次使用前都需要用ETag确认
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
     
-    if not user:
+    # ETag和响应体必须来自同一版本的数据，否则客户端会把旧数据保存在新ETag下
+    loaded = await user_storage.get_user_at_version(user_id, version)
+    if not loaded:
         raise HTTPException(status_code=404, detail="用户未找到")
+    user, version = loaded
+    headers["ETag"] = f'"{version:x}"'
+    
+    with profile_span("serialize"):
+        content = user.model_dump_json(include=include)
+    return Response(content, media_type="application/json", headers=headers)
+
+
+async def _iter_ndjson_lines(stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """将请求体字节流按行切分"""
+    buffer = b""
+    async for chunk in stream:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line
+    if buffer:
+        yield buffer
+
+
+@router.get("/")
+async def list_users(
+    cursor: str = Query("", description="上一页返回的next_cursor，为空时从头开始"),
+    limit: int = Query(100, ge=1, le=1000),
+    fields: Optional[str] = Query(
+        None, description="逗号分隔的返回字段，除用户信息的字段外还可选deadline_at和next_alert_at；默认返回用户信息的全部字段"
+    ),
+    overdue: Optional[bool] = Query(None, description="只返回已超时（true）或未超时（false）的用户"),
+    push_type: Optional[str] = Query(None, description="只返回有该类型推送规则的用户"),
+    enabled: Optional[bool] = Query(None, description="只返回有启用（true）或停用（false）推送规则的用户"),
+    user_storage=Depends(get_user_storage)
+):
+    """按user_id键集分页列出用户
+    
+    只请求user_id、deadline_at等字段时不解析推送规则；next_cursor为null表示已到最后一页。
+    """
+    try:
+        users = await user_storage.list_users(
+            cursor,
+            limit,
+            fields=[field.strip() for field in fields.split(",") if field.strip()] if fields else None,
+            overdue=overdue,
+            push_type=push_type,
+            enabled=enabled
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    next_cursor = users[-1]["user_id"] if len(users) == limit else None
+    return JSONResponse({"users": users, "next_cursor": next_cursor})
+
+
+@router.get("/cache/stats")
+async def get_cache_stats(user_storage=Depends(get_user_storage)):
+    """获取用户读缓存的命中统计"""
+    return user_storage.cache.stats()
+
+
+@router.get("/export")
+async def export_users(user_storage=Depends(get_user_storage)):
+    """以NDJSON流式导出所有用户"""
+    return StreamingResponse(user_storage.iter_users_ndjson(), media_type="application/x-ndjson")
+
+
+@router.post("/import")
+async def import_users(
+    request: Request,
+    user_storage=Depends(get_user_storage),
+    timeout_checker=Depends(get_timeout_checker)
+):
+    """从NDJSON请求体流式导入用户，按块提交事务"""
+    imported = 0
+    failed = 0
+    errors = []
+    chunk = []
+    
+    async def flush(chunk):
+        count = await user_storage.import_users(chunk, IMPORT_CHUNK_SIZE)
+        for user in chunk:
+            timeout_checker.schedule_user(user)
+        return count
+    
+    line_number = 0
+    async for line in _iter_ndjson_lines(request.stream()):
+        line_number += 1
+        if not line.strip():
+            continue
+        
+        try:
+            chunk.append(CheckinUser.model_validate_json(line))
+        except ValidationError as e:
+            failed += 1
+            if len(errors) < MAX_IMPORT_ERRORS:
+                errors.append({"line": line_number, "error": str(e)})
+            continue
+        
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            imported += await flush(chunk)
+            chunk = []
     
-    return user
+    if chunk:
+        imported += await flush(chunk)
+    
+    return {"message": "用户导入完成", "imported": imported, "failed": failed, "errors": errors}
+
+
+@router.get("/{user_id}", response_model=CheckinUser)
+async def get_user(user_id: str, request: Request, user_storage=Depends(get_user_storage)):
+    """获取用户信息，支持If-None-Match条件请求"""
+    return await _user_response(request, user_id, user_storage)
 
 
 @router.post("/")
-async def create_user(user: CheckinUser, user_storage=Depends(get_user_storage)):
+async def create_user(
+    user: CheckinUser,
+    user_storage=Depends(get_user_storage),
+    timeout_checker=Depends(get_timeout_checker)
+):
     """创建用户"""
-    user_storage.save_user(user)
+    await user_storage.save_user(user)
+    timeout_checker.schedule_user(user)
     return {"message": "用户创建成功", "user_id": user.user_id}
 
 
 @router.put("/{user_id}")
-async def update_user(user_id: str, user: CheckinUser, user_storage=Depends(get_user_storage)):
+async def update_user(
+    user_id: str,
+    user: CheckinUser,
+    user_storage=Depends(get_user_storage),
+    timeout_checker=Depends(get_timeout_checker)
+):
     """更新用户信息"""
-    existing_user = user_storage.get_user(user_id)
+    existing_user = await user_storage.get_user(user_id)
     
     if not existing_user:
         raise HTTPException(status_code=404, detail="用户未找到")
@@ -46,35 +205,113 @@ async def update_user(user_id: str, user: CheckinUser, user_storage=Depends(get_
     # 保持原有的打卡时间
     user.last_checkin_time = existing_user.last_checkin_time
     
-    user_storage.save_user(user)
+    await user_storage.save_user(user)
+    timeout_checker.schedule_user(user)
     return {"message": "用户更新成功", "user_id": user.user_id}
 
 
+@router.delete("/{user_id}")
+async def delete_user(
+    user_id: str,
+    user_storage=Depends(get_user_storage),
+    timeout_checker=Depends(get_timeout_checker)
+):
+    """删除用户"""
+    if not await user_storage.delete_user(user_id):
+        raise HTTPException(status_code=404, detail="用户未找到")
+    
+    timeout_checker.unschedule_user(user_id)
+    return {"message": "用户删除成功", "user_id": user_id}
+
+
+@router.post("/checkin/batch")
+async def batch_checkin(
+    request: BatchCheckinRequest,
+    user_storage=Depends(get_user_storage),
+    timeout_checker=Depends(get_timeout_checker)
+):
+    """批量打卡，所有条目在同一个事务中写入"""
+    from datetime import datetime
+    now = datetime.now()
+    results = await user_storage.record_checkins(
+        [(item.user_id, item.checkin_time or now) for item in request.checkins]
+    )
+    
+    succeeded = 0
+    for result in results:
+        if result.status == "ok":
+            succeeded += 1
+            timeout_checker.schedule_deadline(result.user_id, result.deadline_at)
+            timeout_checker.event_bus.publish(
+                "checkin",
+                result.user_id,
+                checkin_time=result.checkin_time.isoformat(),
+                deadline_at=result.deadline_at
+            )
+    
+    return {
+        "message": "批量打卡完成",
+        "total": len(results),
+        "succeeded": succeeded,
+        "results": results
+    }
+
+
 @router.post("/{user_id}/checkin")
-async def user_checkin(user_id: str, user_storage=Depends(get_user_storage)):
+async def user_checkin(
+    user_id: str,
+    user_storage=Depends(get_user_storage),
+    timeout_checker=Depends(get_timeout_checker)
+):
     """用户打卡"""
-    user = user_storage.get_user(user_id)
+    from datetime import datetime
+    checkin_time = datetime.now()
+    if timeout_checker.checkin_buffer is not None:
+        # 合并写入模式：与同一时间段内的其他打卡一起提交后返回
+        result = await timeout_checker.checkin_buffer.record_checkin(user_id, checkin_time)
+        deadline_at = result.deadline_at if result.status != "not_found" else None
+    else:
+        deadline_at = await user_storage.record_checkin(user_id, checkin_time)
     
-    if not user:
+    if deadline_at is None:
         raise HTTPException(status_code=404, detail="用户未找到")
     
-    from datetime import datetime
-    user.last_checkin_time = datetime.now()
-    user_storage.save_user(user)
+    timeout_checker.schedule_deadline(user_id, deadline_at)
+    timeout_checker.event_bus.publish(
+        "checkin", user_id, checkin_time=checkin_time.isoformat(), deadline_at=deadline_at
+    )
     
-    return {"message": "打卡记录成功", "checkin_time": user.last_checkin_time}
+    return {"message": "打卡记录成功", "checkin_time": checkin_time}
 
 
 @router.get("/{user_id}/timeout-config")
-async def get_timeout_config(user_id: str, user_storage=Depends(get_user_storage)):
-    """获取用户超时配置"""
-    user = user_storage.get_user(user_id)
+async def get_timeout_config(user_id: str, request: Request, user_storage=Depends(get_user_storage)):
+    """获取用户超时配置，支持If-None-Match条件请求"""
+    return await _user_response(request, user_id, user_storage, include=TIMEOUT_CONFIG_FIELDS)
+
+
+@router.get("/{user_id}/stats")
+async def get_checkin_stats(
+    user_id: str,
+    since: Optional[datetime] = Query(None, description="统计该时间之后的打卡次数和超时次数"),
+    until: Optional[datetime] = Query(None, description="时间范围的结束时间，默认当前时间"),
+    user_storage=Depends(get_user_storage)
+):
+    """获取用户的打卡统计
     
-    if not user:
-        raise HTTPException(status_code=404, detail="用户未找到")
+    累计统计在每次打卡时增量更新，直接读取；指定since时额外统计该时间范围内的打卡，
+    早于打卡历史保留期的部分已被清理，不计入时间范围统计。
+    """
+    stats = await user_storage.get_checkin_stats(user_id)
+    if stats is None:
+        if await user_storage.get_user_version(user_id) is None:
+            raise HTTPException(status_code=404, detail="用户未找到")
+        stats = CheckinStats(user_id=user_id)
     
-    return {
-        "timeout_duration": user.timeout_duration,
-        "last_checkin_time": user.last_checkin_time,
-        "push_rules": user.push_rules
-    }
+    result = stats.model_dump()
+    result["mean_interval"] = stats.mean_interval
+    if since is not None:
+        until = until or datetime.now()
+        checkins, overdue = await user_storage.count_checkin_events(user_id, since.timestamp(), until.timestamp())
+        result["window"] = {"since": since, "until": until, "checkin_count": checkins, "overdue_count": overdue}
+    return result
@@ -1,11 +1,30 @@
 from abc import ABC, abstractmethod
+from typing import Callable, List, Optional
 from models.user import CheckinUser
 
 
 class BasePushService(ABC):
     """推送服务基类"""
     
+    # 是否能把多个用户合并为一条消息发送；否则send_digest逐个发送，每个用户消耗一个限流令牌
+    supports_digest = False
+    
+    def __init__(self, session_provider: Optional[Callable] = None):
+        # 由PushServiceManager注入，返回共享的HTTP连接池会话
+        self._session_provider = session_provider
+    
+    def get_session(self):
+        """获取共享的aiohttp会话"""
+        if self._session_provider is None:
+            raise RuntimeError(f"{type(self).__name__} 未绑定HTTP会话，请通过PushServiceManager获取服务实例")
+        return self._session_provider()
+    
     @abstractmethod
     async def send_notification(self, config: dict, user: CheckinUser):
         """发送通知"""
-        pass
\ No newline at end of file
+        pass
+    
+    async def send_digest(self, config: dict, users: List[CheckinUser]):
+        """发送多个用户合并后的通知，默认逐个发送，支持摘要消息的服务可覆盖"""
+        for user in users:
+            await self.send_notification(config, user)
\ No newline at end of file
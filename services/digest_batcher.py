@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+from models.user import CheckinUser
+from utils.metrics import PUSH_DURATION, PUSH_MESSAGES, PUSH_USERS
+from utils.rate_limiter import TokenBucket
+
+
+logger = logging.getLogger(__name__)
+
+
+class DigestBatcher:
+    """按webhook合并推送并限流
+    
+    同一webhook在合并窗口内的多条超时通知合并为一条摘要消息发送；
+    每个webhook有独立的令牌桶，令牌不足时继续积累待发送用户，下一条摘要一并发送。
+    """
+    
+    def __init__(
+        self,
+        service_manager,
+        window: Optional[float] = None,
+        rate_per_minute: Optional[float] = None,
+        max_batch: int = 100
+    ):
+        self.service_manager = service_manager
+        # 合并窗口（秒），首条通知到达后等待这么久再发送
+        if window is None:
+            window = float(os.environ.get("PUSH_DIGEST_WINDOW", "1"))
+        self.window = window
+        # 每个webhook每分钟最多发送的消息数，钉钉自定义机器人限制为20条/分钟
+        if rate_per_minute is None:
+            rate_per_minute = float(os.environ.get("PUSH_RATE_LIMIT_PER_MINUTE", "20"))
+        self.rate_per_minute = rate_per_minute
+        # 单条摘要最多包含的用户数，避免消息超长
+        self.max_batch = max_batch
+        self._pending: Dict[Tuple, List[Tuple[dict, CheckinUser, asyncio.Future]]] = {}
+        self._flushers: Dict[Tuple, asyncio.Task] = {}
+        self._buckets: Dict[Tuple, TokenBucket] = {}
+    
+    @staticmethod
+    def _batch_key(service_type: str, config: dict) -> Tuple:
+        """配置相同的通知才能合并"""
+        return (service_type, config.get("webhook_url"), config.get("secret", ""))
+    
+    def _get_bucket(self, service_type: str, webhook_url: Optional[str]) -> TokenBucket:
+        """获取webhook对应的令牌桶，同一webhook共享限额"""
+        key = (service_type, webhook_url)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate=self.rate_per_minute / 60, capacity=self.rate_per_minute)
+            self._buckets[key] = bucket
+        return bucket
+    
+    def _supports_digest(self, service_type: str) -> bool:
+        service_class = self.service_manager.services.get(service_type)
+        return getattr(service_class, "supports_digest", False)
+    
+    def _batch_size(self, service_type: str, bucket: TokenBucket, pending: int) -> int:
+        """已取得一个令牌后，本次最多发送的用户数
+        
+        支持摘要的服务一条消息最多max_batch个用户；逐个发送的服务每个用户一条消息，
+        只取桶中现有令牌够发送的用户，其余等待后续令牌。
+        """
+        if self._supports_digest(service_type):
+            return self.max_batch
+        size = 1
+        while size < min(pending, self.max_batch) and bucket.try_acquire():
+            size += 1
+        return size
+    
+    def _message_count(self, service_type: str, users: List[CheckinUser]) -> int:
+        return 1 if self._supports_digest(service_type) else len(users)
+    
+    async def send(self, service_type: str, config: dict, user: CheckinUser):
+        """加入合并队列并等待所在摘要发送完成，发送失败时抛出异常"""
+        key = self._batch_key(service_type, config)
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(key, []).append((config, user, future))
+        if key not in self._flushers:
+            self._flushers[key] = asyncio.create_task(self._flush(key))
+        await future
+    
+    async def _flush(self, key: Tuple):
+        """等待合并窗口结束后按限流分批发送"""
+        service_type, webhook_url, _ = key
+        try:
+            await asyncio.sleep(self.window)
+            bucket = self._get_bucket(service_type, webhook_url)
+            
+            while self._pending.get(key):
+                # 等待令牌期间到达的通知会合并进这一条摘要
+                await bucket.acquire()
+                pending = [item for item in self._pending[key] if not item[2].done()]
+                size = self._batch_size(service_type, bucket, len(pending))
+                batch, self._pending[key] = pending[:size], pending[size:]
+                if not batch:
+                    continue
+                
+                config = batch[0][0]
+                users = [user for _, user, _ in batch]
+                start = time.perf_counter()
+                try:
+                    service = self.service_manager.get_service(service_type)
+                    await service.send_digest(config, users)
+                except Exception as e:
+                    PUSH_DURATION.observe(time.perf_counter() - start, service=service_type)
+                    PUSH_MESSAGES.inc(self._message_count(service_type, users), service=service_type, result="failure")
+                    PUSH_USERS.inc(len(users), service=service_type, result="failure")
+                    for _, _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    PUSH_DURATION.observe(time.perf_counter() - start, service=service_type)
+                    PUSH_MESSAGES.inc(self._message_count(service_type, users), service=service_type, result="success")
+                    PUSH_USERS.inc(len(users), service=service_type, result="success")
+                    if len(users) > 1:
+                        logger.info(f"已合并发送 {len(users)} 个用户的 {service_type} 通知")
+                    for _, _, future in batch:
+                        if not future.done():
+                            future.set_result(None)
+        finally:
+            self._pending.pop(key, None)
+            self._flushers.pop(key, None)
+    
+    async def close(self):
+        """取消尚未发送的通知"""
+        for task in list(self._flushers.values()):
+            task.cancel()
+        for pending in list(self._pending.values()):
+            for _, _, future in pending:
+                if not future.done():
+                    future.cancel()
+        if self._flushers:
+            await asyncio.gather(*self._flushers.values(), return_exceptions=True)
+        self._pending.clear()
+        self._flushers.clear()
\ No newline at end of file
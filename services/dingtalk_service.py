@@ -3,10 +3,10 @@ import hmac
 import hashlib
 import base64
 import urllib.parse
-import aiohttp
 from services.base_push_service import BasePushService
 from models.user import CheckinUser
 from datetime import datetime
+from typing import List
 
 
 logger = logging.getLogger(__name__)
@@ -15,17 +15,34 @@ logger = logging.getLogger(__name__)
 class DingtalkService(BasePushService):
     """钉钉推送服务"""
     
+    supports_digest = True
+    
     async def send_notification(self, config: dict, user: CheckinUser):
         """发送钉钉通知"""
+        # 构建消息内容
+        message = f"用户 {user.user_id} 已超过 {user.timeout_duration} 小时未打卡。\n最后打卡时间: {user.last_checkin_time}\n当前时间: {datetime.now()}"
+        await self._send_text(config, message)
+    
+    async def send_digest(self, config: dict, users: List[CheckinUser]):
+        """将共用同一机器人的多个超时用户合并为一条消息发送"""
+        if len(users) == 1:
+            await self.send_notification(config, users[0])
+            return
+        
+        lines = [f"{len(users)} 个用户已超时未打卡："]
+        for user in users:
+            lines.append(f"- {user.user_id}：超过 {user.timeout_duration} 小时，最后打卡时间: {user.last_checkin_time}")
+        lines.append(f"当前时间: {datetime.now()}")
+        await self._send_text(config, "\n".join(lines))
+    
+    async def _send_text(self, config: dict, message: str):
+        """签名并发送文本消息"""
         webhook_url = config.get("webhook_url")
         secret = config.get("secret", "")
         
         if not webhook_url:
             raise ValueError("缺少必要的钉钉配置")
         
-        # 构建消息内容
-        message = f"用户 {user.user_id} 已超过 {user.timeout_duration} 小时未打卡。\n最后打卡时间: {user.last_checkin_time}\n当前时间: {datetime.now()}"
-        
         # 如果有安全密钥，需要计算签名
         timestamp = str(round(datetime.now().timestamp() * 1000))
         sign = ""
@@ -50,14 +67,14 @@ class DingtalkService(BasePushService):
         }
         
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(final_webhook, json=payload) as response:
-                    if response.status != 200:
-                        raise Exception(f"钉钉API返回状态 {response.status}")
-                    result = await response.json()
-                    if result.get("errcode") != 0:
-                        raise Exception(f"钉钉API错误: {result}")
-                    logger.info("钉钉通知已发送")
+            session = self.get_session()
+            async with session.post(final_webhook, json=payload) as response:
+                if response.status != 200:
+                    raise Exception(f"钉钉API返回状态 {response.status}")
+                result = await response.json()
+                if result.get("errcode") != 0:
+                    raise Exception(f"钉钉API错误: {result}")
+                logger.info("钉钉通知已发送")
         except Exception as e:
             logger.error(f"发送钉钉通知失败: {str(e)}")
             raise
\ No newline at end of file
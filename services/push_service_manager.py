@@ -1,13 +1,35 @@
-from typing import Dict, Type
+import logging
+from typing import TYPE_CHECKING, Dict, Optional, Type
+from models.user import CheckinUser
 from services.base_push_service import BasePushService
 from services.dingtalk_service import DingtalkService
+from services.digest_batcher import DigestBatcher
+
+if TYPE_CHECKING:
+    import aiohttp
+
+
+logger = logging.getLogger(__name__)
 
 
 class PushServiceManager:
     """推送服务管理器"""
     
+    # 连接池与超时配置（秒）
+    POOL_LIMIT = 100
+    POOL_LIMIT_PER_HOST = 50
+    DNS_CACHE_TTL = 300
+    KEEPALIVE_TIMEOUT = 60
+    CONNECT_TIMEOUT = 5
+    READ_TIMEOUT = 10
+    TOTAL_TIMEOUT = 15
+    
     def __init__(self):
         self.services: Dict[str, Type[BasePushService]] = {}
+        self._instances: Dict[str, BasePushService] = {}
+        self._session: Optional["aiohttp.ClientSession"] = None
+        # 按webhook限流并合并同一时间段内的通知
+        self.batcher = DigestBatcher(self)
         self._register_default_services()
     
     def _register_default_services(self):
@@ -17,10 +39,55 @@ class PushServiceManager:
     def register_service(self, service_type: str, service_class: Type[BasePushService]):
         """注册推送服务"""
         self.services[service_type] = service_class
+        self._instances.pop(service_type, None)
     
     def get_service(self, service_type: str) -> BasePushService:
-        """获取推送服务实例"""
+        """获取推送服务实例（每种类型单例）"""
         if service_type not in self.services:
             raise ValueError(f"未知的推送服务类型: {service_type}")
         
-        return self.services[service_type]()
\ No newline at end of file
+        service = self._instances.get(service_type)
+        if service is None:
+            service = self.services[service_type](session_provider=self.get_session)
+            self._instances[service_type] = service
+        return service
+    
+    async def send(self, service_type: str, config: dict, user: CheckinUser):
+        """经限流和合并后发送通知，失败时抛出异常"""
+        if service_type not in self.services:
+            raise ValueError(f"未知的推送服务类型: {service_type}")
+        await self.batcher.send(service_type, config, user)
+    
+    def get_session(self) -> "aiohttp.ClientSession":
+        """获取共享的HTTP会话，首次使用或关闭后自动创建
+        
+        aiohttp在此处才导入，不发送通知的进程（如无服务器环境中的健康检查）无需加载。
+        """
+        if self._session is None or self._session.closed:
+            import aiohttp
+            
+            connector = aiohttp.TCPConnector(
+                limit=self.POOL_LIMIT,
+                limit_per_host=self.POOL_LIMIT_PER_HOST,
+                ttl_dns_cache=self.DNS_CACHE_TTL,
+                keepalive_timeout=self.KEEPALIVE_TIMEOUT
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=self.TOTAL_TIMEOUT,
+                connect=self.CONNECT_TIMEOUT,
+                sock_read=self.READ_TIMEOUT
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+    
+    async def start(self):
+        """在应用启动时预先创建HTTP会话"""
+        self.get_session()
+    
+    async def close(self):
+        """取消未发送的合并通知并关闭共享的HTTP会话"""
+        await self.batcher.close()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info("推送服务HTTP会话已关闭")
+        self._session = None
\ No newline at end of file
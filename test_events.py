@@ -0,0 +1,61 @@
+import json
+import pytest
+from datetime import datetime, timedelta
+from models.user import CheckinUser
+from utils.event_bus import EventBus
+from utils.timeout_checker import TimeoutChecker
+
+
+def parse(payload):
+    fields = dict(line.split(": ", 1) for line in payload.strip().splitlines())
+    return fields["event"], json.loads(fields["data"])
+
+
+@pytest.mark.asyncio
+async def test_subscribers_filter_by_prefix_and_type():
+    bus = EventBus()
+    team = bus.subscribe(user_id_prefix="team-a/")
+    checkins = bus.subscribe(types=["checkin"])
+    
+    bus.publish("checkin", "team-a/alice", deadline_at=1.0)
+    bus.publish("overdue", "team-b/bob")
+    
+    event_type, data = parse(await team.get(timeout=1))
+    assert (event_type, data["user_id"], data["data"]) == ("checkin", "team-a/alice", {"deadline_at": 1.0})
+    assert await team.get(timeout=0.01) == ""
+    assert parse(await checkins.get(timeout=1))[1]["user_id"] == "team-a/alice"
+    assert await checkins.get(timeout=0.01) == ""
+
+
+@pytest.mark.asyncio
+async def test_slow_subscriber_is_evicted():
+    bus = EventBus(buffer_size=2)
+    slow = bus.subscribe()
+    fast = bus.subscribe()
+    
+    for i in range(3):
+        bus.publish("checkin", f"user{i}")
+        await fast.get(timeout=1)
+    
+    assert slow.evicted and await slow.get(timeout=1) is None
+    assert len(bus) == 1 and bus.evicted == 1
+
+
+@pytest.mark.asyncio
+async def test_timeout_check_publishes_overdue_events():
+    checker = TimeoutChecker()
+    subscription = checker.event_bus.subscribe()
+    users = {
+        "late": CheckinUser(
+            user_id="late", timeout_duration=1, push_rules=[],
+            last_checkin_time=datetime.now() - timedelta(hours=2)
+        ),
+        "fresh": CheckinUser(user_id="fresh", timeout_duration=1, push_rules=[], last_checkin_time=datetime.now()),
+    }
+    
+    await checker.check_all_users_timeout(users)
+    await checker.close()
+    
+    event_type, data = parse(await subscription.get(timeout=1))
+    assert (event_type, data["user_id"]) == ("overdue", "late")
+    assert await subscription.get(timeout=0.01) == ""
@@ -0,0 +1,61 @@
+from utils.metrics import Counter, Histogram, MetricsRegistry
+
+
+def test_registry_renders_prometheus_text():
+    registry = MetricsRegistry()
+    requests = registry.register(Counter("requests_total", "请求数", ["route"]))
+    latency = registry.register(Histogram("latency_seconds", "耗时", buckets=(0.1, 1.0)))
+    
+    requests.inc(route="/users/{user_id}")
+    requests.inc(2, route="/users/{user_id}")
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(3)
+    
+    lines = registry.render().splitlines()
+    assert "# TYPE requests_total counter" in lines
+    assert 'requests_total{route="/users/{user_id}"} 3' in lines
+    # 桶计数是累计值
+    assert 'latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{le="1"} 2' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 3' in lines
+    assert "latency_seconds_sum 3.55" in lines
+    assert "latency_seconds_count 3" in lines
+
+
+def test_slow_request_log_has_breakdown(caplog):
+    from utils.request_profile import log_if_slow, start_profile
+    
+    profile = start_profile()
+    profile.add("storage", 0.4)
+    profile.add("serialize", 0.1)
+    with caplog.at_level("WARNING", logger="utils.request_profile"):
+        log_if_slow(profile, "GET", "/users/{user_id}", 200, 0.5)
+        log_if_slow(profile, "GET", "/users/{user_id}", 200, 2.0)
+    
+    assert len(caplog.records) == 1
+    message = caplog.records[0].getMessage()
+    assert "GET /users/{user_id} 200" in message
+    assert "序列化 0.100s" in message and "其他 1.500s" in message
+
+
+def test_profile_endpoint_requires_token_and_samples_stacks(monkeypatch):
+    from fastapi.testclient import TestClient
+    from api.app import app
+    
+    with TestClient(app) as client:
+        monkeypatch.delenv("ADMIN_TOKEN", raising=False)
+        assert client.post("/admin/profile?seconds=0.05").status_code == 404
+        
+        monkeypatch.setenv("ADMIN_TOKEN", "secret")
+        assert client.post("/admin/profile?seconds=0.05", headers={"X-Admin-Token": "wrong"}).status_code == 403
+        
+        response = client.post("/admin/profile?seconds=0.05&top=5", headers={"X-Admin-Token": "secret"})
+        assert response.status_code == 200
+        body = response.json()
+        assert body["samples"] > 0
+        assert body["stacks"] and len(body["top_functions"]) <= 5
+        
+        folded = client.post("/admin/profile?seconds=0.05&format=folded", headers={"X-Admin-Token": "secret"})
+        stack, count = folded.text.splitlines()[0].rsplit(" ", 1)
+        assert ";" in stack and int(count) > 0
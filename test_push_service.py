@@ -0,0 +1,106 @@
+import asyncio
+import time
+import pytest
+from models.user import CheckinUser
+from services.base_push_service import BasePushService
+from services.push_service_manager import PushServiceManager
+from utils.rate_limiter import TokenBucket
+
+
+class RecordingService(BasePushService):
+    supports_digest = True
+    sent = []
+    
+    async def send_notification(self, config: dict, user: CheckinUser):
+        self.sent.append((config["webhook_url"], [user.user_id]))
+    
+    async def send_digest(self, config: dict, users):
+        self.sent.append((config["webhook_url"], [user.user_id for user in users]))
+
+
+class SingleMessageService(BasePushService):
+    """不支持摘要，send_digest使用默认的逐个发送"""
+    sent = []
+    
+    async def send_notification(self, config: dict, user: CheckinUser):
+        self.sent.append((time.monotonic(), user.user_id))
+
+
+def make_user(user_id):
+    return CheckinUser(user_id=user_id, timeout_duration=1, push_rules=[])
+
+
+def test_token_bucket_limits_burst():
+    bucket = TokenBucket(rate=1, capacity=2)
+    assert bucket.try_acquire()
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+    assert 0 < bucket.delay() <= 1
+
+
+@pytest.mark.asyncio
+async def test_notifications_sharing_webhook_are_merged():
+    RecordingService.sent = []
+    manager = PushServiceManager()
+    manager.register_service("recording", RecordingService)
+    manager.batcher.window = 0.01
+    team = {"webhook_url": "https://example.com/team"}
+    other = {"webhook_url": "https://example.com/other"}
+    
+    await asyncio.gather(
+        *(manager.send("recording", team, make_user(f"user{i}")) for i in range(250)),
+        manager.send("recording", other, make_user("solo"))
+    )
+    
+    team_messages = [users for url, users in RecordingService.sent if url == team["webhook_url"]]
+    assert len(team_messages) == 3  # 每条摘要最多100个用户
+    assert sum(len(users) for users in team_messages) == 250
+    assert ("https://example.com/other", ["solo"]) in RecordingService.sent
+    await manager.close()
+
+
+@pytest.mark.asyncio
+async def test_rate_limited_webhook_accumulates_into_next_digest():
+    RecordingService.sent = []
+    manager = PushServiceManager()
+    manager.register_service("recording", RecordingService)
+    manager.batcher.window = 0
+    manager.batcher.rate_per_minute = 60 * 20  # 每50毫秒一个令牌
+    config = {"webhook_url": "https://example.com/team"}
+    bucket = manager.batcher._get_bucket("recording", config["webhook_url"])
+    bucket.tokens = 0
+    
+    async def late_sender(i):
+        await asyncio.sleep(0.01)
+        await manager.send("recording", config, make_user(f"late{i}"))
+    
+    await asyncio.gather(
+        manager.send("recording", config, make_user("first")),
+        *(late_sender(i) for i in range(10))
+    )
+    
+    # 等待令牌期间到达的通知合并进同一条消息
+    assert len(RecordingService.sent) == 1
+    assert len(RecordingService.sent[0][1]) == 11
+    await manager.close()
+
+
+@pytest.mark.asyncio
+async def test_services_without_digest_take_one_token_per_message():
+    SingleMessageService.sent = []
+    manager = PushServiceManager()
+    manager.register_service("single", SingleMessageService)
+    manager.batcher.window = 0
+    manager.batcher.rate_per_minute = 60 * 20  # 每50毫秒一个令牌
+    config = {"webhook_url": "https://example.com/team"}
+    bucket = manager.batcher._get_bucket("single", config["webhook_url"])
+    bucket.tokens = 2
+    
+    start = time.monotonic()
+    await asyncio.gather(*(manager.send("single", config, make_user(f"user{i}")) for i in range(5)))
+    
+    assert sorted(user_id for _, user_id in SingleMessageService.sent) == [f"user{i}" for i in range(5)]
+    # 前两条使用已有令牌立即发送，其余三条各等待一个令牌
+    assert sum(1 for at, _ in SingleMessageService.sent if at - start < 0.04) == 2
+    assert SingleMessageService.sent[-1][0] - start >= 0.12
+    await manager.close()
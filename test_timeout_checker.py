@@ -0,0 +1,455 @@
+import asyncio
+import time
+import pytest
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from db.async_user_storage import AsyncUserStorage
+from db.checkin_buffer import CheckinBuffer
+from db.user_storage import UserStorage
+from models.checkin import BatchCheckinRequest
+from models.user import CheckinUser
+from models.push_rule import PushRule
+from utils.deadline_queue import DeadlineQueue
+from utils.outbox_dispatcher import OutboxDispatcher
+from utils.timeout_checker import TimeoutChecker
+
+
+def make_user(user_id, hours_ago=None, timeout_duration=1):
+    last_checkin_time = None
+    if hours_ago is not None:
+        last_checkin_time = datetime.now() - timedelta(hours=hours_ago)
+    return CheckinUser(
+        user_id=user_id,
+        timeout_duration=timeout_duration,
+        push_rules=[
+            PushRule(
+                id="rule1",
+                type="dingtalk",
+                config={"webhook_url": "https://oapi.dingtalk.com/robot/send?access_token=test"}
+            )
+        ],
+        last_checkin_time=last_checkin_time
+    )
+
+
+class FakeScheduler:
+    def add_job(self, *args, **kwargs):
+        pass
+    
+    def get_job(self, job_id):
+        return None
+
+
+def test_deadline_queue_orders_and_replaces():
+    queue = DeadlineQueue()
+    queue.schedule("a", 30.0)
+    queue.schedule("b", 10.0)
+    queue.schedule("c", 20.0)
+    
+    # 重新调度后旧条目应被忽略
+    queue.schedule("b", 40.0)
+    queue.unschedule("c")
+    
+    assert queue.peek() == 30.0
+    assert queue.pop_due(35.0) == ["a"]
+    assert queue.pop_due(35.0) == []
+    assert queue.pop_due(40.0) == ["b"]
+    assert len(queue) == 0
+
+
+@pytest.mark.asyncio
+async def test_check_due_users_only_notifies_due_users(monkeypatch):
+    monkeypatch.setenv("USE_MEMORY_DB", "true")
+    storage = UserStorage()
+    checker = TimeoutChecker()
+    
+    users = [
+        make_user("overdue", hours_ago=2),
+        make_user("fresh", hours_ago=0),
+        make_user("never"),
+    ]
+    for user in users:
+        storage.save_user(user)
+    checker.load_deadlines(storage.get_deadlines())
+    
+    notified = []
+    
+    async def fake_trigger(user, rules=None):
+        notified.append(user.user_id)
+        return {rule.id: True for rule in rules}
+    
+    monkeypatch.setattr(checker, "trigger_push_notifications", fake_trigger)
+    checker.scheduler = FakeScheduler()
+    
+    await checker.check_due_users(AsyncUserStorage(storage))
+    
+    assert notified == ["overdue"]
+    # 超时用户按第一档冷却时间重新入队
+    assert checker.deadline_queue.get("overdue") >= time.time() + checker.backoff_schedule[0] - 5
+    assert "never" not in checker.deadline_queue
+
+
+def test_get_overdue_users_uses_deadline_column(tmp_path, monkeypatch):
+    monkeypatch.delenv("USE_MEMORY_DB", raising=False)
+    storage = UserStorage(db_path=str(tmp_path / "users.db"))
+    storage.save_user(make_user("overdue", hours_ago=3))
+    storage.save_user(make_user("due_soon", hours_ago=0.5))
+    storage.save_user(make_user("never"))
+    
+    overdue = storage.get_overdue_users(time.time())
+    assert list(overdue) == ["overdue"]
+    
+    later = storage.get_overdue_users(time.time() + 3600, limit=1)
+    assert list(later) == ["overdue"]
+    
+    assert {user_id for user_id, _ in storage.get_deadlines()} == {"overdue", "due_soon"}
+
+
+@pytest.mark.asyncio
+async def test_check_all_users_timeout_bounds_concurrency(monkeypatch):
+    checker = TimeoutChecker(max_concurrency=5)
+    users = {f"user{i}": make_user(f"user{i}", hours_ago=2) for i in range(20)}
+    in_flight = 0
+    peak = 0
+    
+    async def slow_trigger(user):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.05)
+        in_flight -= 1
+    
+    monkeypatch.setattr(checker, "trigger_push_notifications", slow_trigger)
+    
+    stats = await checker.check_all_users_timeout(users)
+    
+    assert peak == 5
+    assert stats["timed_out"] == 20
+    assert stats["elapsed"] < 1
+
+
+@pytest.mark.asyncio
+async def test_repeat_alerts_follow_backoff_and_reset_on_checkin(tmp_path, monkeypatch):
+    monkeypatch.delenv("USE_MEMORY_DB", raising=False)
+    storage = UserStorage(db_path=str(tmp_path / "users.db"))
+    async_storage = AsyncUserStorage(storage)
+    checker = TimeoutChecker(backoff_schedule=[600, 3600])
+    storage.save_user(make_user("stale", hours_ago=3))
+    sent = []
+    
+    async def fake_trigger(user, rules=None):
+        sent.append(user.user_id)
+        return {rule.id: True for rule in rules}
+    
+    monkeypatch.setattr(checker, "trigger_push_notifications", fake_trigger)
+    
+    await checker.check_overdue_users(async_storage)
+    # 冷却期内不再重复提醒
+    await checker.check_overdue_users(async_storage)
+    assert sent == ["stale"]
+    
+    state = storage.get_notification_states("stale")["rule1"]
+    assert state.stage == 1
+    assert state.next_notify_at == pytest.approx(state.last_notified_at + 600)
+    
+    # 冷却结束后进入下一档
+    later = time.time() + 601
+    monkeypatch.setattr(time, "time", lambda: later)
+    await checker.check_overdue_users(async_storage)
+    assert sent == ["stale", "stale"]
+    assert storage.get_notification_states("stale")["rule1"].stage == 2
+    
+    # 打卡后告警状态重置
+    user = storage.get_user("stale")
+    user.last_checkin_time = datetime.now()
+    storage.save_user(user)
+    assert storage.get_notification_states("stale") == {}
+
+
+@pytest.mark.asyncio
+async def test_enabling_rule_on_overdue_user_triggers_alert(storage, monkeypatch):
+    async_storage = AsyncUserStorage(storage)
+    checker = TimeoutChecker()
+    sent = []
+    
+    async def fake_trigger(user, rules=None):
+        sent.append(user.user_id)
+        return {rule.id: True for rule in rules}
+    
+    monkeypatch.setattr(checker, "trigger_push_notifications", fake_trigger)
+    
+    # 没有启用的规则时不推送，也不再安排下次检查
+    user = make_user("silent", hours_ago=3)
+    user.push_rules[0].enabled = False
+    storage.save_user(user)
+    await checker.check_overdue_users(async_storage)
+    assert sent == []
+    assert storage.get_overdue_users(time.time()) == {}
+    
+    # 截止时间不变，启用规则后仍应重新检查并推送
+    user.push_rules[0].enabled = True
+    storage.save_user(user)
+    await checker.check_overdue_users(async_storage)
+    assert sent == ["silent"]
+    await async_storage.close()
+
+
+def test_shard_leases_rebalance_between_workers(tmp_path, monkeypatch):
+    monkeypatch.delenv("USE_MEMORY_DB", raising=False)
+    db_path = str(tmp_path / "users.db")
+    first = UserStorage(db_path=db_path)
+    second = UserStorage(db_path=db_path)
+    now = time.time()
+    
+    assert len(first.acquire_shard_leases("w1", ttl=30, now=now)) == UserStorage.SHARD_COUNT
+    # 新进程加入时分片已被占用，等待原持有者续约时释放一半
+    assert second.acquire_shard_leases("w2", ttl=30, now=now + 1) == []
+    shards1 = first.acquire_shard_leases("w1", ttl=30, now=now + 2)
+    shards2 = second.acquire_shard_leases("w2", ttl=30, now=now + 3)
+    assert len(shards1) == len(shards2) == UserStorage.SHARD_COUNT // 2
+    assert not set(shards1) & set(shards2)
+    
+    # w1停止续约，租约到期后由w2接管全部分片
+    assert len(second.acquire_shard_leases("w2", ttl=30, now=now + 40)) == UserStorage.SHARD_COUNT
+
+
+def _claim_overdue(db_path):
+    storage = UserStorage(db_path=db_path)
+    now = time.time()
+    claimed = [
+        user_id
+        for user_id, user in storage.get_overdue_users(now).items()
+        if storage.claim_alert(user_id, user.deadline_at, now, now + 60)
+    ]
+    storage.close()
+    return claimed
+
+
+def test_claim_alert_is_exclusive_across_processes(tmp_path, monkeypatch):
+    monkeypatch.delenv("USE_MEMORY_DB", raising=False)
+    db_path = str(tmp_path / "users.db")
+    storage = UserStorage(db_path=db_path)
+    storage.import_users(make_user(f"user{i}", hours_ago=2) for i in range(200))
+    storage.close()
+    
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(_claim_overdue, [db_path] * 4))
+    
+    claimed = [user_id for result in results for user_id in result]
+    assert sorted(claimed) == sorted(f"user{i}" for i in range(200))
+
+
+class FlakyServiceManager:
+    def __init__(self, failures):
+        self.failures = failures
+        self.sent = []
+    
+    async def send(self, service_type, config, user):
+        if self.failures > 0:
+            self.failures -= 1
+            raise Exception("webhook unavailable")
+        self.sent.append(user.user_id)
+
+
+@pytest.mark.asyncio
+async def test_outbox_retries_then_dead_letters(tmp_path, monkeypatch):
+    monkeypatch.delenv("USE_MEMORY_DB", raising=False)
+    storage = UserStorage(db_path=str(tmp_path / "users.db"))
+    async_storage = AsyncUserStorage(storage)
+    storage.save_user(make_user("stale", hours_ago=3))
+    storage.save_user(make_user("late", hours_ago=2))
+    
+    checker = TimeoutChecker()
+    manager = FlakyServiceManager(failures=1)
+    checker.outbox = OutboxDispatcher(async_storage, manager, max_attempts=2, base_delay=0)
+    
+    async def fail_if_called(user, rules=None):
+        raise AssertionError("检查过程不应直接推送")
+    
+    monkeypatch.setattr(checker, "trigger_push_notifications", fail_if_called)
+    await checker.check_overdue_users(async_storage)
+    assert storage.get_outbox_stats() == {"pending": 2, "dead": 0}
+    # 写入发件箱即按冷却时间推迟下次提醒
+    assert storage.get_overdue_users(time.time()) == {}
+    
+    # 第一条失败一次后立即重试成功
+    stats = await checker.outbox.drain()
+    assert stats == {"sent": 2, "retry": 1, "dead": 0}
+    assert sorted(manager.sent) == ["late", "stale"]
+    assert storage.get_outbox_stats() == {"pending": 0, "dead": 0}
+    
+    # 连续失败达到上限后进入dead状态并保留错误信息
+    storage.save_notification_states(
+        "stale", storage.get_user("stale").deadline_at, [], None,
+        [OutboxDispatcher.build_entry(storage.get_user("stale"), make_user("stale").push_rules[0], time.time())]
+    )
+    manager.failures = 2
+    stats = await checker.outbox.drain()
+    assert stats == {"sent": 0, "retry": 1, "dead": 1}
+    dead = storage.get_outbox_entries("dead")
+    assert [(entry.user_id, entry.attempts, entry.last_error) for entry in dead] == [
+        ("stale", 2, "webhook unavailable")
+    ]
+
+
+@pytest.mark.asyncio
+async def test_outbox_drops_alerts_after_user_checks_in(storage):
+    async_storage = AsyncUserStorage(storage)
+    storage.save_user(make_user("late", hours_ago=2))
+    
+    checker = TimeoutChecker()
+    manager = FlakyServiceManager(failures=1)
+    checker.outbox = OutboxDispatcher(async_storage, manager, base_delay=60)
+    await checker.check_overdue_users(async_storage)
+    
+    # 第一次发送失败，等待重试期间用户打卡
+    assert await checker.outbox.drain() == {"sent": 0, "retry": 1, "dead": 0}
+    storage.record_checkin("late", datetime.now())
+    
+    assert storage.claim_outbox(time.time() + 3600, time.time() + 3720) == []
+    assert storage.get_outbox_stats() == {"pending": 0, "dead": 0}
+    assert manager.sent == []
+    await async_storage.close()
+
+
+@pytest.mark.asyncio
+async def test_budgeted_check_resumes_from_saved_cursor(tmp_path, monkeypatch):
+    monkeypatch.delenv("USE_MEMORY_DB", raising=False)
+    storage = UserStorage(db_path=str(tmp_path / "users.db"))
+    async_storage = AsyncUserStorage(storage)
+    storage.import_users(make_user(f"user{i:03d}", hours_ago=2) for i in range(50))
+    checker = TimeoutChecker()
+    notified = []
+    
+    async def fake_trigger(user, rules=None):
+        notified.append(user.user_id)
+        return {rule.id: True for rule in rules}
+    
+    monkeypatch.setattr(checker, "trigger_push_notifications", fake_trigger)
+    
+    # 预算为0时每次只处理一批
+    first = await checker.check_overdue_users_budgeted(async_storage, budget=0, batch_size=20)
+    assert (first["timed_out"], first["cursor"], first["done"]) == (20, "user019", False)
+    assert storage.get_cursor(TimeoutChecker.CURSOR_NAME) == "user019"
+    
+    second = await checker.check_overdue_users_budgeted(async_storage, budget=0, batch_size=20)
+    third = await checker.check_overdue_users_budgeted(async_storage, budget=0, batch_size=20)
+    assert (second["timed_out"], second["done"]) == (20, False)
+    assert (third["timed_out"], third["cursor"], third["done"]) == (10, "", True)
+    assert sorted(notified) == [f"user{i:03d}" for i in range(50)]
+
+
+@pytest.mark.asyncio
+async def test_checkin_buffer_coalesces_commits_and_is_visible_to_checker(tmp_path, monkeypatch):
+    monkeypatch.delenv("USE_MEMORY_DB", raising=False)
+    storage = UserStorage(db_path=str(tmp_path / "users.db"))
+    async_storage = AsyncUserStorage(storage)
+    storage.save_user(make_user("a", hours_ago=3))
+    storage.save_user(make_user("b", hours_ago=3))
+    commits = []
+    record_checkins = async_storage.record_checkins
+    
+    async def counting_record_checkins(checkins):
+        commits.append(len(checkins))
+        return await record_checkins(checkins)
+    
+    async_storage.record_checkins = counting_record_checkins
+    buffer = CheckinBuffer(async_storage, flush_interval=0.05)
+    checker = TimeoutChecker()
+    checker.checkin_buffer = buffer
+    base = datetime.now()
+    
+    tasks = [
+        asyncio.create_task(buffer.record_checkin("ab"[i % 2], base + timedelta(milliseconds=i)))
+        for i in range(100)
+    ]
+    tasks.append(asyncio.create_task(buffer.record_checkin("missing", base)))
+    await asyncio.sleep(0)
+    # 提交前超时检查器已能看到最新打卡
+    assert not await checker.check_user_timeout(storage.get_user("a"))
+    
+    results = await asyncio.gather(*tasks)
+    
+    assert commits == [3]
+    assert results[-1].status == "not_found"
+    assert {result.status for result in results[:-1]} == {"ok"}
+    assert storage.get_user("a").last_checkin_time == base + timedelta(milliseconds=98)
+    assert storage.get_user("b").last_checkin_time == base + timedelta(milliseconds=99)
+    assert buffer.pending_checkin("a") is None
+    
+    # 关闭时提交剩余的打卡
+    late = asyncio.create_task(buffer.record_checkin("a", base + timedelta(seconds=1)))
+    await asyncio.sleep(0)
+    await buffer.close()
+    assert (await late).status == "ok"
+    assert storage.get_user("a").last_checkin_time == base + timedelta(seconds=1)
+    await checker.close()
+    await async_storage.close()
+
+
+@pytest.mark.asyncio
+async def test_batch_checkin_with_utc_times_does_not_break_timeout_check(monkeypatch):
+    monkeypatch.setenv("USE_MEMORY_DB", "true")
+    storage = UserStorage()
+    storage.save_user(make_user("utc"))
+    storage.save_user(make_user("naive"))
+    
+    two_hours_ago = datetime.now() - timedelta(hours=2)
+    utc_time = two_hours_ago.astimezone().astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    request = BatchCheckinRequest.model_validate({"checkins": [
+        {"user_id": "utc", "checkin_time": utc_time},
+        {"user_id": "naive", "checkin_time": two_hours_ago.isoformat()},
+        {"user_id": "naive", "checkin_time": utc_time},
+    ]})
+    results = storage.record_checkins([(item.user_id, item.checkin_time) for item in request.checkins])
+    assert {result.status for result in results} == {"ok"}
+    assert storage.get_user("utc").last_checkin_time == two_hours_ago
+    
+    checker = TimeoutChecker()
+    
+    async def fake_trigger(user):
+        pass
+    
+    monkeypatch.setattr(checker, "trigger_push_notifications", fake_trigger)
+    stats = await checker.check_all_users_timeout(storage.get_all_users())
+    assert stats["timed_out"] == 2
+
+
+@pytest.mark.asyncio
+async def test_sharded_check_loads_only_users_missing_from_overdue_query(tmp_path, monkeypatch):
+    from utils.shard_lease import ShardLeaseManager
+    monkeypatch.delenv("USE_MEMORY_DB", raising=False)
+    storage = AsyncUserStorage(UserStorage(str(tmp_path / "users.db")))
+    for user in [make_user("queued", hours_ago=2), make_user("other_worker", hours_ago=2), make_user("fresh", hours_ago=0)]:
+        storage.storage.save_user(user)
+    
+    lease_manager = ShardLeaseManager(storage, worker_id="w1")
+    checker = TimeoutChecker(lease_manager=lease_manager)
+    checker.scheduler = FakeScheduler()
+    await checker._sync_shards(storage, time.time())
+    checker.deadline_queue.unschedule("other_worker")  # 在其他进程打卡，不在本进程队列中
+    checker.deadline_queue.schedule("fresh", time.time() - 1)  # 队列中的截止时间已过期
+    
+    loaded = []
+    get_users = storage.get_users
+    
+    async def recording_get_users(user_ids):
+        loaded.append(list(user_ids))
+        return await get_users(user_ids)
+    
+    notified = []
+    
+    async def fake_trigger(user, rules=None):
+        notified.append(user.user_id)
+        return {rule.id: True for rule in rules}
+    
+    monkeypatch.setattr(storage, "get_users", recording_get_users)
+    monkeypatch.setattr(checker, "trigger_push_notifications", fake_trigger)
+    
+    await checker.check_due_users(storage)
+    
+    assert sorted(notified) == ["other_worker", "queued"]
+    # 超时查询已返回的用户不再重复加载
+    assert loaded == [["fresh"]]
+    assert checker.deadline_queue.get("fresh") > time.time()
+    await storage.close()
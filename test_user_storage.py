@@ -0,0 +1,304 @@
+import time
+import pytest
+from datetime import datetime, timedelta
+from db.user_storage import UserStorage
+from models.user import CheckinUser
+from models.push_rule import PushRule
+
+
+def make_user(user_id, last_checkin_time=None, timeout_duration=1):
+    return CheckinUser(
+        user_id=user_id,
+        timeout_duration=timeout_duration,
+        push_rules=[
+            PushRule(
+                id="rule1",
+                type="dingtalk",
+                config={"webhook_url": "https://oapi.dingtalk.com/robot/send?access_token=test"}
+            )
+        ],
+        last_checkin_time=last_checkin_time
+    )
+
+
+def test_record_checkins_reports_per_item_status(storage):
+    now = datetime.now()
+    storage.save_user(make_user("a"))
+    storage.save_user(make_user("b", last_checkin_time=now))
+    storage.save_user(make_user("c"))
+    
+    results = storage.record_checkins([
+        ("a", now - timedelta(minutes=5)),
+        ("a", now - timedelta(minutes=1)),
+        ("b", now - timedelta(hours=1)),
+        ("missing", now),
+        ("c", now + timedelta(hours=1)),
+    ])
+    statuses = {result.user_id: result.status for result in results}
+    
+    assert statuses == {"a": "ok", "b": "stale", "missing": "not_found", "c": "future"}
+    
+    user = storage.get_user("a")
+    assert user.last_checkin_time == now - timedelta(minutes=1)
+    assert user.deadline_at == pytest.approx((now - timedelta(minutes=1)).timestamp() + 3600)
+    assert storage.get_user("b").last_checkin_time == now
+    assert storage.get_user("c").last_checkin_time is None
+
+
+def test_ndjson_export_round_trips_through_import(storage, tmp_path, monkeypatch):
+    users = [make_user(f"user{i:03d}", last_checkin_time=datetime(2024, 1, 1, 8, 0)) for i in range(25)]
+    assert storage.import_users(users, chunk_size=10) == 25
+    
+    lines = "".join(storage.iter_users_ndjson(batch_size=7)).splitlines()
+    assert len(lines) == 25
+    
+    monkeypatch.delenv("USE_MEMORY_DB", raising=False)
+    target = UserStorage(db_path=str(tmp_path / "target.db"))
+    target.import_users(CheckinUser.model_validate_json(line) for line in lines)
+    
+    assert [user.user_id for user in target.iter_users(batch_size=4)] == [user.user_id for user in users]
+    assert target.get_user("user007") == storage.get_user("user007")
+    target.close()
+
+
+def test_get_user_is_served_from_cache_until_written(tmp_path, monkeypatch):
+    monkeypatch.delenv("USE_MEMORY_DB", raising=False)
+    storage = UserStorage(db_path=str(tmp_path / "users.db"))
+    storage.save_user(make_user("cached"))
+    
+    first = storage.get_user("cached")
+    first.timeout_duration = 99  # 修改返回值不应污染缓存
+    second = storage.get_user("cached")
+    assert second.timeout_duration == 1
+    assert storage.cache.stats()["hits"] == 1
+    
+    second.last_checkin_time = datetime(2024, 1, 1, 8, 0)
+    storage.save_user(second)
+    assert storage.get_user("cached").last_checkin_time == datetime(2024, 1, 1, 8, 0)
+    
+    storage.delete_user("cached")
+    assert storage.get_user("cached") is None
+    storage.close()
+
+
+def test_versioned_read_ignores_cache_stale_from_other_process(tmp_path, monkeypatch):
+    monkeypatch.delenv("USE_MEMORY_DB", raising=False)
+    worker_a = UserStorage(db_path=str(tmp_path / "users.db"))
+    worker_b = UserStorage(db_path=str(tmp_path / "users.db"))
+    worker_a.save_user(make_user("shared"))
+    old_version = worker_a.get_user_version("shared")
+    assert worker_a.get_user_at_version("shared", old_version)[0].timeout_duration == 1
+    
+    # 另一个进程写入，本进程的缓存不会失效
+    worker_b.save_user(make_user("shared", timeout_duration=5))
+    assert worker_a.get_user("shared").timeout_duration == 1
+    
+    new_version = worker_a.get_user_version("shared")
+    user, version = worker_a.get_user_at_version("shared", new_version)
+    assert (user.timeout_duration, version) == (5, new_version)
+    assert worker_a.get_user("shared").timeout_duration == 5
+    worker_a.close()
+    worker_b.close()
+
+
+def test_record_checkin_updates_deadline_in_place(storage):
+    storage.save_user(make_user("hot", timeout_duration=2))
+    checkin_time = datetime(2024, 1, 1, 8, 0)
+    
+    deadline_at = storage.record_checkin("hot", checkin_time)
+    
+    assert deadline_at == pytest.approx(checkin_time.timestamp() + 7200)
+    assert storage.get_user("hot").last_checkin_time == checkin_time
+    assert storage.get_deadlines() == [("hot", deadline_at)]
+    assert storage.record_checkin("missing", checkin_time) is None
+
+
+def test_memory_snapshot_restores_users_and_alert_state(tmp_path, monkeypatch):
+    monkeypatch.setenv("USE_MEMORY_DB", "true")
+    monkeypatch.setenv("MEMORY_SNAPSHOT_PATH", str(tmp_path / "users.snapshot"))
+    storage = UserStorage()
+    checkin_time = datetime(2024, 1, 1, 8, 0)
+    for i in range(3):
+        storage.save_user(make_user(f"user{i}", last_checkin_time=checkin_time))
+    storage.delete_user("user1")
+    deadline_at = storage.get_user("user0").deadline_at
+    assert storage.claim_alert("user0", deadline_at, deadline_at, deadline_at + 600)
+    storage.save_cursor("overdue_sweep", "user0")
+    storage.close()
+    
+    restored = UserStorage()
+    
+    assert sorted(user.user_id for user in restored.iter_users()) == ["user0", "user2"]
+    assert restored.get_user("user2") == storage.get_user("user2")
+    assert restored.get_deadlines() == storage.get_deadlines()
+    assert restored.get_cursor("overdue_sweep") == "user0"
+    # 相同的推送规则只保存一份，读取到的规则对象互不影响
+    first, second = (record for record in restored.users._records if record is not None)
+    assert first.push_rules is second.push_rules
+    user = restored.get_user("user0")
+    user.push_rules[0].enabled = False
+    assert restored.get_user("user2").push_rules[0].enabled
+
+
+@pytest.mark.asyncio
+async def test_memory_snapshot_is_written_in_background(tmp_path, monkeypatch):
+    monkeypatch.setenv("USE_MEMORY_DB", "true")
+    monkeypatch.setenv("MEMORY_SNAPSHOT_PATH", str(tmp_path / "users.snapshot"))
+    monkeypatch.setenv("MEMORY_SNAPSHOT_INTERVAL", "0")
+    storage = UserStorage()
+    storage.save_user(make_user("background"))
+    
+    # 触发快照的写入不等待文件写完
+    storage.record_checkin("background", datetime.now() - timedelta(hours=2))
+    assert storage._snapshot_task is not None
+    await storage.wait_snapshot()
+    assert storage._snapshot_task is None
+    
+    restored = UserStorage()
+    assert restored.get_user("background") == storage.get_user("background")
+    assert restored.get_checkin_stats("background") == storage.get_checkin_stats("background")
+    assert restored.count_checkin_events("background", 0, time.time()) == (1, 0)
+
+
+def test_memory_snapshot_keeps_history_captured_before_later_checkins(tmp_path, monkeypatch):
+    monkeypatch.setenv("USE_MEMORY_DB", "true")
+    monkeypatch.setenv("MEMORY_SNAPSHOT_PATH", str(tmp_path / "users.snapshot"))
+    storage = UserStorage()
+    storage.save_user(make_user("history"))
+    start = datetime.now() - timedelta(hours=10)
+    storage.record_checkin("history", start)
+    storage.record_checkin("history", start + timedelta(hours=2))
+    events = storage.checkin_events["history"]
+    
+    captured = storage._capture_snapshot()
+    # 复制之后的追加原地进行，乱序插入换成新列表
+    storage.record_checkin("history", start + timedelta(hours=3))
+    assert storage.checkin_events["history"] is events
+    storage._record_memory_history("history", (start + timedelta(hours=1)).timestamp(), None)
+    assert storage.checkin_events["history"] is not events
+    assert [at for at, _ in storage.checkin_events["history"]] == sorted(at for at, _ in storage.checkin_events["history"])
+    UserStorage._write_snapshot(storage.snapshot_path, captured)
+    
+    restored = UserStorage()
+    assert restored.count_checkin_events("history", 0, time.time()) == (2, 1)
+
+
+def test_user_version_changes_on_every_write(storage):
+    storage.save_user(make_user("v"))
+    created = storage.get_user_version("v")
+    
+    storage.record_checkin("v", datetime.now())
+    checked_in = storage.get_user_version("v")
+    storage.save_user(make_user("v", timeout_duration=3))
+    
+    assert created < checked_in < storage.get_user_version("v")
+    assert storage.get_user_version("missing") is None
+
+
+def test_modifying_returned_user_does_not_affect_storage(storage):
+    storage.save_user(make_user("x"))
+    version = storage.get_user_version("x")
+    
+    for user in (
+        storage.get_user("x"),
+        storage.get_user("x"),  # 第二次读取命中缓存
+        storage.get_users(["x"])["x"],
+        storage.get_user_at_version("x", version)[0],
+    ):
+        user.push_rules[0].enabled = False
+        user.push_rules[0].config["webhook_url"] = "https://example.com/changed"
+        user.push_rules.append(user.push_rules[0])
+    
+    user = storage.get_user("x")
+    assert user == make_user("x")
+    assert storage.get_users(["x"])["x"] == make_user("x")
+
+
+def test_list_users_pages_filters_and_projects(storage):
+    now = datetime.now()
+    for i in range(5):
+        user = make_user(f"user{i}", last_checkin_time=now - timedelta(hours=2 if i % 2 else 0))
+        user.push_rules[0].enabled = i != 4
+        storage.save_user(user)
+    
+    pages = []
+    cursor = ""
+    while True:
+        page = storage.list_users(cursor, limit=2, fields=["deadline_at"])
+        pages.append([user["user_id"] for user in page])
+        if len(page) < 2:
+            break
+        cursor = page[-1]["user_id"]
+    
+    assert pages == [["user0", "user1"], ["user2", "user3"], ["user4"]]
+    assert set(page[0]) == {"user_id", "deadline_at"}
+    assert [user["user_id"] for user in storage.list_users(overdue=True)] == ["user1", "user3"]
+    assert [user["user_id"] for user in storage.list_users(push_type="dingtalk", enabled=False)] == ["user4"]
+    assert storage.list_users(push_type="email") == []
+    
+    full = storage.list_users(limit=1)[0]
+    assert full["push_rules"][0]["config"] == make_user("x").push_rules[0].config
+    with pytest.raises(ValueError):
+        storage.list_users(fields=["password"])
+
+
+def test_memory_list_users_seeks_to_cursor(monkeypatch):
+    monkeypatch.setenv("USE_MEMORY_DB", "true")
+    storage = UserStorage()
+    for i in range(200):
+        storage.save_user(make_user(f"user{i:03d}"))
+    assert [user["user_id"] for user in storage.list_users(limit=2)] == ["user000", "user001"]
+    
+    # 删除、重新添加和新增的用户都按顺序出现在后续分页中
+    for i in range(0, 200, 3):
+        storage.delete_user(f"user{i:03d}")
+    storage.save_user(make_user("user003"))
+    storage.save_user(make_user("user050a"))
+    
+    loaded = []
+    get_row = storage.users.get_row
+    monkeypatch.setattr(storage.users, "get_row", lambda user_id: loaded.append(user_id) or get_row(user_id))
+    page = storage.list_users("user049", limit=3)
+    assert [user["user_id"] for user in page] == ["user050", "user050a", "user052"]
+    # 只为游标之后扫描到的用户构造字段
+    assert loaded == ["user050", "user050a", "user052"]
+    
+    expected = sorted(user.user_id for user in storage.iter_users())
+    listed = []
+    cursor = ""
+    while True:
+        page = storage.list_users(cursor, limit=50, fields=["user_id"])
+        listed.extend(user["user_id"] for user in page)
+        if len(page) < 50:
+            break
+        cursor = page[-1]["user_id"]
+    assert listed == expected
+
+
+def test_checkin_history_maintains_stats_and_compacts(storage):
+    start = datetime.now() - timedelta(days=1)
+    storage.save_user(make_user("history"))
+    
+    storage.record_checkin("history", start)
+    storage.record_checkin("history", start + timedelta(minutes=30))
+    # 截止时间为上次打卡后1小时，这次打卡已超时
+    storage.record_checkin("history", start + timedelta(hours=3))
+    storage.record_checkins([("history", start + timedelta(hours=3, minutes=30))])
+    
+    stats = storage.get_checkin_stats("history")
+    assert stats.checkin_count == 4
+    assert stats.overdue_count == 1
+    assert stats.max_interval == pytest.approx(2.5 * 3600)
+    assert stats.mean_interval == pytest.approx(3.5 * 3600 / 3)
+    assert (stats.current_streak, stats.longest_streak) == (1, 2)
+    
+    window_end = (start + timedelta(hours=4)).timestamp()
+    assert storage.count_checkin_events("history", (start + timedelta(hours=1)).timestamp(), window_end) == (2, 1)
+    
+    # 清理历史只影响时间范围统计，累计统计保持不变
+    assert storage.compact_checkin_events((start + timedelta(hours=1)).timestamp()) == 2
+    assert storage.count_checkin_events("history", start.timestamp(), window_end) == (2, 1)
+    assert storage.get_checkin_stats("history").checkin_count == 4
+    
+    storage.delete_user("history")
+    assert storage.get_checkin_stats("history") is None
@@ -0,0 +1,85 @@
+from fastapi.testclient import TestClient
+from api.app import app
+
+
+def test_health_does_not_initialize_storage(monkeypatch):
+    monkeypatch.setenv("USE_MEMORY_DB", "true")
+    monkeypatch.delenv("MEMORY_SNAPSHOT_PATH", raising=False)
+    
+    with TestClient(app) as client:
+        assert client.get("/health").status_code == 200
+        assert not app.state.initialized
+        
+        response = client.post("/users/", json={"user_id": "lazy", "timeout_duration": 1, "push_rules": []})
+        assert response.status_code == 200
+        assert app.state.initialized
+        assert client.get("/users/lazy").json()["user_id"] == "lazy"
+    
+    # 没有发送过通知，不应加载aiohttp的HTTP会话
+    assert app.state.timeout_checker.service_manager._session is None
+
+
+def test_concurrent_first_requests_initialize_services_once(monkeypatch):
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    import api.app as vercel_app
+    monkeypatch.setenv("USE_MEMORY_DB", "true")
+    monkeypatch.delenv("MEMORY_SNAPSHOT_PATH", raising=False)
+    
+    calls = []
+    create_services = vercel_app._create_services
+    
+    def slow_create_services():
+        calls.append(1)
+        time.sleep(0.1)  # 放大竞争窗口
+        return create_services()
+    
+    monkeypatch.setattr(vercel_app, "_create_services", slow_create_services)
+    
+    with TestClient(app) as client:
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            responses = list(pool.map(
+                lambda user_id: client.post("/users/", json={"user_id": user_id, "timeout_duration": 1, "push_rules": []}),
+                ["a", "b", "c", "d"]
+            ))
+        assert [response.status_code for response in responses] == [200] * 4
+        assert len(calls) == 1
+        for user_id in "abcd":
+            assert client.get(f"/users/{user_id}").status_code == 200
+
+
+def test_user_reads_support_conditional_get(monkeypatch):
+    monkeypatch.setenv("USE_MEMORY_DB", "true")
+    monkeypatch.delenv("MEMORY_SNAPSHOT_PATH", raising=False)
+    
+    with TestClient(app) as client:
+        client.post("/users/", json={"user_id": "etag", "timeout_duration": 1, "push_rules": []})
+        for path in ("/users/etag", "/users/etag/timeout-config"):
+            first = client.get(path)
+            etag = first.headers["etag"]
+            
+            unchanged = client.get(path, headers={"If-None-Match": etag})
+            assert unchanged.status_code == 304 and unchanged.content == b""
+        
+        client.post("/users/etag/checkin")
+        changed = client.get("/users/etag", headers={"If-None-Match": etag})
+        assert changed.status_code == 200 and changed.headers["etag"] != etag
+        assert changed.json()["last_checkin_time"] is not None
+
+
+def test_timeout_check_compacts_old_checkin_history(monkeypatch):
+    from datetime import datetime, timedelta
+    monkeypatch.setenv("USE_MEMORY_DB", "true")
+    monkeypatch.delenv("MEMORY_SNAPSHOT_PATH", raising=False)
+    
+    with TestClient(app) as client:
+        client.post("/users/", json={"user_id": "old", "timeout_duration": 24, "push_rules": []})
+        storage = app.state.user_storage.storage
+        storage.record_checkin("old", datetime.now() - timedelta(days=200))
+        storage.record_checkin("old", datetime.now())
+        
+        stats = client.post("/trigger-timeout-check?budget=1").json()["stats"]
+        assert stats["checkin_history_compacted"] == 1
+        assert client.get("/users/old/stats").json()["checkin_count"] == 2
+        # 一小时内的后续调用不再清理
+        assert client.post("/trigger-timeout-check?budget=1").json()["stats"]["checkin_history_compacted"] == 0
@@ -0,0 +1,77 @@
+import heapq
+from typing import Dict, List, Optional, Tuple
+
+
+class DeadlineQueue:
+    """按截止时间排序的最小堆
+    
+    堆中条目为 (deadline, user_id)，同一用户重新调度时旧条目不立即删除，
+    而是在弹出时与 ``_deadlines`` 比对后丢弃（惰性删除）。
+    """
+    
+    def __init__(self):
+        self._heap: List[Tuple[float, str]] = []
+        self._deadlines: Dict[str, float] = {}
+    
+    def __len__(self) -> int:
+        return len(self._deadlines)
+    
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._deadlines
+    
+    def get(self, user_id: str) -> Optional[float]:
+        """获取用户当前的截止时间"""
+        return self._deadlines.get(user_id)
+    
+    def schedule(self, user_id: str, deadline: Optional[float]):
+        """设置（或替换）用户的截止时间，deadline为None时移除"""
+        if deadline is None:
+            self.unschedule(user_id)
+            return
+        
+        if self._deadlines.get(user_id) == deadline:
+            return
+        
+        self._deadlines[user_id] = deadline
+        heapq.heappush(self._heap, (deadline, user_id))
+        self._maybe_compact()
+    
+    def unschedule(self, user_id: str):
+        """移除用户的截止时间"""
+        self._deadlines.pop(user_id, None)
+    
+    def clear(self):
+        """清空队列"""
+        self._heap.clear()
+        self._deadlines.clear()
+    
+    def peek(self) -> Optional[float]:
+        """返回最早的截止时间，队列为空时返回None"""
+        self._discard_stale()
+        if not self._heap:
+            return None
+        return self._heap[0][0]
+    
+    def pop_due(self, now: float, limit: Optional[int] = None) -> List[str]:
+        """弹出所有截止时间不晚于now的用户ID"""
+        due = []
+        while limit is None or len(due) < limit:
+            self._discard_stale()
+            if not self._heap or self._heap[0][0] > now:
+                break
+            _, user_id = heapq.heappop(self._heap)
+            del self._deadlines[user_id]
+            due.append(user_id)
+        return due
+    
+    def _discard_stale(self):
+        """丢弃堆顶已失效的条目"""
+        heap = self._heap
+        while heap and self._deadlines.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+    
+    def _maybe_compact(self):
+        """失效条目过多时重建堆，避免频繁打卡导致堆无限增长"""
+        if len(self._heap) > 2 * len(self._deadlines) + 1024:
+            self._heap = [(deadline, user_id) for user_id, deadline in self._deadlines.items()]
+            heapq.heapify(self._heap)
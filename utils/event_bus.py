@@ -0,0 +1,90 @@
+import asyncio
+import itertools
+import logging
+import os
+import time
+from typing import Iterable, Optional, Set
+from models.event import Event
+
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """单个订阅者：按user_id前缀和事件类型过滤，缓冲区有上限
+    
+    缓冲区写满（消费过慢）时被事件总线移除，get返回None，由客户端重新连接。
+    """
+    
+    def __init__(self, user_id_prefix: str = "", types: Optional[Iterable[str]] = None, buffer_size: int = 256):
+        self.user_id_prefix = user_id_prefix
+        self.types = frozenset(types) if types else None
+        self.evicted = False
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=buffer_size)
+    
+    def matches(self, event: Event) -> bool:
+        return event.user_id.startswith(self.user_id_prefix) and (self.types is None or event.type in self.types)
+    
+    def offer(self, payload: str) -> bool:
+        """放入一条已编码的事件，缓冲区已满时返回False"""
+        try:
+            self._queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            return False
+        return True
+    
+    async def get(self, timeout: Optional[float] = None) -> Optional[str]:
+        """等待下一条事件；超时返回空字符串，被移除后返回None"""
+        if self.evicted:
+            return None
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None if self.evicted else ""
+
+
+class EventBus:
+    """进程内事件总线，将打卡、超时和通知发送事件分发给SSE订阅者
+    
+    发布不等待订阅者，每个事件只编码一次；缓冲区写满的订阅者直接移除，
+    避免一个慢客户端占用内存或拖慢其他订阅者。
+    """
+    
+    def __init__(self, buffer_size: Optional[int] = None):
+        if buffer_size is None:
+            buffer_size = int(os.environ.get("EVENT_BUFFER_SIZE", "256"))
+        self.buffer_size = buffer_size
+        self._subscribers: Set[Subscription] = set()
+        self._ids = itertools.count(1)
+        self.evicted = 0
+    
+    def __len__(self) -> int:
+        return len(self._subscribers)
+    
+    def subscribe(self, user_id_prefix: str = "", types: Optional[Iterable[str]] = None) -> Subscription:
+        """订阅user_id以user_id_prefix开头的事件，types为空时订阅全部类型"""
+        subscription = Subscription(user_id_prefix, types, self.buffer_size)
+        self._subscribers.add(subscription)
+        return subscription
+    
+    def unsubscribe(self, subscription: Subscription):
+        self._subscribers.discard(subscription)
+    
+    def publish(self, type: str, user_id: str, **data) -> Optional[Event]:
+        """发布事件，没有订阅者时直接返回None"""
+        if not self._subscribers:
+            return None
+        
+        event = Event(id=next(self._ids), type=type, user_id=user_id, timestamp=time.time(), data=data)
+        payload = None
+        for subscription in list(self._subscribers):
+            if not subscription.matches(event):
+                continue
+            if payload is None:
+                payload = f"id: {event.id}\nevent: {event.type}\ndata: {event.model_dump_json()}\n\n"
+            if not subscription.offer(payload):
+                subscription.evicted = True
+                self._subscribers.discard(subscription)
+                self.evicted += 1
+                logger.warning(f"事件订阅者消费过慢，缓冲区已满（{self.buffer_size} 条），已断开")
+        return event
\ No newline at end of file
@@ -0,0 +1,35 @@
+import threading
+from typing import Any, Callable, Dict
+from starlette.datastructures import State
+
+
+class LazyState(State):
+    """首次访问缺失的属性时才调用factory创建的应用状态
+    
+    factory返回属性名到对象的字典，只调用一次。用于无服务器环境，
+    使健康检查等不依赖存储的请求无需等待存储和超时检查器初始化。
+    同步依赖在线程池中执行，初始化加锁，并发的首批请求只会创建一套对象。
+    """
+    
+    def __init__(self, factory: Callable[[], Dict[str, Any]]):
+        super().__init__()
+        super(State, self).__setattr__("_factory", factory)
+        super(State, self).__setattr__("_init_lock", threading.Lock())
+    
+    @property
+    def initialized(self) -> bool:
+        """factory是否已经调用过"""
+        return self._factory is None
+    
+    def get_initialized(self, key: str, default: Any = None) -> Any:
+        """只读取已创建的属性，不会触发初始化（用于关闭时清理资源）"""
+        return self._state.get(key, default)
+    
+    def __getattr__(self, key: str) -> Any:
+        if key not in self._state and self._factory is not None:
+            with self._init_lock:
+                # 等锁期间其他线程可能已完成初始化
+                if self._factory is not None:
+                    self._state.update(self._factory())
+                    super(State, self).__setattr__("_factory", None)
+        return super().__getattr__(key)
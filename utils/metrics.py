@@ -0,0 +1,211 @@
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    """指标基类，按标签值保存各序列"""
+    
+    TYPE = ""
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], object] = {}
+    
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_series(key, value))
+        return lines
+    
+    def _render_series(self, key: Tuple[str, ...], value) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+    
+    TYPE = "counter"
+    
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def get(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """可任意设置的瞬时值"""
+    
+    TYPE = "gauge"
+    
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+    
+    def get(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Histogram(_Metric):
+    """按桶统计的分布，用于耗时等指标"""
+    
+    TYPE = "histogram"
+    
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+    
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+    
+    def time(self, **labels) -> "_Timer":
+        """用作上下文管理器统计代码块耗时"""
+        return _Timer(self, labels)
+    
+    def get_count(self, **labels) -> int:
+        with self._lock:
+            series = self._values.get(self._key(labels))
+            return series[2] if series else 0
+    
+    def _render_series(self, key: Tuple[str, ...], value) -> List[str]:
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+        self.start: Optional[float] = None
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class MetricsRegistry:
+    """进程内指标注册表，按Prometheus文本格式输出"""
+    
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+    
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+# 超时检查
+TIMEOUT_CHECK_DURATION = REGISTRY.register(Histogram(
+    "timeout_check_duration_seconds", "超时检查一次的耗时"
+))
+TIMEOUT_CHECK_USERS = REGISTRY.register(Counter(
+    "timeout_check_users_total", "超时检查涉及的用户数，result为checked或overdue", ["result"]
+))
+SCHEDULER_LAG = REGISTRY.register(Gauge(
+    "scheduler_lag_seconds", "最近一次超时检查实际运行时间比计划晚的秒数"
+))
+EVENT_LOOP_LAG = REGISTRY.register(Gauge(
+    "event_loop_lag_seconds", "事件循环最近一次的调度延迟，持续偏大说明有同步代码阻塞事件循环"
+))
+
+# 存储
+STORAGE_DURATION = REGISTRY.register(Histogram(
+    "storage_operation_duration_seconds", "UserStorage调用耗时", ["operation"]
+))
+STORAGE_ERRORS = REGISTRY.register(Counter(
+    "storage_operation_errors_total", "UserStorage调用失败次数", ["operation"]
+))
+CHECKIN_FLUSH_SIZE = REGISTRY.register(Histogram(
+    "checkin_flush_size",
+    "打卡合并写入模式下每次提交的用户数",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+))
+
+# 推送
+PUSH_DURATION = REGISTRY.register(Histogram(
+    "push_send_duration_seconds", "推送服务发送一条消息的耗时", ["service"]
+))
+PUSH_MESSAGES = REGISTRY.register(Counter(
+    "push_messages_total", "推送服务发送的消息数，result为success或failure", ["service", "result"]
+))
+PUSH_USERS = REGISTRY.register(Counter(
+    "push_users_total", "推送消息中包含的用户数（摘要消息包含多个用户）", ["service", "result"]
+))
+OUTBOX_DELIVERIES = REGISTRY.register(Counter(
+    "outbox_deliveries_total", "发件箱投递结果，result为sent、retry或dead", ["result"]
+))
+
+# HTTP
+HTTP_REQUEST_DURATION = REGISTRY.register(Histogram(
+    "http_request_duration_seconds", "HTTP请求处理耗时", ["method", "route", "status"]
+))
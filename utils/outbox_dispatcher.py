@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from typing import Dict, Optional
+from models.outbox import OutboxEntry
+from models.push_rule import PushRule
+from models.user import CheckinUser
+from utils.metrics import OUTBOX_DELIVERIES
+
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxDispatcher:
+    """告警发件箱投递器
+    
+    超时检查只把告警写入发件箱，由投递器在后台异步发送；发送失败按带抖动的指数退避重试，
+    连续失败max_attempts次后标记为dead，可通过 /outbox 接口查看。
+    """
+    
+    def __init__(
+        self,
+        user_storage,
+        service_manager,
+        max_attempts: Optional[int] = None,
+        base_delay: Optional[float] = None,
+        max_delay: Optional[float] = None,
+        batch_size: int = 100,
+        poll_interval: float = 5,
+        claim_ttl: float = 120,
+        event_bus=None
+    ):
+        self.user_storage = user_storage
+        self.service_manager = service_manager
+        if max_attempts is None:
+            max_attempts = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "8"))
+        self.max_attempts = max_attempts
+        # 第N次失败后等待 base_delay * 2^(N-1) 秒（不超过max_delay）再重试
+        if base_delay is None:
+            base_delay = float(os.environ.get("OUTBOX_RETRY_BASE_DELAY", "5"))
+        self.base_delay = base_delay
+        if max_delay is None:
+            max_delay = float(os.environ.get("OUTBOX_RETRY_MAX_DELAY", "3600"))
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        # 没有新告警写入时检查到期重试的间隔
+        self.poll_interval = poll_interval
+        # 认领后未完成投递（例如进程崩溃）的告警在此时间后重新投递
+        self.claim_ttl = claim_ttl
+        # 投递成功后发布notification_sent事件
+        self.event_bus = event_bus
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+    
+    @staticmethod
+    def build_entry(user: CheckinUser, rule: PushRule, now: float) -> OutboxEntry:
+        """为用户的一条推送规则创建待投递告警"""
+        return OutboxEntry(
+            user_id=user.user_id,
+            rule_id=rule.id,
+            rule_type=rule.type,
+            config=rule.config,
+            user=user,
+            deadline_at=user.deadline_at,
+            next_attempt_at=now,
+            created_at=now
+        )
+    
+    def get_retry_delay(self, attempts: int) -> float:
+        """第attempts次失败后的重试等待时间，在[delay/2, delay]内随机，避免同时重试"""
+        delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+        return random.uniform(delay / 2, delay)
+    
+    def notify(self):
+        """有新告警写入时唤醒后台投递"""
+        self._wakeup.set()
+    
+    async def start(self):
+        """启动后台投递任务"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def close(self):
+        """停止后台投递，未发送的告警保留在发件箱中，下次启动后继续投递"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _run(self):
+        while True:
+            try:
+                await self.drain()
+            except Exception as e:
+                logger.error(f"投递发件箱告警失败: {str(e)}")
+            
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+    
+    async def drain(self, budget: Optional[float] = None) -> Dict[str, int]:
+        """投递所有到期的告警，返回成功、重试和进入dead状态的数量
+        
+        指定budget（秒）时超出预算后不再认领新的一批，剩余告警留给下次投递。
+        """
+        stats = {"sent": 0, "retry": 0, "dead": 0}
+        start = time.perf_counter()
+        while budget is None or time.perf_counter() - start < budget:
+            now = time.time()
+            entries = await self.user_storage.claim_outbox(now, now + self.claim_ttl, self.batch_size)
+            if not entries:
+                return stats
+            
+            # 同一webhook的告警在推送服务中限流并合并发送
+            results = await asyncio.gather(*(self._deliver(entry) for entry in entries))
+            for result in results:
+                stats[result] += 1
+                OUTBOX_DELIVERIES.inc(result=result)
+        return stats
+    
+    async def _deliver(self, entry: OutboxEntry) -> str:
+        """投递单条告警并记录结果"""
+        try:
+            await self.service_manager.send(entry.rule_type, entry.config, entry.user)
+        except Exception as e:
+            attempts = entry.attempts + 1
+            if attempts >= self.max_attempts:
+                logger.error(f"用户 {entry.user_id} 的 {entry.rule_type} 告警连续失败 {attempts} 次，已放弃: {str(e)}")
+                await self.user_storage.fail_outbox(entry.id, attempts, None, str(e))
+                return "dead"
+            
+            delay = self.get_retry_delay(attempts)
+            logger.warning(
+                f"用户 {entry.user_id} 的 {entry.rule_type} 告警发送失败（第 {attempts} 次），{delay:.0f} 秒后重试: {str(e)}"
+            )
+            await self.user_storage.fail_outbox(entry.id, attempts, time.time() + delay, str(e))
+            return "retry"
+        
+        logger.info(f"成功发送 {entry.rule_type} 通知给用户 {entry.user_id}")
+        await self.user_storage.complete_outbox(entry.id)
+        if self.event_bus is not None:
+            self.event_bus.publish("notification_sent", entry.user_id, rule_id=entry.rule_id, rule_type=entry.rule_type)
+        return "sent"
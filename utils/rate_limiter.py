@@ -0,0 +1,38 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """令牌桶限流器
+    
+    桶中最多保存capacity个令牌，每秒补充rate个；令牌不足时acquire等待补充。
+    """
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+    
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        """令牌足够时立即扣除并返回True"""
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+    
+    def delay(self, tokens: float = 1.0) -> float:
+        """距离令牌足够还需等待的秒数"""
+        self._refill()
+        return max(tokens - self.tokens, 0.0) / self.rate
+    
+    async def acquire(self, tokens: float = 1.0):
+        """等待直到获得令牌"""
+        while not self.try_acquire(tokens):
+            await asyncio.sleep(self.delay(tokens))
\ No newline at end of file
@@ -0,0 +1,104 @@
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Optional, Tuple
+from utils.metrics import EVENT_LOOP_LAG
+
+
+logger = logging.getLogger(__name__)
+
+_current: contextvars.ContextVar[Optional["RequestProfile"]] = contextvars.ContextVar("request_profile", default=None)
+
+
+class RequestProfile:
+    """单个请求各环节的耗时，用于慢请求日志"""
+    
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.spans: Dict[str, float] = {}
+    
+    def add(self, name: str, seconds: float):
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+
+def start_profile() -> RequestProfile:
+    """为当前请求创建耗时记录，之后在同一上下文中调用的profile_span都会计入"""
+    profile = RequestProfile()
+    _current.set(profile)
+    return profile
+
+
+def add_span(name: str, seconds: float):
+    """把一段耗时计入当前请求，不在请求中时忽略"""
+    profile = _current.get()
+    if profile is not None:
+        profile.add(name, seconds)
+
+
+@contextmanager
+def profile_span(name: str):
+    """统计代码块耗时并计入当前请求"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_span(name, time.perf_counter() - start)
+
+
+class LoopLagMonitor:
+    """定期测量事件循环的调度延迟，延迟大说明有同步代码阻塞了事件循环"""
+    
+    def __init__(self, interval: float = 0.1, history: int = 600):
+        self.interval = interval
+        self._samples: Deque[Tuple[float, float]] = deque(maxlen=history)
+        self._task: Optional[asyncio.Task] = None
+    
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _run(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(now - expected, 0.0)
+            self._samples.append((now, lag))
+            EVENT_LOOP_LAG.set(lag)
+    
+    def max_lag_since(self, since: float) -> Optional[float]:
+        """since（monotonic时间）之后观测到的最大延迟，未运行时返回None"""
+        if self._task is None:
+            return None
+        return max((lag for at, lag in self._samples if at >= since), default=0.0)
+
+
+LOOP_MONITOR = LoopLagMonitor()
+
+
+def log_if_slow(profile: RequestProfile, method: str, route: str, status: int, elapsed: float):
+    """请求耗时超过SLOW_REQUEST_THRESHOLD秒时记录各环节耗时"""
+    threshold = float(os.environ.get("SLOW_REQUEST_THRESHOLD", "1"))
+    if elapsed < threshold:
+        return
+    
+    storage = profile.spans.get("storage", 0.0)
+    serialize = profile.spans.get("serialize", 0.0)
+    details = [f"存储 {storage:.3f}s", f"序列化 {serialize:.3f}s", f"其他 {max(elapsed - storage - serialize, 0.0):.3f}s"]
+    loop_lag = LOOP_MONITOR.max_lag_since(profile.started_at)
+    if loop_lag is not None:
+        details.append(f"事件循环最大阻塞 {loop_lag:.3f}s")
+    logger.warning(f"慢请求 {method} {route} {status} 耗时 {elapsed:.3f}s：{'，'.join(details)}")
@@ -0,0 +1,120 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import List, Optional
+
+
+class SamplingProfiler:
+    """采样分析器：按固定间隔读取所有线程的调用栈并统计出现次数
+    
+    通过 ``sys._current_frames()`` 采样，不需要插桩，开销只与采样频率有关，可在线上短时间运行。
+    调用栈以 ``线程名;外层函数;...;内层函数`` 的折叠格式统计，可直接交给flamegraph.pl等工具生成火焰图。
+    """
+    
+    def __init__(self, interval: float = 0.005, max_depth: int = 64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self._lock = threading.Lock()
+        self._root = os.getcwd() + os.sep
+    
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+    
+    def _describe(self, frame) -> str:
+        code = frame.f_code
+        filename = code.co_filename
+        if filename.startswith(self._root):
+            filename = filename[len(self._root):]
+        else:
+            # 第三方库和标准库只保留 site-packages 之后或最后两级路径
+            parts = filename.split("site-packages" + os.sep, 1)
+            filename = parts[1] if len(parts) == 2 else os.sep.join(filename.rsplit(os.sep, 2)[-2:])
+        return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+    
+    def _stack(self, frame) -> List[str]:
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            stack.append(self._describe(frame))
+            frame = frame.f_back
+        stack.reverse()
+        return stack
+    
+    def run(self, duration: float, interval: Optional[float] = None) -> Optional[dict]:
+        """在调用线程中采样duration秒并返回统计结果；已有采样在运行时返回None"""
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            return self._sample(duration, self.interval if interval is None else interval)
+        finally:
+            self._lock.release()
+    
+    def _sample(self, duration: float, interval: float) -> dict:
+        own_ident = threading.get_ident()
+        stacks: Counter = Counter()
+        self_counts: Counter = Counter()
+        total_counts: Counter = Counter()
+        thread_counts: Counter = Counter()
+        samples = 0
+        
+        start = time.perf_counter()
+        deadline = start + duration
+        while time.perf_counter() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = self._stack(frame)
+                if not stack:
+                    continue
+                thread_name = names.get(ident, str(ident))
+                stacks[";".join([thread_name] + stack)] += 1
+                thread_counts[thread_name] += 1
+                self_counts[stack[-1]] += 1
+                # 递归调用在同一个栈里只计一次
+                for function in set(stack):
+                    total_counts[function] += 1
+            samples += 1
+            time.sleep(interval)
+        
+        return {
+            "duration": round(time.perf_counter() - start, 3),
+            "interval": interval,
+            "samples": samples,
+            "threads": dict(thread_counts.most_common()),
+            "stacks": stacks,
+            "self_counts": self_counts,
+            "total_counts": total_counts,
+        }
+    
+    @staticmethod
+    def summarize(result: dict, top: int) -> dict:
+        """按采样次数取最常出现的调用栈和函数"""
+        return {
+            "duration": result["duration"],
+            "interval": result["interval"],
+            "samples": result["samples"],
+            "threads": result["threads"],
+            "top_functions": [
+                {"function": function, "self": count, "total": result["total_counts"][function]}
+                for function, count in result["self_counts"].most_common(top)
+            ],
+            "top_cumulative": [
+                {"function": function, "total": count}
+                for function, count in result["total_counts"].most_common(top)
+            ],
+            "stacks": [
+                {"stack": stack, "count": count}
+                for stack, count in result["stacks"].most_common(top)
+            ],
+        }
+    
+    @staticmethod
+    def folded(result: dict) -> str:
+        """折叠格式：每行一个调用栈及其采样次数"""
+        return "".join(f"{stack} {count}\n" for stack, count in result["stacks"].most_common())
+
+
+PROFILER = SamplingProfiler()
@@ -0,0 +1,45 @@
+import logging
+import os
+import socket
+import uuid
+from typing import FrozenSet, Optional
+from db.user_storage import UserStorage
+
+
+logger = logging.getLogger(__name__)
+
+
+class ShardLeaseManager:
+    """超时检查分片租约管理
+    
+    用户按 user_id 哈希分到固定数量的分片，每个分片的检查权以租约形式保存在共享数据库中。
+    工作进程定期续约，只检查自己持有的分片；进程退出或停止续约后租约到期，由其他进程接管。
+    """
+    
+    def __init__(self, user_storage, worker_id: Optional[str] = None, lease_ttl: Optional[float] = None):
+        self.user_storage = user_storage
+        if worker_id is None:
+            worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.worker_id = worker_id
+        if lease_ttl is None:
+            lease_ttl = float(os.environ.get("SHARD_LEASE_TTL", "30"))
+        self.lease_ttl = lease_ttl
+        self.shards: FrozenSet[int] = frozenset()
+    
+    def owns(self, user_id: str) -> bool:
+        """当前进程是否负责检查该用户"""
+        return UserStorage.shard_of(user_id) in self.shards
+    
+    async def renew(self) -> bool:
+        """续约并参与分片再均衡，返回持有的分片是否发生变化"""
+        shards = frozenset(await self.user_storage.acquire_shard_leases(self.worker_id, self.lease_ttl))
+        changed = shards != self.shards
+        if changed:
+            logger.info(f"工作进程 {self.worker_id} 持有 {len(shards)}/{UserStorage.SHARD_COUNT} 个分片")
+        self.shards = shards
+        return changed
+    
+    async def release(self):
+        """释放全部租约，让其他进程尽快接管"""
+        await self.user_storage.release_shard_leases(self.worker_id)
+        self.shards = frozenset()
@@ -1,8 +1,17 @@
+import asyncio
 import logging
+import os
+import time
+import weakref
 from datetime import datetime
-from typing import Dict
+from typing import Dict, Iterable, List, Optional, Tuple
+from models.notification_state import NotificationState
+from models.push_rule import PushRule
 from models.user import CheckinUser
 from services.push_service_manager import PushServiceManager
+from utils.deadline_queue import DeadlineQueue
+from utils.event_bus import EventBus
+from utils.metrics import SCHEDULER_LAG, TIMEOUT_CHECK_DURATION, TIMEOUT_CHECK_USERS
 
 
 logger = logging.getLogger(__name__)
@@ -11,42 +20,387 @@ logger = logging.getLogger(__name__)
 class TimeoutChecker:
     """超时检查器"""
     
-    def __init__(self):
+    JOB_ID = "check_due_users"
+    
+    # 分批检查进度游标的名称
+    CURSOR_NAME = "overdue_sweep"
+    
+    DEFAULT_BACKOFF_SCHEDULE = "300,900,1800,3600"
+    
+    def __init__(
+        self,
+        realert_interval: int = 60,
+        max_concurrency: Optional[int] = None,
+        backoff_schedule: Optional[List[int]] = None,
+        lease_manager=None,
+        poll_interval: Optional[float] = None
+    ):
         self.service_manager = PushServiceManager()
+        # 超时和通知发送事件发布到这里，由 /events 推送给看板
+        self.event_bus = EventBus()
+        # 推送失败后重试的间隔（秒）
+        self.realert_interval = realert_interval
+        # 第N次成功提醒后到下一次提醒的间隔（秒），超出列表长度后沿用最后一项
+        if backoff_schedule is None:
+            backoff_schedule = [
+                int(seconds)
+                for seconds in os.environ.get("ALERT_BACKOFF_SCHEDULE", self.DEFAULT_BACKOFF_SCHEDULE).split(",")
+            ]
+        self.backoff_schedule = backoff_schedule
+        # 同时进行推送的用户数上限，避免单个慢webhook阻塞其他告警
+        if max_concurrency is None:
+            max_concurrency = int(os.environ.get("PUSH_MAX_CONCURRENCY", "50"))
+        self.max_concurrency = max_concurrency
+        self._push_semaphore = asyncio.Semaphore(max_concurrency)
+        # 同一用户的推送串行执行，保证顺序
+        self._user_locks = weakref.WeakValueDictionary()
+        self.deadline_queue = DeadlineQueue()
+        self.scheduler = None
+        self.user_storage = None
+        self._armed_at: Optional[float] = None
+        # 多进程部署时只检查本进程持有租约的分片，并定期轮询数据库发现其他进程写入的截止时间
+        self.lease_manager = lease_manager
+        if poll_interval is None:
+            poll_interval = float(os.environ.get("SHARD_POLL_INTERVAL", "10"))
+        self.poll_interval = poll_interval
+        self._renewed_at: Optional[float] = None
+        # 设置后告警写入发件箱由OutboxDispatcher异步投递，检查过程不等待推送完成
+        self.outbox = None
+        # 打卡合并写入时设置，检查超时前先看是否有尚未提交的打卡
+        self.checkin_buffer = None
+    
+    async def start(self):
+        """启动推送服务使用的共享HTTP会话"""
+        await self.service_manager.start()
+    
+    async def close(self):
+        """关闭推送服务使用的共享HTTP会话"""
+        await self.service_manager.close()
+    
+    def attach_scheduler(self, scheduler, user_storage):
+        """绑定调度器，按最近的截止时间安排下一次检查"""
+        self.scheduler = scheduler
+        self.user_storage = user_storage
+        self._arm()
+    
+    def load_deadlines(self, deadlines: Iterable[Tuple[str, float]]):
+        """根据 (user_id, deadline_at) 列表重建截止时间队列"""
+        self.deadline_queue.clear()
+        for user_id, deadline in deadlines:
+            self.deadline_queue.schedule(user_id, deadline)
+        logger.info(f"已加载 {len(self.deadline_queue)} 个用户的超时截止时间")
+    
+    def schedule_user(self, user: CheckinUser):
+        """用户创建、更新或打卡后更新其截止时间"""
+        self.schedule_deadline(user.user_id, user.deadline_at)
+    
+    def schedule_deadline(self, user_id: str, deadline: Optional[float]):
+        """直接按截止时间更新队列，供不加载完整用户的批量操作使用"""
+        if self.lease_manager is not None and not self.lease_manager.owns(user_id):
+            # 其他进程负责的分片，由其轮询数据库时发现
+            self.deadline_queue.unschedule(user_id)
+            return
+        self.deadline_queue.schedule(user_id, deadline)
+        self._rearm_if_earlier(deadline)
+    
+    def unschedule_user(self, user_id: str):
+        """用户删除后移除其截止时间"""
+        self.deadline_queue.unschedule(user_id)
+    
+    def _rearm_if_earlier(self, deadline: Optional[float]):
+        """新的截止时间早于已安排的检查时间时重新安排"""
+        if self.scheduler is None or deadline is None:
+            return
+        if self._armed_at is None or deadline < self._armed_at:
+            self._arm()
+    
+    def _arm(self):
+        """安排调度器在最近的截止时间唤醒"""
+        if self.scheduler is None:
+            return
+        
+        next_deadline = self.deadline_queue.peek()
+        if self.lease_manager is not None:
+            # 分片模式下至少每个轮询间隔唤醒一次，用于续约和发现其他进程写入的截止时间
+            next_poll = time.time() + self.poll_interval
+            next_deadline = next_poll if next_deadline is None else min(next_deadline, next_poll)
+        
+        if next_deadline is None:
+            self._armed_at = None
+            if self.scheduler.get_job(self.JOB_ID):
+                self.scheduler.remove_job(self.JOB_ID)
+            return
+        
+        self._armed_at = next_deadline
+        self.scheduler.add_job(
+            self.check_due_users,
+            "date",
+            run_date=datetime.fromtimestamp(next_deadline),
+            id=self.JOB_ID,
+            replace_existing=True,
+            misfire_grace_time=None,
+        )
     
     async def check_user_timeout(self, user: CheckinUser) -> bool:
         """检查单个用户是否超时"""
-        if not user.last_checkin_time:
+        last_checkin_time = user.last_checkin_time
+        if self.checkin_buffer is not None:
+            pending = self.checkin_buffer.pending_checkin(user.user_id)
+            if pending is not None and (last_checkin_time is None or pending > last_checkin_time):
+                last_checkin_time = pending
+        
+        if not last_checkin_time:
             return False  # 如果从未打卡过，不认为是超时
         
         current_time = datetime.now()
-        time_diff = current_time - user.last_checkin_time
+        time_diff = current_time - last_checkin_time
         
         # 检查是否超过超时时间（单位：小时）
         return time_diff.total_seconds() > user.timeout_duration * 3600
     
-    async def trigger_push_notifications(self, user: CheckinUser):
-        """触发推送通知，只处理钉钉推送"""
+    @staticmethod
+    def get_active_rules(user: CheckinUser) -> List[PushRule]:
+        """获取需要推送的规则，只处理钉钉推送"""
+        return [rule for rule in user.push_rules if rule.enabled and rule.type == "dingtalk"]
+    
+    def get_backoff(self, stage: int) -> int:
+        """获取第stage次成功提醒后的冷却时间（秒）"""
+        return self.backoff_schedule[min(stage, len(self.backoff_schedule) - 1)]
+    
+    async def trigger_push_notifications(
+        self,
+        user: CheckinUser,
+        rules: Optional[List[PushRule]] = None
+    ) -> Dict[str, bool]:
+        """触发推送通知，返回每条规则是否发送成功"""
         logger.info(f"为用户 {user.user_id} 触发推送通知")
         
-        for rule in user.push_rules:
-            if not rule.enabled or rule.type != "dingtalk":
-                continue
-            
+        if rules is None:
+            rules = self.get_active_rules(user)
+        
+        results = {}
+        for rule in rules:
             try:
-                service = self.service_manager.get_service(rule.type)
-                await service.send_notification(rule.config, user)
+                # 同一webhook的通知经限流后合并为摘要发送
+                await self.service_manager.send(rule.type, rule.config, user)
                 logger.info(f"成功发送 {rule.type} 通知给用户 {user.user_id}")
+                results[rule.id] = True
+                self.event_bus.publish("notification_sent", user.user_id, rule_id=rule.id, rule_type=rule.type)
             except Exception as e:
                 logger.error(f"发送 {rule.type} 通知失败，用户 {user.user_id}: {str(e)}")
+                results[rule.id] = False
+        return results
+    
+    async def check_due_users(self, user_storage=None):
+        """只检查截止时间已到的用户，检查结束后按下一个截止时间重新安排"""
+        user_storage = user_storage or self.user_storage
+        now = time.time()
+        if self._armed_at is not None:
+            # 实际运行时间比计划晚多少，持续偏大说明事件循环或检查本身过载
+            SCHEDULER_LAG.set(max(now - self._armed_at, 0.0))
+        
+        try:
+            if self.lease_manager is not None:
+                await self._sync_shards(user_storage, now)
+            
+            due_ids = self.deadline_queue.pop_due(now)
+            users = {}
+            if self.lease_manager is not None:
+                # 其他进程处理的打卡不会进入本进程的队列，以数据库中的下次检查时间为准
+                users = await user_storage.get_overdue_users(now, shards=self.lease_manager.shards)
+                queued = set(due_ids)
+                for user_id in users:
+                    if user_id not in queued:
+                        self.deadline_queue.unschedule(user_id)
+                        due_ids.append(user_id)
+            # 已随超时查询加载的用户不再重复读取
+            missing = [user_id for user_id in due_ids if user_id not in users]
+            if missing:
+                users.update(await user_storage.get_users(missing))
+            
+            due_users = {}
+            for user_id in due_ids:
+                user = users.get(user_id)
+                if user is None or user_id in self.deadline_queue:
+                    # 用户已删除，或加载期间已被打卡重新入队
+                    continue
+                
+                deadline = user.deadline_at
+                if deadline is None or deadline > now:
+                    # 队列中的截止时间已过期（例如在其他进程中打过卡）
+                    self.deadline_queue.schedule(user_id, deadline)
+                    continue
+                
+                # 先安排下一次提醒，这样推送期间的打卡或删除能正确覆盖它
+                self.deadline_queue.schedule(user_id, now + self.realert_interval)
+                due_users[user_id] = user
+            
+            if due_users:
+                await self.check_all_users_timeout(due_users, user_storage)
+        finally:
+            self._arm()
+    
+    async def _sync_shards(self, user_storage, now: float):
+        """按轮询间隔续约分片租约，持有的分片变化时重建截止时间队列"""
+        if self._renewed_at is not None and now - self._renewed_at < self.poll_interval:
+            return
+        
+        self._renewed_at = now
+        if await self.lease_manager.renew():
+            self.load_deadlines(await user_storage.get_deadlines(self.lease_manager.shards))
+    
+    async def check_overdue_users(self, user_storage, now: Optional[float] = None, limit: Optional[int] = None):
+        """通过截止时间索引只加载已超时的用户并检查"""
+        if now is None:
+            now = time.time()
+        
+        users_db = await user_storage.get_overdue_users(now, limit)
+        return await self.check_all_users_timeout(users_db, user_storage)
+    
+    async def check_overdue_users_budgeted(
+        self,
+        user_storage,
+        budget: float,
+        cursor: Optional[str] = None,
+        batch_size: int = 200,
+        now: Optional[float] = None
+    ) -> Dict:
+        """在时间预算内按user_id顺序分批检查已到期用户，保存并返回进度游标
+        
+        cursor为None时从上次保存的位置继续；本轮扫描到末尾后游标归零，done为True。
+        预计下一批会超出预算时提前停止，下次调用从游标处接续。
+        """
+        start = time.perf_counter()
+        if now is None:
+            now = time.time()
+        if cursor is None:
+            cursor = await user_storage.get_cursor(self.CURSOR_NAME)
+        
+        checked = 0
+        timed_out = 0
+        done = False
+        while True:
+            batch_start = time.perf_counter()
+            users = await user_storage.get_overdue_users_page(now, cursor, batch_size)
+            if users:
+                stats = await self.check_all_users_timeout(users, user_storage)
+                checked += stats["checked"]
+                timed_out += stats["timed_out"]
+                cursor = max(users)
+            
+            if len(users) < batch_size:
+                done = True
+                cursor = ""
+                break
+            
+            # 按上一批的耗时估算，剩余预算不够再处理一批时停止
+            now_perf = time.perf_counter()
+            if (now_perf - start) + (now_perf - batch_start) > budget:
+                break
+        
+        await user_storage.save_cursor(self.CURSOR_NAME, cursor)
+        return {
+            "checked": checked,
+            "timed_out": timed_out,
+            "cursor": cursor,
+            "done": done,
+            "elapsed": time.perf_counter() - start,
+        }
+    
+    async def _notify_user(self, user: CheckinUser, user_storage=None):
+        """在全局并发上限内为单个用户推送，同一用户的推送按顺序执行"""
+        lock = self._user_locks.get(user.user_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._user_locks[user.user_id] = lock
+        
+        async with lock:
+            async with self._push_semaphore:
+                if user_storage is None:
+                    await self.trigger_push_notifications(user)
+                else:
+                    await self._notify_with_backoff(user, user_storage)
+    
+    async def _notify_with_backoff(self, user: CheckinUser, user_storage):
+        """按各规则的告警状态推送，冷却期内的规则跳过，推送后持久化状态"""
+        placeholder = self.deadline_queue.get(user.user_id)
+        now = time.time()
+        
+        # 先认领本次告警，多个进程同时检查到同一用户时只有一个会推送
+        if not await user_storage.claim_alert(user.user_id, user.deadline_at, now, now + self.realert_interval):
+            return
+        
+        states = await user_storage.get_notification_states(user.user_id)
+        rules = self.get_active_rules(user)
+        
+        due_rules = []
+        for rule in rules:
+            state = states.get(rule.id)
+            if state is None:
+                state = states[rule.id] = NotificationState(user_id=user.user_id, rule_id=rule.id)
+            if state.next_notify_at is None or state.next_notify_at <= now:
+                due_rules.append(rule)
+        
+        outbox_entries = None
+        if self.outbox is not None:
+            # 写入发件箱即视为已提醒，投递失败由发件箱负责重试
+            outbox_entries = [self.outbox.build_entry(user, rule, now) for rule in due_rules]
+            results = {rule.id: True for rule in due_rules}
+        else:
+            results = await self.trigger_push_notifications(user, due_rules) if due_rules else {}
+        
+        for rule in due_rules:
+            state = states[rule.id]
+            if results.get(rule.id):
+                state.last_notified_at = now
+                state.next_notify_at = now + self.get_backoff(state.stage)
+                state.stage += 1
+            else:
+                state.next_notify_at = now + self.realert_interval
+        
+        # 已停用或删除的规则不再参与计算下次检查时间
+        active_states = [states[rule.id] for rule in rules]
+        next_alert_at = min((state.next_notify_at for state in active_states), default=None)
+        
+        saved = await user_storage.save_notification_states(
+            user.user_id, user.deadline_at, active_states, next_alert_at, outbox_entries
+        )
+        if saved and outbox_entries:
+            self.outbox.notify()
+        if saved and self.scheduler is not None and self.deadline_queue.get(user.user_id) == placeholder:
+            # 推送期间未被打卡或删除覆盖时，按冷却结束时间重新入队
+            self.deadline_queue.schedule(user.user_id, next_alert_at)
     
-    async def check_all_users_timeout(self, users_db: Dict[str, CheckinUser]):
-        """检查所有用户是否超时"""
+    async def check_all_users_timeout(self, users_db: Dict[str, CheckinUser], user_storage=None) -> Dict[str, float]:
+        """检查所有用户是否超时，并发推送超时用户的通知
+        
+        传入user_storage时按告警状态执行冷却和退避，否则每次都推送。
+        """
         logger.info("正在检查超时用户...")
+        start = time.perf_counter()
         
+        timed_out_users = []
         for user_id, user in users_db.items():
             is_timed_out = await self.check_user_timeout(user)
             
             if is_timed_out:
                 logger.info(f"用户 {user_id} 已超时，触发推送通知...")
-                await self.trigger_push_notifications(user)
\ No newline at end of file
+                timed_out_users.append(user)
+                self.event_bus.publish(
+                    "overdue",
+                    user_id,
+                    deadline_at=user.deadline_at,
+                    last_checkin_time=user.last_checkin_time.isoformat()
+                )
+        
+        if timed_out_users:
+            await asyncio.gather(*(self._notify_user(user, user_storage) for user in timed_out_users))
+        
+        elapsed = time.perf_counter() - start
+        TIMEOUT_CHECK_DURATION.observe(elapsed)
+        TIMEOUT_CHECK_USERS.inc(len(users_db), result="checked")
+        TIMEOUT_CHECK_USERS.inc(len(timed_out_users), result="overdue")
+        logger.info(
+            f"超时检查完成：检查 {len(users_db)} 个用户，{len(timed_out_users)} 个超时，耗时 {elapsed:.3f} 秒"
+        )
+        return {"checked": len(users_db), "timed_out": len(timed_out_users), "elapsed": elapsed}
\ No newline at end of file